@@ -0,0 +1,160 @@
+import bpy
+from bpy.props import BoolProperty, CollectionProperty, IntProperty, StringProperty
+from bpy.types import AddonPreferences, Panel
+
+from . import dungeon
+from . import pointcloud
+
+
+#---------------------------------------------------------------------------#
+# Preferences
+
+class AgnosiaPreferences(AddonPreferences):
+    bl_idname = __package__
+
+    background_sampling : BoolProperty(name="Sample in background processes", default=False,
+        description="Sample large pointclouds in a pool of worker processes, keeping the UI responsive")
+    background_min_points : IntProperty(name="Minimum points", default=100000, min=0,
+        description="Only sample pointclouds with at least this many points in the background")
+    worker_count : IntProperty(name="Worker processes", default=0, min=0,
+        description="Number of worker processes for background sampling (0: one per CPU)")
+    sample_cache_size : IntProperty(name="Sample cache size (MB)", default=512, min=0,
+        description="Memory for keeping recently sampled pointclouds, so that returning to earlier settings is instant")
+    sphere_miss_budget : IntProperty(name="Sphere sampling miss budget", default=100, min=1,
+        description="Give up sphere sampling after this many rays per point have missed the target")
+    viewport_point_budget : IntProperty(name="Viewport point budget", default=250000, min=0,
+        update=(lambda self, context: pointcloud.update_all_pointcloud_displays()),
+        description="Most points to show in the viewport for each pointcloud, unless it sets its own limit (0: no limit)")
+    frame_budget : IntProperty(name="Frame budget (ms)", default=8, min=1, max=1000,
+        description="Time to spend sampling in each step of an update; shorter keeps the viewport smoother, longer finishes sooner")
+    show_profile : BoolProperty(name="Show timings", default=True,
+        description="Show how long the last update and export of a pointcloud took, stage by stage, in the Pointcloud panel")
+    profile_log : StringProperty(name="Timing log", default="", subtype='FILE_PATH',
+        description="Append the timings of every update and export to this JSON-lines file (empty: don't log)")
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, 'background_sampling')
+        row = layout.row()
+        row.enabled = self.background_sampling
+        row.prop(self, 'background_min_points')
+        row.prop(self, 'worker_count')
+        layout.prop(self, 'sample_cache_size')
+        layout.prop(self, 'sphere_miss_budget')
+        layout.prop(self, 'frame_budget')
+        layout.prop(self, 'viewport_point_budget')
+        layout.prop(self, 'show_profile')
+        layout.prop(self, 'profile_log')
+
+
+#---------------------------------------------------------------------------#
+# Panels
+
+class TOOLS_PT_agnosia_create(Panel):
+    bl_label = "Agnosia"
+    bl_idname = "TOOLS_PT_agnosia_create"
+    bl_space_type = "VIEW_3D"
+    bl_region_type = "UI"
+    bl_category = "Create"
+    bl_context = "objectmode"
+
+    @classmethod
+    def poll(self, context):
+        # This panel should always be available.
+        return True
+
+    def draw(self, context):
+        layout = self.layout
+        row = layout.row(align=True)
+        box = row.box()
+        box.label(text="Create")
+        row = box.row(align=True)
+        row.operator("object.create_pointcloud", text="Pointcloud")
+
+
+#---------------------------------------------------------------------------#
+# Menus
+
+def menu_create_pointcloud(self, context):
+    self.layout.operator(pointcloud.AgnosiaCreatePointcloudOperator.bl_idname)
+
+
+#---------------------------------------------------------------------------#
+# Register and unregister
+
+def register():
+    # Add preferences
+    bpy.utils.register_class(AgnosiaPreferences)
+
+    # Add operators
+    bpy.utils.register_class(pointcloud.AgnosiaCreatePointcloudOperator)
+    bpy.utils.register_class(pointcloud.AgnosiaUpdatePointcloudOperator)
+    bpy.utils.register_class(pointcloud.AgnosiaPointcloudExportOperator)
+    bpy.utils.register_class(pointcloud.AgnosiaExportAllPointcloudsOperator)
+    bpy.utils.register_class(pointcloud.AgnosiaPurgePointcloudMeshesOperator)
+    bpy.utils.register_class(dungeon.ToolsOperator)
+    bpy.utils.register_class(dungeon.AddCorridorOperator)
+    bpy.utils.register_class(dungeon.BuildCorridorMeshOperator)
+
+    # Add panels
+    bpy.utils.register_class(TOOLS_PT_agnosia_create)
+    bpy.utils.register_class(pointcloud.AGNOSIA_PT_pointcloud)
+    bpy.utils.register_class(dungeon.AGNOSIA_PT_dungeon_corridor)
+
+    # Add menus
+    # FIXME: this shouldn't just be slapped on the end of the menu like this!
+    # Probably we should do an Add Object menu, and have this just be a convenience
+    # to add a pointcloud + link it to the selected object for sampling.
+    bpy.types.VIEW3D_MT_object.append(menu_create_pointcloud)
+
+    # Add property groups
+    bpy.utils.register_class(dungeon.CorridorProperty)
+    bpy.types.Object.dungeon_corridors = CollectionProperty(type=dungeon.CorridorProperty)
+    bpy.utils.register_class(pointcloud.PointcloudProperty)
+    # FIXME: Object.pointclouds should maybe be on Mesh instead, since I can't sample cameras and shit.
+    bpy.types.Object.pointclouds = CollectionProperty(type=pointcloud.PointcloudProperty)
+
+    # Add handlers
+    bpy.app.handlers.load_post.append(pointcloud.raw_data_load_post)
+    bpy.app.handlers.save_pre.append(pointcloud.raw_data_save_pre)
+    bpy.app.handlers.save_post.append(pointcloud.raw_data_save_post)
+
+    # Done.
+    print("agnosia_tools: registered.");
+
+
+def unregister():
+    # Remove handlers
+    bpy.app.handlers.save_post.remove(pointcloud.raw_data_save_post)
+    bpy.app.handlers.save_pre.remove(pointcloud.raw_data_save_pre)
+    bpy.app.handlers.load_post.remove(pointcloud.raw_data_load_post)
+
+    # Remove property groups
+    del bpy.types.Object.pointclouds
+    bpy.utils.unregister_class(pointcloud.PointcloudProperty)
+    del bpy.types.Object.dungeon_corridors
+    bpy.utils.unregister_class(dungeon.CorridorProperty)
+
+    # Remove menus
+    bpy.types.VIEW3D_MT_object.remove(menu_create_pointcloud)
+
+    # Remove panels
+    bpy.utils.unregister_class(dungeon.AGNOSIA_PT_dungeon_corridor)
+    bpy.utils.unregister_class(pointcloud.AGNOSIA_PT_pointcloud)
+    bpy.utils.unregister_class(TOOLS_PT_agnosia_create)
+
+    # Remove operators
+    bpy.utils.unregister_class(dungeon.BuildCorridorMeshOperator)
+    bpy.utils.unregister_class(dungeon.AddCorridorOperator)
+    bpy.utils.unregister_class(dungeon.ToolsOperator)
+    bpy.utils.unregister_class(pointcloud.AgnosiaPurgePointcloudMeshesOperator)
+    bpy.utils.unregister_class(pointcloud.AgnosiaExportAllPointcloudsOperator)
+    bpy.utils.unregister_class(pointcloud.AgnosiaPointcloudExportOperator)
+    bpy.utils.unregister_class(pointcloud.AgnosiaUpdatePointcloudOperator)
+    bpy.utils.unregister_class(pointcloud.AgnosiaCreatePointcloudOperator)
+
+    # Remove preferences
+    bpy.utils.unregister_class(AgnosiaPreferences)
+
+    # Done
+    print("agnosia_tools: unregistered.");
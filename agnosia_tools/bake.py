@@ -0,0 +1,389 @@
+# Bake .bin pointclouds for meshes, without Blender:
+#
+#     python -m agnosia_tools.bake assets/ -o baked/ --count 4096 --sampler VOLUME
+#
+# Reads .obj, .ply and .npz meshes (directories are searched recursively),
+# samples them just like the pointcloud panel does with the same settings,
+# and writes a .bin for each. Each output gets a .key file recording what it
+# was baked from, and is skipped next time if that hasn't changed.
+
+import argparse
+import hashlib
+import numpy as np
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .formats import PointcloudBinWriter, is_up_to_date, pack_records, write_key_file
+from .sampling import (SAMPLERS, SamplingError, SphereSampler, TriangleMesh, create_sampler,
+    sample_range)
+from .utils import SHARED_FILE_PERMISSIONS, tempfile
+
+# This runs from the command line, so it must never import bpy, bmesh or
+# mathutils, directly or through the modules it uses.
+
+#---------------------------------------------------------------------------#
+# Reading meshes
+
+MESH_EXTENSIONS = ('.obj', '.ply', '.npz')
+
+def triangle_mesh(positions, triangles):
+    # Make a TriangleMesh, with the same per-triangle normals that Blender
+    # gives its loop triangles.
+    positions = np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, 3)
+    triangles = np.ascontiguousarray(triangles, dtype=np.int32).reshape(-1, 3)
+    if len(triangles) and (triangles.min() < 0 or triangles.max() >= len(positions)):
+        raise ValueError("Triangle vertex index out of range.")
+    a = positions[triangles[:, 0]]
+    normals = np.cross(positions[triangles[:, 1]] - a, positions[triangles[:, 2]] - a)
+    lengths = np.sqrt((normals ** 2).sum(axis=1))[:, np.newaxis]
+    normals = (normals / np.where(lengths > 0, lengths, 1.0)).astype(np.float32)
+    return TriangleMesh(positions, triangles, normals)
+
+def fan_triangles(faces):
+    # Triangulate a list of polygons (lists of vertex indices) as fans.
+    # Blender splits concave polygons differently, so only meshes that are
+    # already triangulated (or have convex faces) sample identically.
+    triangles = []
+    for face in faces:
+        for i in range(1, len(face) - 1):
+            triangles.append((face[0], face[i], face[i + 1]))
+    return np.array(triangles, dtype=np.int64).reshape(-1, 3)
+
+def y_up_to_z_up(positions):
+    # The same axis conversion as Blender's .obj importer: its default
+    # forward -Z and up Y make (x, y, z) into (x, -z, y).
+    positions = np.asarray(positions)
+    return np.stack((positions[:, 0], -positions[:, 2], positions[:, 1]), axis=1)
+
+def read_obj(filename, y_up=True):
+    """Read every face in the .obj file into a single TriangleMesh."""
+    positions = []
+    faces = []
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                if len(parts) < 4:
+                    raise ValueError(f"Malformed .obj vertex {line.strip()!r}.")
+                positions.append([float(x) for x in parts[1:4]])
+            elif parts[0] == 'f':
+                face = []
+                for part in parts[1:]:
+                    index = int(part.split('/')[0])
+                    # Indices are 1-based, or negative relative to the end.
+                    face.append((index - 1) if index > 0 else (len(positions) + index))
+                faces.append(face)
+    positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+    if y_up:
+        positions = y_up_to_z_up(positions)
+    return triangle_mesh(positions, fan_triangles(faces))
+
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+    }
+
+def read_ply(filename):
+    """Read the vertices and faces of an ascii or binary .ply file into a
+    TriangleMesh."""
+    with open(filename, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError("Not a .ply file.")
+        file_format = None
+        elements = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError("Truncated .ply header.")
+            parts = line.decode('ascii', errors='replace').split()
+            if not parts or parts[0] in ('comment', 'obj_info'):
+                continue
+            if parts[0] == 'end_header':
+                break
+            if parts[0] == 'format':
+                _check_ply_header_line(parts, 3)
+                file_format = parts[1]
+            elif parts[0] == 'element':
+                _check_ply_header_line(parts, 3)
+                elements.append((parts[1], int(parts[2]), []))
+            elif parts[0] == 'property':
+                if not elements:
+                    raise ValueError("Malformed .ply header: property before any element.")
+                # (name, type) or (name, count type, item type) for lists.
+                if parts[1:2] == ['list']:
+                    _check_ply_header_line(parts, 5)
+                    elements[-1][2].append((parts[4], _ply_type(parts[2]), _ply_type(parts[3])))
+                else:
+                    _check_ply_header_line(parts, 3)
+                    elements[-1][2].append((parts[2], _ply_type(parts[1])))
+        if file_format == 'ascii':
+            tokens = iter(f.read().split())
+            read_element = _read_ply_ascii_element
+        elif file_format in ('binary_little_endian', 'binary_big_endian'):
+            tokens = f
+            read_element = _read_ply_binary_element
+        else:
+            raise ValueError(f"Unsupported .ply format {file_format!r}.")
+        byte_order = ('>' if file_format == 'binary_big_endian' else '<')
+        positions = None
+        faces = None
+        for (name, count, properties) in elements:
+            values = read_element(tokens, count, properties, byte_order)
+            if name == 'vertex':
+                if not all(axis in values for axis in 'xyz'):
+                    raise ValueError(".ply vertices have no x, y and z.")
+                positions = np.stack([values[axis] for axis in 'xyz'], axis=1)
+            elif name == 'face':
+                faces = values.get('vertex_indices', values.get('vertex_index'))
+                # Nothing after the faces is needed.
+                break
+    if positions is None or faces is None:
+        raise ValueError(".ply file has no vertices or faces.")
+    if isinstance(faces, np.ndarray) and faces.shape[1] == 3:
+        triangles = faces
+    else:
+        triangles = fan_triangles(faces)
+    return triangle_mesh(positions, triangles)
+
+def _check_ply_header_line(parts, length):
+    if len(parts) != length:
+        raise ValueError(f"Malformed .ply header line {' '.join(parts)!r}.")
+
+def _ply_type(name):
+    try:
+        return PLY_TYPES[name]
+    except KeyError:
+        raise ValueError(f"Unknown .ply property type {name!r}.") from None
+
+def _next_ply_token(tokens):
+    token = next(tokens, None)
+    if token is None:
+        raise ValueError("Truncated .ply data.")
+    return token
+
+def _read_ply_ascii_element(tokens, count, properties, byte_order):
+    values = {prop[0]: [] for prop in properties}
+    for _ in range(count):
+        for prop in properties:
+            if len(prop) == 3:
+                n = int(_next_ply_token(tokens))
+                values[prop[0]].append([int(_next_ply_token(tokens)) for _ in range(n)])
+            else:
+                values[prop[0]].append(float(_next_ply_token(tokens)))
+    return _ply_values(properties, values)
+
+def _read_ply_binary(f, dtype, count=1):
+    # Read count items of dtype, or raise ValueError if the file ends first.
+    data = f.read(dtype.itemsize * count)
+    if len(data) != dtype.itemsize * count:
+        raise ValueError("Truncated .ply data.")
+    return np.frombuffer(data, dtype=dtype, count=count)
+
+def _read_ply_binary_element(f, count, properties, byte_order):
+    if all(len(prop) == 2 for prop in properties):
+        dtype = np.dtype([(name, byte_order + t) for (name, t) in properties])
+        data = _read_ply_binary(f, dtype, count)
+        return {name: data[name] for (name, t) in properties}
+    if len(properties) == 1:
+        # A single list property, like most faces: read them all at once
+        # if they all have the same length (triangles, say), which is
+        # checked by reading the first count.
+        (name, count_type, item_type) = properties[0]
+        count_dtype = np.dtype(byte_order + count_type)
+        item_dtype = np.dtype(byte_order + item_type)
+        start = f.tell()
+        n = (int(_read_ply_binary(f, count_dtype)[0]) if count else 0)
+        f.seek(start)
+        dtype = np.dtype([('n', count_dtype), ('items', item_dtype, (n,))])
+        block = f.read(dtype.itemsize * count)
+        if len(block) == dtype.itemsize * count:
+            data = np.frombuffer(block, dtype=dtype, count=count)
+            if np.all(data['n'] == n):
+                return {name: data['items'].reshape(count, n).astype(np.int64)}
+        f.seek(start)
+    values = {prop[0]: [] for prop in properties}
+    for _ in range(count):
+        for prop in properties:
+            if len(prop) == 3:
+                count_dtype = np.dtype(byte_order + prop[1])
+                item_dtype = np.dtype(byte_order + prop[2])
+                n = int(_read_ply_binary(f, count_dtype)[0])
+                items = _read_ply_binary(f, item_dtype, n)
+                values[prop[0]].append(items.tolist())
+            else:
+                t = np.dtype(byte_order + prop[1])
+                values[prop[0]].append(_read_ply_binary(f, t)[0])
+    return _ply_values(properties, values)
+
+def _ply_values(properties, values):
+    # Scalar properties as arrays; lists stay lists, as they can be ragged.
+    return {prop[0]: (values[prop[0]] if len(prop) == 3 else np.array(values[prop[0]]))
+        for prop in properties}
+
+def read_npz(filename):
+    """Read a TriangleMesh from a NumPy archive with 'positions' and
+    'triangles' arrays (as in TriangleMesh)."""
+    with np.load(filename) as archive:
+        if not ('positions' in archive and 'triangles' in archive):
+            raise ValueError(".npz file has no 'positions' and 'triangles' arrays.")
+        return triangle_mesh(archive['positions'], archive['triangles'])
+
+def read_mesh(filename, y_up=True):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.obj':
+        return read_obj(filename, y_up=y_up)
+    elif ext == '.ply':
+        return read_ply(filename)
+    elif ext == '.npz':
+        return read_npz(filename)
+    raise ValueError(f"Unsupported mesh file {filename!r}.")
+
+
+#---------------------------------------------------------------------------#
+# Baking
+
+# Bump this whenever a change would make baked files come out differently.
+BAKE_VERSION = 1
+
+# Points are sampled and written out this many at a time.
+BAKE_STEP_COUNT = 65536
+
+def file_digest(filename):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def bake_key(filename, settings):
+    # Everything that goes into a baked file: the input, and the settings.
+    fields = [f"v{BAKE_VERSION}", file_digest(filename)]
+    fields.extend(f"{name}={settings[name]}" for name in sorted(settings))
+    return ' '.join(fields)
+
+def bake_file(source, destination, settings, force=False):
+    """Sample the mesh in source, and write the points to the .bin file
+    destination. Return the number of points written, or None if the file
+    was already up to date."""
+    key = bake_key(source, settings)
+    if not force and is_up_to_date(destination, key):
+        return None
+    mesh = read_mesh(source, y_up=settings['y_up'])
+    if not len(mesh.triangles):
+        raise SamplingError("Mesh has no faces.")
+    sampler = create_sampler(settings['sampler'], mesh, miss_budget=settings['miss_budget'])
+    count = settings['count']
+    directory = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file, so a failed bake never leaves a partial
+    # file that looks finished.
+    with tempfile(suffix='.bin', dir=directory) as temp:
+        with PointcloudBinWriter(temp) as f:
+            for start in range(0, count, BAKE_STEP_COUNT):
+                (vertices, normals, colors) = sample_range(sampler, settings['seed'],
+                    start, min(start + BAKE_STEP_COUNT, count))
+                f.write_records(pack_records(vertices, colors))
+        # Temporary files are private; the baked file shouldn't be.
+        os.chmod(temp, SHARED_FILE_PERMISSIONS)
+        os.replace(temp, destination)
+    write_key_file(destination, key)
+    return count
+
+def _bake_job(source, destination, settings, force):
+    # Runs in a worker process; errors are returned instead of raised, so
+    # that one bad file doesn't stop the rest. Readers raise ValueError for
+    # bad files, but anything else that goes wrong is still only this
+    # file's failure.
+    start = time.perf_counter()
+    try:
+        count = bake_file(source, destination, settings, force=force)
+    except (OSError, ValueError, KeyError, SamplingError) as e:
+        return (source, None, str(e) or type(e).__name__, time.perf_counter() - start)
+    except Exception as e:
+        return (source, None, f"{type(e).__name__}: {e}", time.perf_counter() - start)
+    return (source, count, None, time.perf_counter() - start)
+
+def find_meshes(path):
+    # Yield (filename, path relative to the search root) for each mesh.
+    if os.path.isfile(path):
+        yield (path, os.path.basename(path))
+        return
+    for (directory, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in MESH_EXTENSIONS:
+                full = os.path.join(directory, filename)
+                yield (full, os.path.relpath(full, path))
+
+def bake_jobs(paths, output=None):
+    # Yield (source, destination) for each mesh under paths. Without an
+    # output directory, each .bin goes next to its mesh.
+    for path in paths:
+        for (source, relative) in find_meshes(path):
+            if output is None:
+                destination = os.path.splitext(source)[0] + '.bin'
+            else:
+                destination = os.path.join(output, os.path.splitext(relative)[0] + '.bin')
+            yield (source, destination)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m agnosia_tools.bake',
+        description="Bake .bin pointclouds from .obj, .ply and .npz meshes.")
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+        help="mesh files, or directories to search for them")
+    parser.add_argument('-o', '--output', default=None,
+        help="directory for the .bin files (default: next to each mesh)")
+    parser.add_argument('--count', type=int, default=1024,
+        help="number of points (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+        help="sampling seed (default: %(default)s)")
+    parser.add_argument('--sampler', choices=sorted(SAMPLERS), default='SURFACE',
+        help="sampler (default: %(default)s)")
+    parser.add_argument('--miss-budget', type=int, default=SphereSampler.miss_budget,
+        help="SPHERE sampler misses allowed per point (default: %(default)s)")
+    parser.add_argument('--keep-axes', action='store_true',
+        help="don't convert .obj files from Y up to Blender's Z up")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+        help="worker processes (default: one per CPU)")
+    parser.add_argument('-f', '--force', action='store_true',
+        help="bake everything, even files that are up to date")
+    args = parser.parse_args(argv)
+
+    settings = {
+        'count': args.count,
+        'seed': args.seed,
+        'sampler': args.sampler,
+        'miss_budget': args.miss_budget,
+        'y_up': not args.keep_axes,
+        }
+    jobs = list(bake_jobs(args.paths, args.output))
+    if not jobs:
+        print("No meshes found.", file=sys.stderr)
+        return 1
+
+    baked = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=(args.jobs or None)) as executor:
+        futures = [executor.submit(_bake_job, source, destination, settings, args.force)
+            for (source, destination) in jobs]
+        for future in futures:
+            (source, count, error, seconds) = future.result()
+            if error is not None:
+                failed += 1
+                print(f"FAILED {source}: {error}", file=sys.stderr)
+            elif count is None:
+                skipped += 1
+            else:
+                baked += 1
+                print(f"baked {source}: {count} points in {seconds:.2f}s")
+    print(f"{baked} baked, {skipped} up to date, {failed} failed.")
+    return (1 if failed else 0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,402 @@
+# Benchmarks for the pointcloud hot paths, without Blender:
+#
+#     python -m agnosia_tools.bench -o before.json
+#     python -m agnosia_tools.bench -o after.json --compare before.json
+#
+# Each stage runs on synthetic meshes at several triangle and point counts.
+# The results, as JSON, give the best time of a few runs, the throughput,
+# and the peak memory allocated (measured with tracemalloc in a separate
+# run, as it slows everything down). They also give a scaling exponent for
+# each stage and mesh: the slope of log(time) against log(points).
+#
+# pointcloud.py needs bpy and mathutils, so minimal stand-ins for them are
+# installed when they aren't there; only the parts that the benchmarked
+# functions touch do anything.
+
+import argparse
+import base64
+import json
+import math
+import numpy as np
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import zlib
+
+from .bake import triangle_mesh
+from .bvh import TriangleBVH, raycast_to_origin
+from .formats import PointcloudBinWriter, pack_records
+from .sampling import create_sampler
+from .storage import RawDataStore
+
+#---------------------------------------------------------------------------#
+# Stand-ins for Blender's modules
+
+class StandinCollection:
+    # A bpy_prop_collection of items with one array property each, held as
+    # a flat array, with foreach_get().
+
+    def __init__(self, **arrays):
+        self.arrays = arrays
+        self.count = (len(next(iter(arrays.values()))) if arrays else 0)
+
+    def __len__(self):
+        return self.count
+
+    def foreach_get(self, name, out):
+        out[:] = self.arrays[name].ravel()
+
+
+class StandinMesh:
+    # A bpy.types.Mesh with triangles for faces, so that its loop triangles
+    # are just its faces.
+
+    def __init__(self, mesh):
+        self.vertices = StandinCollection(co=mesh.positions)
+        self.loop_triangles = StandinCollection(
+            vertices=mesh.triangles, normal=mesh.normals)
+
+    def calc_loop_triangles(self):
+        pass
+
+
+class StandinObject:
+
+    def __init__(self, mesh):
+        self.data = StandinMesh(mesh)
+
+
+def install_standins():
+    """Put stand-ins for bpy and mathutils into sys.modules, unless the real
+    ones can be imported. Return True if the stand-ins were installed."""
+    try:
+        import bpy
+        return False
+    except ImportError:
+        pass
+
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        sys.modules[name] = m
+        return m
+
+    def prop(*args, **kwargs):
+        return None
+
+    props = module('bpy.props', **{name: prop for name in (
+        'BoolProperty', 'EnumProperty', 'FloatProperty', 'IntProperty',
+        'PointerProperty', 'StringProperty', 'CollectionProperty')})
+    bpy_types = module('bpy.types', **{name: type(name, (), {}) for name in (
+        'AddonPreferences', 'Menu', 'Object', 'Operator', 'Panel', 'PropertyGroup')})
+    handlers = module('bpy.app.handlers', persistent=(lambda f: f))
+    app = module('bpy.app', handlers=handlers, binary_path_python=sys.executable,
+        background=True)
+    data = types.SimpleNamespace(filepath="", objects=[])
+    module('bpy', props=props, types=bpy_types, app=app, data=data)
+    # None of the benchmarked functions use mathutils: pointcloud.py only
+    # needs the names to import.
+    mathutils = module('mathutils', Vector=type('Vector', (), {}))
+    mathutils.bvhtree = module('mathutils.bvhtree', BVHTree=type('BVHTree', (), {}))
+    return True
+
+
+#---------------------------------------------------------------------------#
+# Synthetic meshes
+
+def uv_sphere(triangle_count, radius=1.0, noise=0.0, seed=0):
+    """Return a TriangleMesh of a UV sphere with about triangle_count
+    triangles. With noise, each vertex is moved in or out by up to that
+    fraction of the radius."""
+    # 2 * segments * (rings - 1) triangles, with rings = segments // 2.
+    segments = max(4, int(round(math.sqrt(triangle_count))))
+    rings = max(3, segments // 2)
+    theta = np.linspace(0.0, math.pi, rings + 1)[1:-1]
+    phi = np.linspace(0.0, 2 * math.pi, segments, endpoint=False)
+    (t, p) = np.meshgrid(theta, phi, indexing='ij')
+    positions = np.concatenate((
+        [(0.0, 0.0, 1.0)],
+        np.stack((np.sin(t) * np.cos(p), np.sin(t) * np.sin(p), np.cos(t)), axis=-1).reshape(-1, 3),
+        [(0.0, 0.0, -1.0)],
+        ))
+    if noise:
+        rs = np.random.RandomState(seed)
+        positions *= 1.0 + rs.uniform(-noise, noise, (len(positions), 1))
+    positions *= radius
+
+    def ring(r):
+        return 1 + r * segments + np.arange(segments)
+    triangles = []
+    first = ring(0)
+    triangles.append(np.stack((np.zeros(segments, dtype=np.int64), first, np.roll(first, -1)), axis=1))
+    for r in range(rings - 2):
+        (a, b) = (ring(r), ring(r + 1))
+        (a1, b1) = (np.roll(a, -1), np.roll(b, -1))
+        triangles.append(np.stack((a, b, b1), axis=1))
+        triangles.append(np.stack((a, b1, a1), axis=1))
+    last = ring(rings - 2)
+    bottom = len(positions) - 1
+    triangles.append(np.stack((np.full(segments, bottom), np.roll(last, -1), last), axis=1))
+    return triangle_mesh(positions, np.concatenate(triangles))
+
+def grid(triangle_count, size=2.0):
+    """Return a TriangleMesh of a flat square grid in the xy plane with about
+    triangle_count triangles."""
+    n = max(1, int(round(math.sqrt(triangle_count / 2))))
+    coords = np.linspace(-size / 2, size / 2, n + 1)
+    (x, y) = np.meshgrid(coords, coords, indexing='ij')
+    positions = np.stack((x, y, np.zeros_like(x)), axis=-1).reshape(-1, 3)
+    corner = (np.arange(n)[:, np.newaxis] * (n + 1) + np.arange(n)).ravel()
+    triangles = np.concatenate((
+        np.stack((corner, corner + n + 1, corner + n + 2), axis=1),
+        np.stack((corner, corner + n + 2, corner + 1), axis=1),
+        ))
+    return triangle_mesh(positions, triangles)
+
+MESHES = {
+    'sphere': uv_sphere,
+    'grid': grid,
+    'noise': (lambda triangle_count: uv_sphere(triangle_count, noise=0.2)),
+    }
+
+# Meshes that enclose a volume, for the samplers that need one.
+CLOSED_MESHES = ('sphere', 'noise')
+
+
+#---------------------------------------------------------------------------#
+# Stages
+#
+# Each stage is a function (pointcloud, mesh_name, mesh, points), given the
+# pointcloud module, that does any setup and returns a function to time (or
+# None, if the stage doesn't apply to the mesh). Stages that don't depend on the mesh only run
+# on the first mesh in the list.
+
+def _random_points(count, seed=0):
+    rs = np.random.RandomState(seed)
+    vertices = rs.uniform(-1, 1, (count, 3)).astype(np.float32)
+    normals = rs.uniform(-1, 1, (count, 3)).astype(np.float32)
+    colors = rs.uniform(0, 1, (count, 4)).astype(np.float32)
+    return (vertices, normals, colors)
+
+def stage_surface_sample_obj(pointcloud, mesh_name, mesh, points):
+    o = StandinObject(mesh)
+    return lambda: pointcloud.surface_sample_obj(o, points, random.Random(0))
+
+def _generate_points_stage(sampler_name):
+    def stage(pointcloud, mesh_name, mesh, points):
+        if sampler_name != 'SURFACE' and mesh_name not in CLOSED_MESHES:
+            return None
+        def run():
+            sampler = create_sampler(sampler_name, mesh)
+            for data in pointcloud.generate_points(sampler, points, 0,
+                    step_count=pointcloud.SAMPLE_STEP_COUNT):
+                pass
+        return run
+    return stage
+
+def stage_raycast_to_origin(pointcloud, mesh_name, mesh, points):
+    if mesh_name not in CLOSED_MESHES:
+        return None
+    bvh = TriangleBVH.from_mesh(mesh)
+    rs = np.random.RandomState(0)
+    origins = rs.normal(size=(points, 3))
+    origins *= (1.5 / np.sqrt((origins ** 2).sum(axis=1)))[:, np.newaxis]
+    return lambda: raycast_to_origin(bvh, origins)
+
+def stage_expand_vertex_data_to_mesh(pointcloud, mesh_name, mesh, points):
+    data = _random_points(points)
+    return lambda: pointcloud.expand_vertex_data_to_mesh(*data)
+
+def stage_raw_store(pointcloud, mesh_name, mesh, points):
+    # Stands in for the old _pack_array(): storing and reloading raw data.
+    data = _random_points(points)
+    def run():
+        with tempfile.TemporaryDirectory() as directory:
+            store = RawDataStore(directory)
+            digests = [store.put(a) for a in data]
+            for digest in digests:
+                np.asarray(RawDataStore(directory).get(digest)).sum()
+    return run
+
+def stage_unpack_array(pointcloud, mesh_name, mesh, points):
+    # Raw data as older files stored it.
+    (vertices, normals, colors) = _random_points(points)
+    string = base64.encodebytes(zlib.compress(vertices.tobytes())).decode('ascii')
+    return lambda: pointcloud.PointcloudProperty._unpack_array(string, 'f')
+
+def stage_export(pointcloud, mesh_name, mesh, points):
+    (vertices, normals, colors) = _random_points(points)
+    def run():
+        with tempfile.TemporaryDirectory() as directory:
+            with PointcloudBinWriter(os.path.join(directory, 'bench.bin')) as f:
+                f.write_records(pack_records(vertices, colors))
+    return run
+
+STAGES = {
+    'surface_sample_obj': (stage_surface_sample_obj, True),
+    'generate_points_surface': (_generate_points_stage('SURFACE'), True),
+    'generate_points_volume': (_generate_points_stage('VOLUME'), True),
+    'generate_points_sphere': (_generate_points_stage('SPHERE'), True),
+    'raycast_to_origin': (stage_raycast_to_origin, True),
+    'expand_vertex_data_to_mesh': (stage_expand_vertex_data_to_mesh, False),
+    'raw_store': (stage_raw_store, False),
+    'unpack_array': (stage_unpack_array, False),
+    'export': (stage_export, False),
+    }
+
+
+#---------------------------------------------------------------------------#
+# Running
+
+def measure(run, repeat):
+    # Return (best time in seconds, peak bytes allocated).
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (best, peak)
+
+def scaling_exponents(results):
+    # For each stage and mesh, fit time ~ points ** k, and return k.
+    series = {}
+    for r in results:
+        if r['seconds'] > 0:
+            key = (r['stage'], r['mesh'], r['triangles'])
+            series.setdefault(key, []).append((r['points'], r['seconds']))
+    exponents = []
+    for ((stage, mesh, triangles), values) in sorted(series.items()):
+        if len(values) < 2:
+            continue
+        (x, y) = np.log(np.array(values, dtype=np.float64)).T
+        exponents.append({
+            'stage': stage, 'mesh': mesh, 'triangles': triangles,
+            'exponent': round(float(np.polyfit(x, y, 1)[0]), 3),
+            })
+    return exponents
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(stages, meshes, triangle_counts, point_counts, repeat=3, log=None):
+    install_standins()
+    from . import pointcloud
+
+    results = []
+    for stage_name in stages:
+        (stage, per_mesh) = STAGES[stage_name]
+        for mesh_name in (meshes if per_mesh else meshes[:1]):
+            for triangle_count in (triangle_counts if per_mesh else triangle_counts[:1]):
+                mesh = MESHES[mesh_name](triangle_count)
+                for points in point_counts:
+                    run = stage(pointcloud, mesh_name, mesh, points)
+                    if run is None:
+                        continue
+                    (seconds, peak) = measure(run, repeat)
+                    result = {
+                        'stage': stage_name,
+                        'mesh': (mesh_name if per_mesh else None),
+                        'triangles': (len(mesh.triangles) if per_mesh else None),
+                        'points': points,
+                        'seconds': seconds,
+                        'points_per_second': ((points / seconds) if seconds > 0 else None),
+                        'peak_bytes': peak,
+                        }
+                    results.append(result)
+                    if log is not None:
+                        print(f"{stage_name:28} {str(result['mesh']):8} "
+                            f"{str(result['triangles']):>8} tris {points:>9} points "
+                            f"{seconds * 1000:10.2f} ms {peak / 2**20:9.1f} MB", file=log)
+    return {
+        'version': 1,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+        'scaling': scaling_exponents(results),
+        }
+
+def compare(report, baseline, out):
+    # Print how much faster (>1) or slower (<1) each result is than the
+    # same one in baseline.
+    def key(r):
+        return (r['stage'], r['mesh'], r['triangles'], r['points'])
+    before = {key(r): r for r in baseline['results']}
+    for r in report['results']:
+        b = before.get(key(r))
+        if b is None or not r['seconds']:
+            continue
+        print(f"{r['stage']:28} {str(r['mesh']):8} {str(r['triangles']):>8} tris "
+            f"{r['points']:>9} points  speed x{b['seconds'] / r['seconds']:6.2f}  "
+            f"memory x{(r['peak_bytes'] / b['peak_bytes']) if b['peak_bytes'] else 0:6.2f}",
+            file=out)
+
+def int_list(s):
+    return [int(float(x)) for x in s.split(',') if x]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m agnosia_tools.bench',
+        description="Benchmark the pointcloud hot paths, and write the results as JSON.")
+    parser.add_argument('-o', '--output', default=None,
+        help="file to write the JSON results to (default: standard output)")
+    parser.add_argument('--stages', type=(lambda s: s.split(',')), default=list(STAGES),
+        help=f"comma-separated stages to run (default: all of {','.join(STAGES)})")
+    parser.add_argument('--meshes', type=(lambda s: s.split(',')), default=list(MESHES),
+        help="comma-separated synthetic meshes (default: %(default)s)")
+    parser.add_argument('--triangles', type=int_list, default=[1000, 100000],
+        help="comma-separated triangle counts (default: %(default)s)")
+    parser.add_argument('--points', type=int_list, default=[1000, 10000, 100000, 1000000],
+        help="comma-separated point counts (default: %(default)s)")
+    parser.add_argument('--full', action='store_true',
+        help="also run at 10M points, which needs a few GB of memory")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="runs to take the best time of (default: %(default)s)")
+    parser.add_argument('--compare', default=None, metavar='BASELINE',
+        help="JSON results from an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    for name in args.stages:
+        if name not in STAGES:
+            parser.error(f"unknown stage {name!r}")
+    for name in args.meshes:
+        if name not in MESHES:
+            parser.error(f"unknown mesh {name!r}")
+    points = list(args.points)
+    if args.full and 10000000 not in points:
+        points.append(10000000)
+
+    report = run_benchmarks(args.stages, args.meshes, args.triangles, points,
+        repeat=args.repeat, log=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(report, json.load(f), sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
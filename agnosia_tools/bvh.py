@@ -0,0 +1,252 @@
+import numpy as np
+
+# Nothing in this module may import bpy, bmesh or mathutils: it works on
+# plain arrays, so that it can also run outside of Blender.
+
+#---------------------------------------------------------------------------#
+# Bounding volume hierarchy over triangles.
+
+class TriangleBVH:
+    """A BVH over a triangle soup, stored in flat arrays, that casts whole
+    packets of rays at once.
+
+    The tree is a complete binary tree stored heap-style (node i has
+    children 2i + 1 and 2i + 2), so there are no child pointers to chase.
+    It is built top-down, one level at a time: every node's triangles are
+    sorted along the longest axis of their centroids' bounds and split in
+    half, until there are leaf_size triangles in each leaf.
+
+    ray_cast() casts a single ray, and works like mathutils.bvhtree.BVHTree's,
+    so it can stand in for one; ray_cast_many() casts a whole batch."""
+
+    leaf_size = 8
+    # Rays are traversed in packets of this many, to bound memory use.
+    packet_size = 4096
+
+    def __init__(self, positions, triangles):
+        positions = np.asarray(positions, dtype=np.float64)
+        triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        self.triangle_count = len(triangles)
+        self.a = positions[triangles[:, 0]]
+        self.ab = positions[triangles[:, 1]] - self.a
+        self.ac = positions[triangles[:, 2]] - self.a
+        normals = np.cross(self.ab, self.ac)
+        lengths = np.sqrt((normals ** 2).sum(axis=1))[:, np.newaxis]
+        self.normals = normals / np.where(lengths > 0, lengths, 1.0)
+
+        # Leaves, padded out to a power of two. slots holds the triangle in
+        # each place in each leaf, or -1 for padding.
+        leaf_count = max(1, -(-len(triangles) // self.leaf_size))
+        leaf_count = 1 << (leaf_count - 1).bit_length()
+        self.leaf_count = leaf_count
+        padded = leaf_count * self.leaf_size
+        centroids = np.full((padded, 3), np.nan)
+        centroids[:len(triangles)] = self.a + (self.ab + self.ac) / 3.0
+        slots = np.arange(padded)
+        level_size = padded
+        while level_size > self.leaf_size:
+            # Sort each node's triangles along its longest axis, so that the
+            # halves are its children. Padding always sorts last.
+            c = centroids[slots]
+            starts = np.arange(0, padded, level_size)
+            extent = np.fmax.reduceat(c, starts) - np.fmin.reduceat(c, starts)
+            axis = np.argmax(np.where(np.isnan(extent), -1.0, extent), axis=1)
+            node = np.arange(padded) // level_size
+            key = c[np.arange(padded), axis[node]]
+            key[np.isnan(key)] = np.inf
+            slots = slots[np.lexsort((key, node))]
+            level_size //= 2
+        slots[slots >= len(triangles)] = -1
+        self.slots = slots
+
+        # Node bounds, built bottom-up one level at a time.
+        tri_lo = np.minimum(self.a, np.minimum(self.a + self.ab, self.a + self.ac))
+        tri_hi = np.maximum(self.a, np.maximum(self.a + self.ab, self.a + self.ac))
+        lo = np.full((padded, 3), np.inf)
+        hi = np.full((padded, 3), -np.inf)
+        real = (slots >= 0)
+        lo[real] = tri_lo[slots[real]]
+        hi[real] = tri_hi[slots[real]]
+        node_count = 2 * leaf_count - 1
+        self.lo = np.empty((node_count, 3))
+        self.hi = np.empty((node_count, 3))
+        first_leaf = leaf_count - 1
+        self.lo[first_leaf:] = lo.reshape(leaf_count, self.leaf_size, 3).min(axis=1)
+        self.hi[first_leaf:] = hi.reshape(leaf_count, self.leaf_size, 3).max(axis=1)
+        # Leaves that are all padding get nan bounds, which no ray enters
+        # and which fmin and fmax ignore.
+        empty = ~real.reshape(leaf_count, self.leaf_size).any(axis=1)
+        self.lo[first_leaf:][empty] = np.nan
+        self.hi[first_leaf:][empty] = np.nan
+        level_start = first_leaf
+        while level_start > 0:
+            parents = np.arange((level_start - 1) // 2, level_start)
+            self.lo[parents] = np.fmin(self.lo[2 * parents + 1], self.lo[2 * parents + 2])
+            self.hi[parents] = np.fmax(self.hi[2 * parents + 1], self.hi[2 * parents + 2])
+            level_start = (level_start - 1) // 2
+
+    @classmethod
+    def from_mesh(cls, mesh):
+        # Build from a sampling.TriangleMesh.
+        return cls(mesh.positions, mesh.triangles)
+
+    def ray_cast(self, origin, direction, distance=np.inf):
+        """Cast a single ray. Return (location, normal, index, distance) of the
+        closest hit, or (None, None, None, None) if it misses everything."""
+        (hit, locations, normals, indices, distances) = self.ray_cast_many(
+            np.array([origin], dtype=np.float64),
+            np.array([direction], dtype=np.float64),
+            distance)
+        if not hit[0]:
+            return (None, None, None, None)
+        return (locations[0], normals[0], int(indices[0]), float(distances[0]))
+
+    def ray_cast_many(self, origins, directions, distance=np.inf):
+        """Cast rays origins[n, 3] along directions[n, 3] (which should be
+        normalised), up to distance. Return arrays (hit, locations, normals,
+        indices, distances) of the closest hit along each ray. Where a ray
+        misses, its index is -1 and its distance is inf."""
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        count = len(origins)
+        distances = np.full(count, np.inf)
+        indices = np.full(count, -1, dtype=np.int64)
+        for start in range(0, count, self.packet_size):
+            stop = min(start + self.packet_size, count)
+            (distances[start:stop], indices[start:stop]) = self._cast_packet(
+                origins[start:stop], directions[start:stop], distance)
+        hit = (indices >= 0)
+        locations = np.zeros((count, 3), dtype=np.float32)
+        normals = np.zeros((count, 3), dtype=np.float32)
+        locations[hit] = origins[hit] + directions[hit] * distances[hit, np.newaxis]
+        normals[hit] = self.normals[indices[hit]]
+        return (hit, locations, normals, indices, distances)
+
+    def _cast_packet(self, origins, directions, distance):
+        count = len(origins)
+        best_t = np.full(count, float(distance))
+        best_tri = np.full(count, -1, dtype=np.int64)
+        if not self.triangle_count:
+            return (np.full(count, np.inf), best_tri)
+        with np.errstate(divide='ignore'):
+            inverse = 1.0 / directions
+        first_leaf = self.leaf_count - 1
+        leaf_offsets = np.arange(self.leaf_size)
+
+        # Every ray walks the tree depth-first, with its own stack of nodes
+        # (and their entry distances) still to visit; but all the rays take
+        # a step together. Nearer children are visited first, so that far
+        # away nodes can be skipped once something closer has been hit.
+        depth = (self.leaf_count - 1).bit_length()
+        stack = np.zeros((count, depth + 2), dtype=np.int64)
+        stack_t = np.zeros((count, depth + 2))
+        rays = np.arange(count)
+        root_t = self._enter(origins, inverse, rays, np.zeros(count, dtype=np.int64), best_t)
+        pointer = (root_t < np.inf).astype(np.int64)
+        stack_t[:, 0] = root_t
+        while True:
+            rays = np.flatnonzero(pointer)
+            if not len(rays):
+                break
+            pointer[rays] -= 1
+            nodes = stack[rays, pointer[rays]]
+            visit = (stack_t[rays, pointer[rays]] < best_t[rays])
+            (rays, nodes) = (rays[visit], nodes[visit])
+
+            # Test the triangles of the leaves.
+            leaf = (nodes >= first_leaf)
+            if np.any(leaf):
+                leaf_rays = rays[leaf]
+                tris = self.slots[(nodes[leaf] - first_leaf)[:, np.newaxis] * self.leaf_size
+                    + leaf_offsets]
+                real = (tris >= 0)
+                t = np.full(tris.shape, np.inf)
+                t[real] = self._intersect(
+                    np.repeat(origins[leaf_rays], self.leaf_size, axis=0)[real.ravel()],
+                    np.repeat(directions[leaf_rays], self.leaf_size, axis=0)[real.ravel()],
+                    tris[real])
+                nearest = np.argmin(t, axis=1)
+                nearest_t = t[np.arange(len(t)), nearest]
+                closer = (nearest_t < best_t[leaf_rays])
+                best_t[leaf_rays[closer]] = nearest_t[closer]
+                best_tri[leaf_rays[closer]] = tris[closer, nearest[closer]]
+
+            # Push the children of the other nodes that the ray enters,
+            # the nearer one last.
+            (rays, nodes) = (rays[~leaf], nodes[~leaf])
+            left_t = self._enter(origins, inverse, rays, 2 * nodes + 1, best_t)
+            right_t = self._enter(origins, inverse, rays, 2 * nodes + 2, best_t)
+            left_first = (left_t <= right_t)
+            near_child = np.where(left_first, 2 * nodes + 1, 2 * nodes + 2)
+            far_child = np.where(left_first, 2 * nodes + 2, 2 * nodes + 1)
+            near_t = np.minimum(left_t, right_t)
+            far_t = np.maximum(left_t, right_t)
+            for (child, child_t) in ((far_child, far_t), (near_child, near_t)):
+                enter = (child_t < np.inf)
+                (pushing, slot) = (rays[enter], pointer[rays[enter]])
+                stack[pushing, slot] = child[enter]
+                stack_t[pushing, slot] = child_t[enter]
+                pointer[pushing] += 1
+
+        best_t[best_tri < 0] = np.inf
+        return (best_t, best_tri)
+
+    def _enter(self, origins, inverse, rays, nodes, best_t):
+        # Slab test of rays against the nodes' bounds. Returns the distance
+        # at which each ray enters its node, or inf if it misses, or only
+        # enters it beyond best_t. fmin and fmax ignore the nans from rays
+        # that lie in the plane of a slab; empty nodes are all nan, and
+        # always missed.
+        with np.errstate(invalid='ignore'):
+            t0 = (self.lo[nodes] - origins[rays]) * inverse[rays]
+            t1 = (self.hi[nodes] - origins[rays]) * inverse[rays]
+        near = np.maximum(np.fmax.reduce(np.fmin(t0, t1), axis=1), 0.0)
+        far = np.fmin.reduce(np.fmax(t0, t1), axis=1)
+        enters = (near <= far) & (near < best_t[rays])
+        return np.where(enters, near, np.inf)
+
+    def _intersect(self, origins, directions, tris):
+        # Moller-Trumbore, for pairs of rays and triangles. Returns the
+        # distance to each hit, or inf.
+        ab = self.ab[tris]
+        ac = self.ac[tris]
+        p = np.cross(directions, ac)
+        det = (ab * p).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1.0 / det
+            s = origins - self.a[tris]
+            u = (s * p).sum(axis=1) * inv_det
+            q = np.cross(s, ab)
+            v = (directions * q).sum(axis=1) * inv_det
+            t = (ac * q).sum(axis=1) * inv_det
+            hit = ((np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0))
+        return np.where(hit, t, np.inf)
+
+
+#---------------------------------------------------------------------------#
+# Raycasting many points at once.
+#
+# These do the same as pointcloud.raycast_to_origin() and
+# pointcloud.raycast_to_exterior(), for arrays of points.
+
+def raycast_to_origin(bvh, points):
+    """Cast rays from each of points[n, 3] towards the origin. Return
+    (hit, locations, normals, indices, distances), as for ray_cast_many()."""
+    points = np.asarray(points, dtype=np.float64)
+    lengths = np.sqrt((points ** 2).sum(axis=1))[:, np.newaxis]
+    directions = -points / np.where(lengths > 0, lengths, 1.0)
+    return bvh.ray_cast_many(points, directions)
+
+def raycast_to_exterior(bvh, points):
+    """Cast rays from each of points[n, 3] away from the origin. Return
+    (inside, locations, normals, indices, distances): a point is inside if its
+    ray hits a face from behind. Points too close to the origin to have a
+    proper direction are never inside."""
+    points = np.asarray(points, dtype=np.float64)
+    lengths = np.sqrt((points ** 2).sum(axis=1))[:, np.newaxis]
+    usable = (lengths[:, 0] >= 0.0001)
+    directions = points / np.where(usable[:, np.newaxis], lengths, 1.0)
+    (hit, locations, normals, indices, distances) = bvh.ray_cast_many(points, directions)
+    outward_facing = ((directions * normals).sum(axis=1) >= 0)
+    inside = (usable & hit & outward_facing)
+    return (inside, locations, normals, indices, distances)
@@ -0,0 +1,589 @@
+import json
+import numpy as np
+import os
+import struct
+import zlib
+
+from .utils import SHARED_FILE_PERMISSIONS, file_atomic
+
+# Nothing in this module may import bpy, bmesh or mathutils: it works on
+# plain arrays, so that it can also run outside of Blender.
+
+#---------------------------------------------------------------------------#
+# Pointcloud file types
+
+## Structures in binary pointcloud file
+
+def bin_size(size):
+    return struct.pack('=L', size)
+
+def bin_point(x, y, z, r, g, b):
+    return struct.pack('=fffBBBx', x, y, z, r, g, b)
+
+# The same layout as bin_point(), for packing many records at once.
+BIN_RECORD_DTYPE = np.dtype([
+    ('x', '=f4'), ('y', '=f4'), ('z', '=f4'),
+    ('r', 'u1'), ('g', 'u1'), ('b', 'u1'),
+    ('pad', 'u1'),
+    ])
+
+def colors_to_uint8(colors):
+    # Same as min(max(0, int(f * 255.0)), 255) for each channel.
+    scaled = np.trunc(np.asarray(colors, dtype=np.float64) * 255.0)
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+def pack_records(vertices, colors):
+    """Pack flat xyz vertices and rgba colors (any float32 buffers, such as
+    array('f')) into an array of BIN_RECORD_DTYPE records.
+
+    There is one record per point that has both a vertex and a color."""
+    vertices = np.frombuffer(vertices, dtype=np.float32).reshape(-1, 3)
+    colors = np.frombuffer(colors, dtype=np.float32).reshape(-1, 4)
+    count = min(len(vertices), len(colors))
+    records = np.zeros(count, dtype=BIN_RECORD_DTYPE)
+    records['x'] = vertices[:count, 0]
+    records['y'] = vertices[:count, 1]
+    records['z'] = vertices[:count, 2]
+    rgb = colors_to_uint8(colors[:count, :3])
+    records['r'] = rgb[:, 0]
+    records['g'] = rgb[:, 1]
+    records['b'] = rgb[:, 2]
+    return records
+
+
+## Binary pointcloud writing
+
+def open_output(filename, atomic=False):
+    # Open filename for writing, returning (context, file); call the
+    # context's __exit__() to close it. If atomic, the file is written
+    # elsewhere and only moved to filename if __exit__() is given no
+    # exception, so that an interrupted write never leaves a partial file.
+    if atomic:
+        context = file_atomic(filename, 'wb', permissions=SHARED_FILE_PERMISSIONS)
+    else:
+        context = open(filename, 'wb')
+    return (context, context.__enter__())
+
+
+class PointcloudBinWriter:
+    # File format:
+    #     uint32_t size_of_data
+    #     struct record {
+    #         float x, y, z;
+    #         uint8_t r, g, b;
+    #         uint8_t pad;
+    #     } records[size / sizeof(struct record)]
+
+    def __init__(self, filename, atomic=False):
+        self.filename = filename
+        # If atomic, the file only replaces filename once it is complete.
+        self.atomic = atomic
+        self.file = None
+        self.count = 0
+        self.size = 0
+
+    def write(self, x, y, z, r, g, b):
+        assert (self.file is not None), "File is not open."
+        blob = bin_point(x, y, z, r, g, b)
+        self.file.write(blob)
+        self.size += len(blob)
+        self.count += 1
+
+    # size_of_data is a uint32_t.
+    MAX_SIZE = 0xFFFFFFFF
+
+    def write_records(self, records):
+        # Write an array of BIN_RECORD_DTYPE records with a single write.
+        # Can be called any number of times, so a pointcloud can be
+        # streamed out in chunks without ever having all of it in memory.
+        assert (self.file is not None), "File is not open."
+        assert (records.dtype == BIN_RECORD_DTYPE), "Wrong record type."
+        if self.size + records.nbytes > self.MAX_SIZE:
+            raise ValueError("Pointcloud is too large for the .bin format.")
+        records = np.ascontiguousarray(records)
+        self.file.write(records)
+        self.size += records.nbytes
+        self.count += len(records)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        (self._opened, self.file) = open_output(self.filename, self.atomic)
+        # The file starts with the size of its data. We write a zero
+        # initially, and fill in the actual size on __exit__().
+        self.file.write(bin_size(0))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not exc_type and not exc_value:
+            self.file.seek(0)
+            self.file.write(bin_size(self.size))
+        self._opened.__exit__(exc_type, exc_value, traceback)
+
+
+## Quantised binary pointclouds (version 2)
+#
+# File format, all little-endian:
+#     struct header {
+#         char magic[4];            // "APC2"
+#         uint16_t version;         // 2
+#         uint16_t flags;           // BIN2_NORMALS | BIN2_ZLIB
+#         uint64_t count;           // number of points
+#         float bounds_min[3];
+#         float bounds_max[3];
+#         uint32_t block_size;      // points per block (the last may have fewer)
+#         uint32_t block_count;
+#         uint64_t table_offset;    // where the block table starts
+#     };
+#     blocks, each one (zlib-compressed, if BIN2_ZLIB) of:
+#         uint16_t positions[n][3]; // quantised to the bounds
+#         uint8_t colors[n][3];
+#         uint8_t normals[n][2];    // octahedral, if BIN2_NORMALS
+#     struct block_entry {
+#         uint64_t offset;
+#         uint32_t stored_size;     // size in the file
+#         uint32_t count;           // number of points
+#     } block_table[block_count];
+#
+# That's 11 bytes per point, or 9 without normals, before compression;
+# version 1 takes 16. A version 1 file can't start with the magic, as its
+# first four bytes are its data size, always a multiple of 16.
+
+BIN2_MAGIC = b'APC2'
+BIN2_VERSION = 2
+BIN2_HEADER = struct.Struct('<4sHHQ3f3fIIQ')
+BIN2_BLOCK_ENTRY_DTYPE = np.dtype([('offset', '<u8'), ('stored_size', '<u4'), ('count', '<u4')])
+BIN2_NORMALS = 0x1
+BIN2_ZLIB = 0x2
+
+def quantise_positions(vertices, bounds_min, bounds_max):
+    extent = np.asarray(bounds_max, dtype=np.float64) - bounds_min
+    scale = np.where(extent > 0, 65535.0 / np.where(extent > 0, extent, 1.0), 0.0)
+    q = np.rint((np.asarray(vertices, dtype=np.float64) - bounds_min) * scale)
+    return np.clip(q, 0, 65535).astype('<u2')
+
+def dequantise_positions(q, bounds_min, bounds_max):
+    extent = np.asarray(bounds_max, dtype=np.float64) - bounds_min
+    return (bounds_min + q * (extent / 65535.0)).astype(np.float32)
+
+def octahedral_encode(normals):
+    """Encode unit normals[n, 3] as uint8[n, 2] octahedral coordinates."""
+    normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+    length = np.abs(normals).sum(axis=1, keepdims=True)
+    n = normals / np.where(length > 0, length, 1.0)
+    (x, y, z) = (n[:, 0], n[:, 1], n[:, 2])
+    # Fold the lower hemisphere over the diagonals.
+    sign_x = np.where(x >= 0, 1.0, -1.0)
+    sign_y = np.where(y >= 0, 1.0, -1.0)
+    lower = (z < 0)
+    (x, y) = (np.where(lower, (1.0 - np.abs(y)) * sign_x, x),
+        np.where(lower, (1.0 - np.abs(x)) * sign_y, y))
+    uv = np.stack((x, y), axis=1)
+    return np.clip(np.rint((uv * 0.5 + 0.5) * 255.0), 0, 255).astype(np.uint8)
+
+def octahedral_decode(encoded):
+    """Decode uint8[n, 2] octahedral coordinates to float32[n, 3] unit normals."""
+    uv = np.asarray(encoded, dtype=np.float64) / 255.0 * 2.0 - 1.0
+    (x, y) = (uv[:, 0], uv[:, 1])
+    z = 1.0 - np.abs(x) - np.abs(y)
+    t = np.maximum(-z, 0.0)
+    x = x - np.where(x >= 0, t, -t)
+    y = y - np.where(y >= 0, t, -t)
+    n = np.stack((x, y, z), axis=1)
+    n /= np.sqrt((n ** 2).sum(axis=1, keepdims=True))
+    return n.astype(np.float32)
+
+
+class PointcloudBin2Writer:
+    """Writes version 2 .bin files. Positions are quantised to bounds_min
+    and bounds_max, which must hold every point written."""
+
+    def __init__(self, filename, bounds_min, bounds_max, normals=True, compress=False,
+            block_size=65536, atomic=False):
+        self.filename = filename
+        self.atomic = atomic
+        self.bounds_min = np.asarray(bounds_min, dtype=np.float32)
+        self.bounds_max = np.asarray(bounds_max, dtype=np.float32)
+        self.flags = ((BIN2_NORMALS if normals else 0) | (BIN2_ZLIB if compress else 0))
+        self.block_size = block_size
+        self.file = None
+        self.count = 0
+        self.blocks = []
+        self._pending = []
+        self._pending_count = 0
+
+    def write(self, vertices, normals, colors):
+        # Write float arrays vertices[n, 3], normals[n, 3] (or None, if the
+        # file has no normals) and colors[n, 4]. Points are encoded in
+        # blocks of block_size, so any number can be written at a time.
+        assert (self.file is not None), "File is not open."
+        vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+        if self.flags & BIN2_NORMALS:
+            normals = np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+        else:
+            normals = np.zeros((len(vertices), 0), dtype=np.float32)
+        self._pending.append((vertices, normals, colors))
+        self._pending_count += len(vertices)
+        while self._pending_count >= self.block_size:
+            self._write_block(self.block_size)
+
+    def _take(self, count):
+        # Take the first count pending points.
+        taken = []
+        while count:
+            (vertices, normals, colors) = self._pending[0]
+            n = min(count, len(vertices))
+            taken.append((vertices[:n], normals[:n], colors[:n]))
+            if n == len(vertices):
+                self._pending.pop(0)
+            else:
+                self._pending[0] = (vertices[n:], normals[n:], colors[n:])
+            count -= n
+            self._pending_count -= n
+        return tuple(np.concatenate(arrays) for arrays in zip(*taken))
+
+    def _write_block(self, count):
+        (vertices, normals, colors) = self._take(count)
+        parts = [
+            quantise_positions(vertices, self.bounds_min, self.bounds_max).tobytes(),
+            colors_to_uint8(colors[:, :3]).tobytes(),
+            ]
+        if self.flags & BIN2_NORMALS:
+            parts.append(octahedral_encode(normals).tobytes())
+        blob = b''.join(parts)
+        if self.flags & BIN2_ZLIB:
+            blob = zlib.compress(blob)
+        self.blocks.append((self.file.tell(), len(blob), count))
+        self.file.write(blob)
+        self.count += count
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size(self):
+        # Size of the blocks written so far.
+        return sum(stored_size for (offset, stored_size, count) in self.blocks)
+
+    def _header(self, block_count=0, table_offset=0):
+        return BIN2_HEADER.pack(BIN2_MAGIC, BIN2_VERSION, self.flags, self.count,
+            *self.bounds_min.tolist(), *self.bounds_max.tolist(),
+            self.block_size, block_count, table_offset)
+
+    def __enter__(self):
+        (self._opened, self.file) = open_output(self.filename, self.atomic)
+        # The counts and the block table are filled in on __exit__().
+        self.file.write(self._header())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not exc_type and not exc_value:
+            if self._pending_count:
+                self._write_block(self._pending_count)
+            table_offset = self.file.tell()
+            table = np.array(self.blocks, dtype=BIN2_BLOCK_ENTRY_DTYPE)
+            self.file.write(table.tobytes())
+            self.file.seek(0)
+            self.file.write(self._header(len(self.blocks), table_offset))
+        self._opened.__exit__(exc_type, exc_value, traceback)
+
+
+## Binary PLY pointclouds
+#
+# For other tools: a binary little-endian .ply with one vertex element of
+# PLY_RECORD_DTYPE records, including the normals that .bin files drop.
+
+PLY_RECORD_DTYPE = np.dtype([
+    ('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+    ('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4'),
+    ('red', 'u1'), ('green', 'u1'), ('blue', 'u1'),
+    ])
+
+PLY_PROPERTY_TYPES = {'<f4': 'float', '|u1': 'uchar'}
+
+def pack_ply_records(vertices, normals, colors):
+    """Interleave float arrays vertices[n, 3], normals[n, 3] and colors[n, 4]
+    into an array of PLY_RECORD_DTYPE records."""
+    vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+    normals = np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+    count = min(len(vertices), len(normals), len(colors))
+    records = np.empty(count, dtype=PLY_RECORD_DTYPE)
+    for (i, name) in enumerate(('x', 'y', 'z')):
+        records[name] = vertices[:count, i]
+    for (i, name) in enumerate(('nx', 'ny', 'nz')):
+        records[name] = normals[:count, i]
+    rgb = colors_to_uint8(colors[:count, :3])
+    for (i, name) in enumerate(('red', 'green', 'blue')):
+        records[name] = rgb[:, i]
+    return records
+
+def ply_header(count):
+    lines = ['ply', 'format binary_little_endian 1.0', f'element vertex {count}']
+    for name in PLY_RECORD_DTYPE.names:
+        type_name = PLY_PROPERTY_TYPES[PLY_RECORD_DTYPE.fields[name][0].str]
+        lines.append(f'property {type_name} {name}')
+    lines.append('end_header')
+    return ('\n'.join(lines) + '\n').encode('ascii')
+
+
+class PointcloudPlyWriter:
+    """Writes binary .ply files of exactly count points, which the header
+    has to give up front."""
+
+    def __init__(self, filename, count, atomic=False):
+        self.filename = filename
+        self.expected_count = count
+        self.atomic = atomic
+        self.file = None
+        self.count = 0
+        self.size = 0
+
+    def write_records(self, records):
+        # Write an array of PLY_RECORD_DTYPE records with a single write.
+        assert (self.file is not None), "File is not open."
+        assert (records.dtype == PLY_RECORD_DTYPE), "Wrong record type."
+        if self.count + len(records) > self.expected_count:
+            raise ValueError("More points than the .ply header gives.")
+        records = np.ascontiguousarray(records)
+        self.file.write(records)
+        self.size += records.nbytes
+        self.count += len(records)
+
+    def write(self, vertices, normals, colors):
+        self.write_records(pack_ply_records(vertices, normals, colors))
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        (self._opened, self.file) = open_output(self.filename, self.atomic)
+        self.file.write(ply_header(self.expected_count))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not exc_type and (self.count != self.expected_count):
+            # Don't leave a file whose header doesn't match its data.
+            exc_value = ValueError(f"Wrote {self.count} points to a .ply of {self.expected_count}.")
+            self._opened.__exit__(ValueError, exc_value, None)
+            raise exc_value
+        self._opened.__exit__(exc_type, exc_value, traceback)
+
+
+## Binary pointcloud reading
+
+class PointcloudBinReader:
+    """Reads version 1 or 2 .bin files, memory-mapped.
+
+    read() decodes every point, and blocks() one block at a time, as
+    (vertices, normals, colors) float32 arrays shaped [n, 3], [n, 3] and
+    [n, 4]. Normals are None if the file has none (as version 1 never
+    does). For version 1 files, records is the memory-mapped array of
+    BIN_RECORD_DTYPE records."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        if bytes(self.data[:4]) == BIN2_MAGIC:
+            self._open_v2()
+        else:
+            self._open_v1()
+
+    def _open_v1(self):
+        if len(self.data) < 4:
+            raise ValueError("Not a pointcloud .bin file.")
+        size = struct.unpack('=L', bytes(self.data[:4]))[0]
+        if (size % BIN_RECORD_DTYPE.itemsize) or (4 + size > len(self.data)):
+            raise ValueError("Not a pointcloud .bin file, or truncated.")
+        self.version = 1
+        self.flags = 0
+        self.records = self.data[4:4 + size].view(BIN_RECORD_DTYPE)
+        self.count = len(self.records)
+        if self.count:
+            xyz = self._record_positions(self.records)
+            self.bounds = (xyz.min(axis=0), xyz.max(axis=0))
+        else:
+            self.bounds = (np.zeros(3, dtype=np.float32), np.zeros(3, dtype=np.float32))
+        self.block_size = (self.count or 1)
+        self.block_table = np.array([(4, size, self.count)], dtype=BIN2_BLOCK_ENTRY_DTYPE)
+
+    def _open_v2(self):
+        if len(self.data) < BIN2_HEADER.size:
+            raise ValueError("Truncated pointcloud .bin file.")
+        (magic, version, flags, count, x0, y0, z0, x1, y1, z1, block_size, block_count,
+            table_offset) = BIN2_HEADER.unpack(bytes(self.data[:BIN2_HEADER.size]))
+        if version != BIN2_VERSION:
+            raise ValueError(f"Unsupported pointcloud .bin version {version}.")
+        self.version = version
+        self.flags = flags
+        self.count = count
+        self.bounds = (np.array((x0, y0, z0), dtype=np.float32),
+            np.array((x1, y1, z1), dtype=np.float32))
+        self.block_size = block_size
+        table_end = table_offset + block_count * BIN2_BLOCK_ENTRY_DTYPE.itemsize
+        if table_end > len(self.data):
+            raise ValueError("Truncated pointcloud .bin file.")
+        self.block_table = self.data[table_offset:table_end].view(BIN2_BLOCK_ENTRY_DTYPE)
+        self.records = None
+
+    @property
+    def has_normals(self):
+        return bool(self.flags & BIN2_NORMALS)
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def _record_positions(records):
+        return np.stack((records['x'], records['y'], records['z']), axis=1)
+
+    def _decode_block(self, offset, stored_size, count):
+        blob = self.data[offset:offset + stored_size]
+        if self.version == 1:
+            records = blob.view(BIN_RECORD_DTYPE)
+            vertices = self._record_positions(records)
+            rgb = np.stack((records['r'], records['g'], records['b']), axis=1)
+            normals = None
+        else:
+            if self.flags & BIN2_ZLIB:
+                blob = np.frombuffer(zlib.decompress(blob), dtype=np.uint8)
+            q = blob[:6 * count].view('<u2').reshape(count, 3)
+            vertices = dequantise_positions(q, *self.bounds)
+            rgb = blob[6 * count:9 * count].reshape(count, 3)
+            normals = None
+            if self.flags & BIN2_NORMALS:
+                normals = octahedral_decode(blob[9 * count:11 * count].reshape(count, 2))
+        colors = np.ones((count, 4), dtype=np.float32)
+        colors[:, :3] = rgb / np.float32(255.0)
+        return (vertices, normals, colors)
+
+    def blocks(self):
+        for (offset, stored_size, count) in self.block_table.tolist():
+            yield self._decode_block(offset, stored_size, count)
+
+    def read(self):
+        decoded = list(self.blocks())
+        if not decoded:
+            normals = (np.empty((0, 3), dtype=np.float32) if self.has_normals else None)
+            return (np.empty((0, 3), dtype=np.float32), normals, np.empty((0, 4), dtype=np.float32))
+        vertices = np.concatenate([d[0] for d in decoded])
+        normals = (np.concatenate([d[1] for d in decoded]) if self.has_normals else None)
+        colors = np.concatenate([d[2] for d in decoded])
+        return (vertices, normals, colors)
+
+    def close(self):
+        # Drop the mapping; arrays from read() don't refer to it.
+        self.records = None
+        self.block_table = None
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+## Tiled pointclouds
+#
+# A tiled .bin is an ordinary .bin whose records are grouped by the cell of
+# a uniform grid that they fall in, so that each tile is one contiguous
+# block of records. A JSON manifest next to it gives the byte offset, record
+# count and bounds of each tile, so that a game can stream and cull them.
+
+def tiled_manifest_path(filename):
+    return os.path.splitext(filename)[0] + '.tiles.json'
+
+def bin_tiles(vertices, tile_size):
+    """Bin vertices[n, 3] into a grid of cubes tile_size on a side, starting
+    at the minimum of their bounds. Return (order, origin, grid, tiles):
+    order is a permutation of the points grouping them by tile; grid is the
+    number of tiles along each axis; and tiles is a list of (index, start,
+    count) for each non-empty tile, in order, where index is its (i, j, k)
+    grid position and start is where its points begin in order."""
+    vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+    if tile_size <= 0:
+        raise ValueError("tile_size must be positive.")
+    if not len(vertices):
+        return (np.empty(0, dtype=np.int64), np.zeros(3), np.zeros(3, dtype=np.int64), [])
+    origin = vertices.min(axis=0).astype(np.float64)
+    cells = np.floor((vertices - origin) / tile_size).astype(np.int64)
+    grid = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * grid[1] + cells[:, 1]) * grid[2] + cells[:, 2]
+    # Stable, so points stay in their stored order within each tile.
+    order = np.argsort(keys, kind='stable')
+    (unique_keys, starts, counts) = np.unique(keys[order], return_index=True, return_counts=True)
+    index = np.stack(np.unravel_index(unique_keys, grid), axis=1)
+    tiles = list(zip(index.tolist(), starts.tolist(), counts.tolist()))
+    return (order, origin, grid, tiles)
+
+def write_tiled_bin(filename, vertices, colors, tile_size, batch_size=1 << 20):
+    """Write vertices[n, 3] and colors[n, 4] as a tiled .bin, and its
+    manifest. Return the manifest."""
+    vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+    count = min(len(vertices), len(colors))
+    (vertices, colors) = (vertices[:count], colors[:count])
+    (order, origin, grid, tiles) = bin_tiles(vertices, tile_size)
+
+    with PointcloudBinWriter(filename, atomic=True) as f:
+        for start in range(0, count, batch_size):
+            batch = order[start:start + batch_size]
+            f.write_records(pack_records(vertices[batch], colors[batch]))
+
+    # Tight bounds of the points in each tile.
+    if tiles:
+        starts = np.array([start for (index, start, n) in tiles])
+        grouped = vertices[order]
+        lo = np.minimum.reduceat(grouped, starts, axis=0).tolist()
+        hi = np.maximum.reduceat(grouped, starts, axis=0).tolist()
+    header_size = len(bin_size(0))
+    manifest = {
+        'version': 1,
+        'file': os.path.basename(filename),
+        'header_size': header_size,
+        'record_size': BIN_RECORD_DTYPE.itemsize,
+        'count': count,
+        'tile_size': tile_size,
+        'origin': origin.tolist(),
+        'grid': grid.tolist(),
+        'tiles': [
+            {
+                'index': index,
+                'offset': header_size + start * BIN_RECORD_DTYPE.itemsize,
+                'count': n,
+                'min': lo[i],
+                'max': hi[i],
+            }
+            for (i, (index, start, n)) in enumerate(tiles)],
+        }
+    with file_atomic(tiled_manifest_path(filename), 'w', permissions=SHARED_FILE_PERMISSIONS) as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+## Key files
+#
+# A key file sits next to an output file, and records what the output was
+# made from, so that tools can skip making it again when nothing changed.
+
+def key_file_path(filename):
+    return filename + '.key'
+
+def read_key_file(filename):
+    # Return the key recorded for filename, or None if there isn't one.
+    try:
+        with open(key_file_path(filename), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def write_key_file(filename, key):
+    with file_atomic(key_file_path(filename), 'w', permissions=SHARED_FILE_PERMISSIONS) as f:
+        f.write(key + '\n')
+
+def is_up_to_date(filename, key):
+    # True if filename exists and was made from key.
+    return os.path.exists(filename) and (read_key_file(filename) == key)
@@ -1,22 +1,40 @@
 import bpy
-import bmesh
+import atexit
 import base64
-import math
 import mathutils
+import multiprocessing
+import numpy as np
+import os
 import random
-import struct
+import tempfile
+import threading
+import time
 import zlib
 
 from array import array
-from itertools import islice
-from bpy.props import IntProperty, PointerProperty, StringProperty
+from collections import OrderedDict, deque
+from bpy.app.handlers import persistent
+from bpy.props import (BoolProperty, EnumProperty, FloatProperty, IntProperty, PointerProperty,
+    StringProperty)
 from bpy.types import Object, Operator, Panel, PropertyGroup
 from mathutils import Vector
 from mathutils.bvhtree import BVHTree
 
+from .formats import (PointcloudBin2Writer, PointcloudBinWriter, PointcloudPlyWriter, is_up_to_date,
+    pack_ply_records, pack_records, write_key_file, write_tiled_bin)
+from .profiling import Profile, append_to_log
+from .sampling import (CHUNK_SIZE, SAMPLERS, BackgroundSampler, PointAccumulator, SampleCache,
+    SamplingError, SphereSampler, StepScheduler, progressive_order, SurfaceSampler, TriangleMesh,
+    VolumeSampler, create_sampler, empty_points, mesh_digest, sample_cache_key, sample_range,
+    sample_series, step_ranges, step_stop)
+from .storage import RawDataStore, digest_of
+
 #---------------------------------------------------------------------------#
 # Operators
 
+def addon_preferences(context):
+    return context.preferences.addons[__package__].preferences
+
 class AgnosiaCreatePointcloudOperator(Operator):
     bl_idname = "object.create_pointcloud"
     bl_label = "Create pointcloud"
@@ -58,6 +76,7 @@ class AgnosiaUpdatePointcloudOperator(Operator):
 
     _timer = None
     _generator = None
+    _profile = None
     _finished = False
     _cancelled = False
     _object = None
@@ -74,50 +93,168 @@ class AgnosiaUpdatePointcloudOperator(Operator):
             prior_op.abort()
         self.__class__._running_on[self._object] = self
 
-        self._generator = update_pointcloud_iter(self._object)
+        prefs = addon_preferences(context)
+        sample_cache.max_bytes = (prefs.sample_cache_size * 2**20)
+        background = (prefs.background_sampling
+            and bool(self._object.pointclouds)
+            and (self._object.pointclouds[0].point_count >= prefs.background_min_points))
+        self._profile = update_profile(self._object, background=background)
+        self._generator = update_pointcloud_iter(self._object,
+            background=background, workers=prefs.worker_count,
+            miss_budget=prefs.sphere_miss_budget, profile=self._profile,
+            step_budget=(prefs.frame_budget / 1000.0))
         self._cancelled = False
         self._finished = False
 
         wm = context.window_manager
-        self._timer = wm.event_timer_add(0.1, window=context.window)
+        self._timer = wm.event_timer_add(MODAL_TICK_INTERVAL, window=context.window)
         wm.modal_handler_add(self)
+        wm.progress_begin(0.0, 1.0)
         return {'RUNNING_MODAL'}
 
     def modal(self, context, event):
         if event.type in {'RIGHTMOUSE', 'ESC'}:
             self._cancelled = True
 
+        if not (self._cancelled or self._finished) and event.type == 'TIMER':
+            try:
+                progress = next(self._generator)
+                context.window_manager.progress_update(progress)
+            except StopIteration:
+                self._finished = True
+                record_profile(self._object, self._profile,
+                    addon_preferences(context).profile_log)
+            except SamplingError as e:
+                self.report({'ERROR'}, f"Update pointcloud: {e}")
+                self._cancelled = True
+            except Exception as e:
+                # Anything else (a broken worker pool, a full disk) must
+                # still clean up below, or the object stays busy.
+                self.report({'ERROR'}, f"Update pointcloud: {type(e).__name__}: {e}")
+                self._cancelled = True
+
         if self._cancelled or self._finished:
-            # Remove ourselves
-            if self.__class__._running_on.get(self._object) == self:
-                del self.__class__._running_on[self._object]
-            # Remove the timer
-            wm = context.window_manager
-            wm.event_timer_remove(self._timer)
-            self._timer = None
+            self.stop(context)
 
         if self._cancelled:
             return {'CANCELLED'}
         elif self._finished:
             return {'FINISHED'}
-        elif event.type == 'TIMER':
-            try:
-                next(self._generator)
-            except StopIteration:
-                self._finished = True
-
         return {'PASS_THROUGH'}
 
+    def stop(self, context):
+        # Remove ourselves
+        if self.__class__._running_on.get(self._object) == self:
+            del self.__class__._running_on[self._object]
+        try:
+            # Stop any outstanding work
+            self._generator.close()
+        finally:
+            # Remove the timer
+            wm = context.window_manager
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+            wm.progress_end()
+
     def abort(self):
         self._cancelled = True
+        self._generator.close()
+
 
+FILE_FORMAT_ITEMS = (
+    ('V1', "Version 1", "Float positions and 8-bit colors, 16 bytes per point"),
+    ('V2', "Version 2", "Quantised positions, 8-bit colors and octahedral normals, 11 bytes per point"),
+    ('PLY', "Binary PLY", "Float positions and normals, and 8-bit colors, for other tools. Not tiled"),
+    )
 
-class AgnosiaPointcloudExportOperator(Operator):
+FILE_FORMAT_EXTENSIONS = {'V1': '.bin', 'V2': '.bin', 'PLY': '.ply'}
+
+class BackgroundExport:
+    # Runs ExportJobs on an ExportThread, showing progress from a modal
+    # timer; mixed into the export operators. self._exports holds
+    # (object, job) pairs.
+
+    _timer = None
+    _thread = None
+    _exports = ()
+
+    def run_exports(self, context, background):
+        jobs = [job for (o, job) in self._exports]
+        if not background:
+            try:
+                for job in jobs:
+                    for progress in job.run():
+                        pass
+            except (OSError, ValueError, SamplingError) as e:
+                self.report({'ERROR'}, f"{self.bl_label}: {e}")
+                return {'CANCELLED'}
+            return self.finish_exports(context)
+
+        # Everything the jobs need from Blender has been read by now, so
+        # the rest can run on a thread while Blender stays responsive.
+        self._thread = ExportThread(jobs)
+        self._thread.start()
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(EXPORT_TICK_INTERVAL, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0.0, 1.0)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        thread = self._thread
+        if event.type in {'RIGHTMOUSE', 'ESC'}:
+            thread.cancel()
+        elif event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        if thread.is_alive():
+            context.window_manager.progress_update(thread.progress)
+            return {'PASS_THROUGH'}
+
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        self._timer = None
+        wm.progress_end()
+        if thread.cancelled:
+            self.report({'WARNING'}, f"{self.bl_label}: cancelled.")
+            return {'CANCELLED'}
+        if thread.error is not None:
+            self.report({'ERROR'}, f"{self.bl_label}: {thread.error}")
+            return {'CANCELLED'}
+        return self.finish_exports(context)
+
+    def finish_exports(self, context):
+        log_filepath = addon_preferences(context).profile_log
+        for (o, job) in self._exports:
+            record_profile(o, job.profile, log_filepath)
+        return {'FINISHED'}
+
+
+class AgnosiaPointcloudExportOperator(BackgroundExport, Operator):
     bl_idname = "object.export_pointcloud"
     bl_label = "Export pointcloud"
     bl_options = {'REGISTER'}
 
     filepath : bpy.props.StringProperty(subtype="FILE_PATH")
+    stream : BoolProperty(name="Resample while writing", default=False,
+        description=("Sample the target again and write the points chunk by chunk, "
+            "instead of exporting the stored points. Memory use is bounded by the chunk size"))
+    point_count : IntProperty(name="Point count", default=0, min=0,
+        description="Number of points to sample when resampling while writing (0: the pointcloud's point count)")
+    tiled : BoolProperty(name="Tiled", default=False,
+        description=("Group the points by the tiles of a uniform grid, and write a .tiles.json manifest "
+            "of where each tile's points are, so that they can be streamed in and culled. Exports the stored points"))
+    tile_size : FloatProperty(name="Tile size", default=16.0, min=0.001, subtype='DISTANCE',
+        description="Size of each tile of the grid")
+    file_format : EnumProperty(name="Format", default='V1', items=FILE_FORMAT_ITEMS)
+    compress : BoolProperty(name="Compress", default=False,
+        description="Compress each block of a version 2 file with zlib")
+    # Scripts run with Blender in the background need the file written
+    # before the operator returns.
+    background : BoolProperty(name="In the background", default=(not bpy.app.background),
+        description=("Pack and write the file on a background thread, showing progress, "
+            "so that Blender stays responsive. Press Esc to cancel"))
+    force : BoolProperty(name="Always write", default=False,
+        description="Write the file even if it was already exported from the same points and settings")
 
     @classmethod
     def poll(cls, context):
@@ -135,29 +272,139 @@ class AgnosiaPointcloudExportOperator(Operator):
     def execute(self, context):
         o = context.object
         pc = o.pointclouds[0]
+        if self.tiled and (self.file_format != 'V1'):
+            self.report({'WARNING'}, "Export pointcloud: tiled exports can only be version 1 .bin files.")
+            return {'CANCELLED'}
+        filepath = bpy.path.abspath(self.filepath)
+        profile = Profile('export', object=o.name, stream=self.stream, tiled=self.tiled,
+            file_format=self.file_format, background=self.background)
+        profile.add_rate("points/s", 'points')
+        settings = export_settings(self.file_format, self.compress,
+            tile_size=(self.tile_size if self.tiled else None))
+
+        if self.stream and not self.tiled:
+            if not can_sample(pc.target):
+                self.report({'WARNING'}, "Export pointcloud: nothing to sample.")
+                return {'CANCELLED'}
+            count = (self.point_count or pc.point_count)
+            with profile.span('read_mesh'):
+                mesh = mesh_triangles(pc.target)
+                sampler = create_local_sampler(pc.sampler, mesh,
+                    miss_budget=addon_preferences(context).sphere_miss_budget)
+            settings.update(sampler=pc.sampler, count=count, seed=pc.seed)
+            key = export_key(f"mesh:{mesh_digest(mesh)}", settings)
+            job = ExportJob(filepath, self.file_format, compress=self.compress,
+                profile=profile, key=key)
+            job.sampled(sampler, count, pc.seed, mesh.positions)
+        else:
+            points = raw_points(pc)
+            key = export_key(stored_points_source(pc, points), settings)
+            job = ExportJob(filepath, self.file_format, compress=self.compress,
+                profile=profile, key=key)
+            if self.tiled:
+                job.tiled(points, self.tile_size)
+            else:
+                job.stored(points)
 
-        def to_uint8(f):
-            return min(max(0, int(f * 255.0)), 255)
-
-        with PointcloudBinWriter(self.filepath) as f:
-            vertices = pc.raw_vertices
-            normals = pc.raw_normals
-            colors = pc.raw_colors
-            def records():
-                v_it = iter(vertices)
-                n_it = iter(normals)
-                c_it = iter(colors)
-                while True:
-                    v_xyz = list(islice(v_it, 3))
-                    n_xyz = list(islice(n_it, 3))
-                    c_rgb = [to_uint8(f) for f in list(islice(c_it, 4))][:3]
-                    if v_xyz and c_rgb:
-                        yield v_xyz + c_rgb
-                    else:
-                        break
-            for r in records():
-                f.write(*r)
+        if not self.force and is_up_to_date(filepath, key):
+            self.report({'INFO'}, "Export pointcloud: already up to date.")
+            return {'FINISHED'}
+        self._exports = [(o, job)]
+        return self.run_exports(context, self.background)
+
+
+def unique_file_stems(names):
+    """Return a dict mapping each object name to a filename stem: its
+    bpy.path.clean_name(), with a suffix (_2, _3, ...) if an earlier name
+    cleans to the same stem, as "A.001" and "A_001" do. Names are taken in
+    sorted order, so each keeps its stem from one export to the next. Stems
+    are compared ignoring case, for filesystems that do."""
+    used = set()
+    stems = {}
+    for name in sorted(names):
+        stem = clean = bpy.path.clean_name(name)
+        suffix = 2
+        while stem.lower() in used:
+            stem = f"{clean}_{suffix}"
+            suffix += 1
+        used.add(stem.lower())
+        stems[name] = stem
+    return stems
+
+
+class AgnosiaExportAllPointcloudsOperator(BackgroundExport, Operator):
+    bl_idname = "object.export_all_pointclouds"
+    bl_label = "Export all pointclouds"
+    bl_description = ("Export the stored points of every pointcloud in the scene to a folder, "
+        "as <object name>.bin (or .ply), skipping files that are already up to date")
+    bl_options = {'REGISTER'}
+
+    directory : bpy.props.StringProperty(subtype="DIR_PATH")
+    file_format : EnumProperty(name="Format", default='V1', items=FILE_FORMAT_ITEMS)
+    compress : BoolProperty(name="Compress", default=False,
+        description="Compress each block of a version 2 file with zlib")
+    force : BoolProperty(name="Always write", default=False,
+        description="Write every file, even those already exported from the same points and settings")
+    # Scripts run with Blender in the background need the files written
+    # before the operator returns.
+    background : BoolProperty(name="In the background", default=(not bpy.app.background),
+        description=("Pack and write the files on a background thread, showing progress, "
+            "so that Blender stays responsive. Press Esc to cancel"))
 
+    @classmethod
+    def poll(cls, context):
+        return (context.mode == 'OBJECT')
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        directory = bpy.path.abspath(self.directory)
+        settings = export_settings(self.file_format, self.compress)
+        exports = []
+        up_to_date = 0
+        objects = [o for o in context.scene.objects if o.pointclouds]
+        stems = unique_file_stems([o.name for o in objects])
+        for o in objects:
+            pc = o.pointclouds[0]
+            points = raw_points(pc)
+            if not len(points[0]):
+                print(f"WARNING: pointcloud {o.name} has no points; update it to export it.")
+                continue
+            if stems[o.name] != bpy.path.clean_name(o.name):
+                print(f"WARNING: pointcloud {o.name} is exported as {stems[o.name]}, "
+                    f"as another pointcloud's name gives the same filename.")
+            filepath = os.path.join(directory,
+                stems[o.name] + FILE_FORMAT_EXTENSIONS[self.file_format])
+            key = export_key(stored_points_source(pc, points), settings)
+            if not self.force and is_up_to_date(filepath, key):
+                up_to_date += 1
+                continue
+            profile = Profile('export', object=o.name, file_format=self.file_format)
+            profile.add_rate("points/s", 'points')
+            job = ExportJob(filepath, self.file_format, compress=self.compress,
+                profile=profile, key=key)
+            job.stored(points)
+            exports.append((o, job))
+
+        self.report({'INFO'}, f"Export all pointclouds: {len(exports)} to write, {up_to_date} up to date.")
+        if not exports:
+            return {'FINISHED'}
+        os.makedirs(directory, exist_ok=True)
+        self._exports = exports
+        return self.run_exports(context, self.background)
+
+
+class AgnosiaPurgePointcloudMeshesOperator(Operator):
+    bl_idname = "object.purge_pointcloud_meshes"
+    bl_label = "Purge unused pointcloud meshes"
+    bl_description = "Remove meshes left behind by pointcloud updates that nothing uses any more, freeing their memory"
+    bl_options = {'REGISTER'}
+
+    def execute(self, context):
+        (mesh_count, vertex_count) = purge_pointcloud_meshes()
+        self.report({'INFO'}, f"Purged {mesh_count} unused pointcloud meshes ({vertex_count:,} vertices).")
         return {'FINISHED'}
 
 
@@ -192,7 +439,21 @@ class AGNOSIA_PT_pointcloud(Panel):
         box.prop(pc, 'target')
         box.prop(pc, 'point_count')
         box.prop(pc, 'seed')
+        box.prop(pc, 'sampler')
+        box.prop(pc, 'display_mode')
+        box.prop(pc, 'viewport_points')
         layout.operator('object.export_pointcloud', text="Export .bin")
+        layout.operator('object.export_all_pointclouds', text="Export all")
+        layout.operator('object.purge_pointcloud_meshes', text="Purge unused meshes")
+        if addon_preferences(context).show_profile:
+            for name in ('update', 'export'):
+                profile = last_profiles.get((o.name, name))
+                if profile is None:
+                    continue
+                box = layout.box()
+                col = box.column(align=True)
+                for line in profile.summary():
+                    col.label(text=line)
 
 
 #---------------------------------------------------------------------------#
@@ -201,24 +462,39 @@ class AGNOSIA_PT_pointcloud(Panel):
 def _pointcloud_property_update(self, context):
     bpy.ops.object.update_pointcloud()
 
+def _pointcloud_display_update(self, context):
+    # Only the display changes; the stored points stay as they are.
+    update_pointcloud_display(self.id_data)
+
 class PointcloudProperty(PropertyGroup):
     target : PointerProperty(name="Sample", type=Object, update=_pointcloud_property_update)
     point_count : IntProperty(name="Point count", default=1024, min=128, step=64, update=_pointcloud_property_update)
     seed : IntProperty(name="Seed", default=0, update=_pointcloud_property_update)
+    sampler : EnumProperty(name="Sampler", default='SURFACE', update=_pointcloud_property_update,
+        items=(
+            ('SURFACE', "Surface", "Sample points on the surface of the target"),
+            ('VOLUME', "Volume", "Sample points inside the target, which must be closed"),
+            ('SPHERE', "Sphere", "Sample points on the outside of the target, by casting rays at its origin from all around"),
+            ))
+    display_mode : EnumProperty(name="Display", default='QUADS', update=_pointcloud_display_update,
+        items=(
+            ('QUADS', "Quads", "Show each point as a quad of its own, with four vertices"),
+            ('INSTANCED', "Instanced", "Show each point as one vertex that instances a shared quad, using a quarter of the memory. "
+                "Points are only colored in Blender 3.0 and later"),
+            ))
+    viewport_points : IntProperty(name="Viewport points", default=0, min=0, update=_pointcloud_display_update,
+        description="Most points to show in the viewport, spread evenly over the pointcloud; export still uses all of them "
+            "(0: the viewport point budget from the addon preferences)")
+    # Content hashes of the raw data in the RawDataStore.
+    raw_vertices_digest : StringProperty(name="_RawVerticesDigest", default="")
+    raw_normals_digest : StringProperty(name="_RawNormalsDigest", default="")
+    raw_colors_digest : StringProperty(name="_RawColorsDigest", default="")
+    # The sample_series() that the raw data is a prefix of, if any.
+    raw_series : StringProperty(name="_RawSeries", default="")
+    # Raw data from older files, zlib-compressed and base64-encoded.
     raw_vertices_string : StringProperty(name="_RawVerticesString", default="")
     raw_normals_string : StringProperty(name="_RawNormalsString", default="")
     raw_colors_string : StringProperty(name="_RawColorsString", default="")
-    _raw_cache = None
-
-    @staticmethod
-    def _pack_array(a):
-        if a:
-            b = a.tobytes()
-            c = zlib.compress(b)
-            d = base64.encodebytes(c)
-            return d.decode('ascii')
-        else:
-            return ""
 
     @staticmethod
     def _unpack_array(s, typecode):
@@ -232,72 +508,156 @@ class PointcloudProperty(PropertyGroup):
         else:
             return array(typecode)
 
-    @property
-    def raw_cache(self):
-        cache = self.__dict__.get('_raw_cache')
-        if cache is None:
-            cache = {}
-            self.__dict__['_raw_cache'] = cache
-        return cache
-
-    @property
-    def raw_vertices(self):
-        if self.raw_vertices_string:
-            value = self.raw_cache.get('vertices')
+    @staticmethod
+    def _as_raw_array(a, name):
+        if isinstance(a, array):
+            if a.typecode != 'f':
+                raise ValueError(f"{name} must be type array('f') or a float32 ndarray")
+            return np.frombuffer(a, dtype=np.float32)
+        if (not isinstance(a, np.ndarray)) or (a.dtype != np.float32):
+            raise ValueError(f"{name} must be type array('f') or a float32 ndarray")
+        return a.ravel()
+
+    def _get_raw(self, digest, string):
+        # Returns a read-only float32 array: memory-mapped from the store,
+        # or unpacked from an older file.
+        if digest:
+            value = raw_store().get(digest)
             if value is None:
-                value = self._unpack_array(self.raw_vertices_string, 'f')
-                self.raw_cache['vertices'] = value
+                print(f"WARNING: pointcloud data {digest} is missing; update the pointcloud to regenerate it.")
+                return np.empty(0, dtype=np.float32)
             return value
+        elif string:
+            return unpack_raw_string(string)
         else:
-            return array('f')
+            return np.empty(0, dtype=np.float32)
+
+    def migrate_raw_strings(self):
+        # Move raw data from an older file into the store, so that it is
+        # only unpacked once. Returns True if there was any.
+        store = raw_store()
+        migrated = False
+        for name in ('vertices', 'normals', 'colors'):
+            string = getattr(self, f"raw_{name}_string")
+            if string and not getattr(self, f"raw_{name}_digest"):
+                setattr(self, f"raw_{name}_digest", store.put(unpack_raw_string(string)))
+                setattr(self, f"raw_{name}_string", "")
+                migrated = True
+        return migrated
+
+    @property
+    def raw_vertices(self):
+        return self._get_raw(self.raw_vertices_digest, self.raw_vertices_string)
 
     @property
     def raw_normals(self):
-        if self.raw_normals_string:
-            value = self.raw_cache.get('normals')
-            if value is None:
-                value = self._unpack_array(self.raw_normals_string, 'f')
-                self.raw_cache['normals'] = value
-            return value
-        else:
-            return array('f')
+        return self._get_raw(self.raw_normals_digest, self.raw_normals_string)
 
     @property
     def raw_colors(self):
-        if self.raw_colors_string:
-            value = self.raw_cache.get('colors')
-            if value is None:
-                value = self._unpack_array(self.raw_colors_string, 'f')
-                self.raw_cache['colors'] = value
-            return value
-        else:
-            return array('f')
+        return self._get_raw(self.raw_colors_digest, self.raw_colors_string)
 
-    def set_raw_data(self, vertices, normals=None, colors=None):
-        if (not isinstance(vertices, array)) or (vertices.typecode != 'f'):
-            raise ValueError("vertices must be type array('f')")
+    def set_raw_data(self, vertices, normals=None, colors=None, series=""):
+        vertices = self._as_raw_array(vertices, "vertices")
         if len(vertices) % 3 != 0:
             raise ValueError("vertices length must be multiple of 3")
         vertex_count = len(vertices) // 3
         if (normals is not None):
-            if (not isinstance(normals, array)) or (normals.typecode != 'f'):
-                raise ValueError("normals must be type array('f')")
+            normals = self._as_raw_array(normals, "normals")
             if len(normals) != (3 * vertex_count):
                 raise ValueError("len(normals) must be 3 * vertex_count")
         if (colors is not None):
-            if (not isinstance(colors, array)) or (colors.typecode != 'f'):
-                raise ValueError("colors must be type array('f')")
+            colors = self._as_raw_array(colors, "colors")
             if len(colors) != 4 * vertex_count:
                 raise ValueError("len(colors) must be 4 * vertex_count")
 
-        self.raw_vertices_string = self._pack_array(vertices)
-        self.raw_normals_string = self._pack_array(normals)
-        self.raw_colors_string = self._pack_array(colors)
+        store = raw_store()
+        self.raw_vertices_digest = store.put(vertices)
+        self.raw_normals_digest = (store.put(normals) if normals is not None else "")
+        self.raw_colors_digest = (store.put(colors) if colors is not None else "")
+        self.raw_series = series
+        self.raw_vertices_string = ""
+        self.raw_normals_string = ""
+        self.raw_colors_string = ""
 
-        # Cached
-        self.raw_cache['vertices'] = vertices
-        self.raw_cache['normals'] = normals
-        self.raw_cache['colors'] = colors
+
+#---------------------------------------------------------------------------#
+# Raw data storage
+
+# Raw data strings from older files, unpacked, for those that can't be
+# migrated into the store (such as linked ones); keyed by the string.
+_unpacked_raw_strings = OrderedDict()
+UNPACKED_RAW_STRINGS_SIZE = 8
+
+def unpack_raw_string(string):
+    a = _unpacked_raw_strings.get(string)
+    if a is None:
+        a = np.frombuffer(PointcloudProperty._unpack_array(string, 'f'), dtype=np.float32)
+        a.flags.writeable = False
+        _unpacked_raw_strings[string] = a
+        while len(_unpacked_raw_strings) > UNPACKED_RAW_STRINGS_SIZE:
+            _unpacked_raw_strings.popitem(last=False)
+    else:
+        _unpacked_raw_strings.move_to_end(string)
+    return a
+
+# Where raw data goes before the .blend has been saved, and after it's
+# no longer used by the saved file (so that undo can still find it). It
+# belongs to this Blender session alone: loading a file prunes it to what
+# that file uses, and it is deleted on exit.
+_raw_store = RawDataStore(tempfile.mkdtemp(prefix='agnosia_pointclouds_'))
+atexit.register(_raw_store.remove_session_directory)
+
+def sidecar_directory(blend_filepath):
+    # The raw data for foo.blend lives in foo_pointclouds/ next to it.
+    if not blend_filepath:
+        return None
+    return os.path.splitext(blend_filepath)[0] + '_pointclouds'
+
+def raw_store():
+    _raw_store.directory = sidecar_directory(bpy.data.filepath)
+    return _raw_store
+
+def referenced_raw_digests():
+    digests = set()
+    for o in bpy.data.objects:
+        for pc in o.pointclouds:
+            digests.add(pc.raw_vertices_digest)
+            digests.add(pc.raw_normals_digest)
+            digests.add(pc.raw_colors_digest)
+    digests.discard("")
+    return digests
+
+@persistent
+def raw_data_load_post(*args):
+    # Move raw data strings from older files into the store. Then, as undo
+    # can't go back past loading a file, the session's raw data is only
+    # needed for what the loaded file uses.
+    _unpacked_raw_strings.clear()
+    for o in bpy.data.objects:
+        if o.library is None:
+            for pc in o.pointclouds:
+                pc.migrate_raw_strings()
+    raw_store().prune(referenced_raw_digests())
+
+@persistent
+def raw_data_save_pre(*args):
+    # Find all the raw data while the sidecar directory of the file as it
+    # was loaded is still current, in case this is a Save As.
+    store = raw_store()
+    for digest in referenced_raw_digests():
+        store.locate(digest)
+
+@persistent
+def raw_data_save_post(*args):
+    # Make sure the sidecar has everything the saved file refers to,
+    # and nothing else.
+    store = raw_store()
+    digests = referenced_raw_digests()
+    missing = store.gather(digests)
+    if missing:
+        print(f"WARNING: {len(missing)} pointcloud data files are missing; update the pointclouds to regenerate them.")
+    store.evict(digests)
 
 
 #---------------------------------------------------------------------------#
@@ -366,7 +726,7 @@ def layout_nodes(node_tree, root_node):
             y -= (ceil(total_height(n) + spacing[1]))
         column_location[0] -= (column_width + spacing[0])
 
-def define_pointcloud_material(material):
+def define_pointcloud_material(material, attribute_type=None):
     material.use_nodes = True
 
     tree = material.node_tree
@@ -393,6 +753,11 @@ def define_pointcloud_material(material):
     colors.label = "PointNormal Attribute"
     normals.attribute_name = 'PointNormal'
 
+    # Where to read the attributes from, if this version can choose.
+    if attribute_type and hasattr(colors, 'attribute_type'):
+        colors.attribute_type = attribute_type
+        normals.attribute_type = attribute_type
+
     # Create nodes to unpack the normals from the second vertex color layer.
     combine = nodes.new(type='ShaderNodeCombineXYZ')
     combine.hide = True
@@ -440,6 +805,7 @@ def assign_material(o, mat):
 
 def create_pointcloud_from(context, target):
     o = create_empty_mesh_obj(context, 'Pointcloud')
+    o.data[POINTCLOUD_MESH_TAG] = True
     pc = o.pointclouds.add()
     pc.target = target
     pc.seed = random.randint(-2**31, 2**31)
@@ -452,193 +818,660 @@ def create_empty_mesh_obj(context, name):
     context.scene.collection.objects.link(o)
     return o
 
-def update_pointcloud_iter(o):
+# Number of points sampled per step of an update, when not sized to fit a
+# time budget. The results don't depend on these, but they should be
+# multiples of sampling.CHUNK_SIZE.
+SAMPLE_STEP_COUNT = 4096
+# Number of points sampled per step by each worker process of a background update.
+BACKGROUND_STEP_COUNT = 65536
+# Seconds between ticks of the update operator. Each tick does one step,
+# sized to fit the frame budget preference; the viewport is redrawn between
+# ticks, so they can come as often as Blender can manage.
+MODAL_TICK_INTERVAL = 0.001
+
+def can_sample(target):
+    return (target is not None) and (target.type == 'MESH') and (not target.pointclouds)
+
+def update_pointcloud_iter(o, background=False, workers=0, miss_budget=None, profile=None,
+        step_budget=None):
+    # Yields the fraction of the points sampled so far, until done. When
+    # background is true, the points are sampled in worker processes, and
+    # closing the generator stops them. Otherwise, if step_budget is given,
+    # each step samples as many points as fit in that many seconds. Raises
+    # SamplingError if sampling fails. Timings and counts for each stage are
+    # added to profile, if given.
+    if profile is None:
+        profile = Profile('update')
     if not o.pointclouds:
         return
     pc = o.pointclouds[0]
-    target = pc.target
-    if (target is None) or (target.type != 'MESH') or (target.pointclouds):
+    if not can_sample(pc.target):
         return
-    seed = pc.seed
-    rng = random.Random(seed)
-    for data in generate_points(pc.target, pc.point_count, rng, step_count=4096):
-        yield
+    with profile.span('read_mesh'):
+        mesh = mesh_triangles(pc.target)
+    profile.count('triangles', len(mesh.triangles))
+    with profile.span('cache_lookup'):
+        sampler_class = SAMPLERS[pc.sampler]
+        key = sample_cache_key(mesh, sampler_class, pc.point_count, pc.seed)
+        series = sample_series(key)
+        data = sample_cache.get(key)
+    if data is None:
+        # Sampling is prefix-stable: the points for a smaller count are the
+        # first points for a larger one. So if the stored points come from
+        # the same series, only the difference needs sampling, if anything.
+        with profile.span('load_stored'):
+            prefix = stored_points(pc, series)
+        if len(prefix[0]) >= pc.point_count:
+            data = tuple(a[:pc.point_count] for a in prefix)
+        else:
+            with profile.span('create_sampler'):
+                if background:
+                    sampler = create_sampler(pc.sampler, mesh, miss_budget=miss_budget)
+                else:
+                    sampler = create_local_sampler(pc.sampler, mesh, miss_budget=miss_budget)
+            if background:
+                points = generate_points_in_background(sampler, pc.point_count, pc.seed,
+                    step_count=BACKGROUND_STEP_COUNT, workers=workers, prefix=prefix)
+            else:
+                scheduler = (StepScheduler(step_budget) if step_budget else None)
+                points = generate_points(sampler, pc.point_count, pc.seed,
+                    step_count=SAMPLE_STEP_COUNT, prefix=prefix, scheduler=scheduler)
+            try:
+                while True:
+                    # In the background, this only times collecting the
+                    # results; the overall points/s rate covers the rest.
+                    with profile.span('sample'):
+                        step = next(points, None)
+                    if step is None:
+                        break
+                    data = step
+                    profile.count('steps')
+                    yield (len(data[0]) / pc.point_count)
+            finally:
+                points.close()
+            profile.count('points_sampled', pc.point_count - len(prefix[0]))
+        with profile.span('cache_store'):
+            sample_cache.put(key, data)
+    else:
+        profile.count('cache_hits')
 
-    vertices_arr = array('f', (f for vec in data[0] for f in vec))
-    normals_arr = array('f', (f for vec in data[1] for f in vec))
-    colors_arr = array('f', (f for vec in data[2] for f in vec))
-    pc.set_raw_data(vertices_arr, normals=normals_arr, colors=colors_arr)
+    with profile.span('store_raw'):
+        pc.set_raw_data(data[0], normals=data[1], colors=data[2], series=series)
+    profile.count('raw_bytes', sum(a.nbytes for a in data))
 
-    o.data = create_pointcloud_mesh(o.data.name, data)
-    assign_material(o, get_pointcloud_material())
+    with profile.span('create_mesh'):
+        update_pointcloud_display(o, data)
+    profile.count('mesh_vertices', len(o.data.vertices))
+    profile.count('mesh_faces', len(o.data.polygons))
 
-def generate_points(target, count, rng=random, step_count=0):
+def update_profile(o, background=False):
+    # A Profile for updating o, recording its settings.
+    info = {'object': o.name, 'background': background}
+    if o.pointclouds:
+        pc = o.pointclouds[0]
+        info.update(sampler=pc.sampler, point_count=pc.point_count, seed=pc.seed)
+    profile = Profile('update', **info)
+    profile.add_rate("points/s", 'points_sampled')
+    return profile
+
+# The last profile of each kind for each object, by (object name, profile
+# name), for showing in the panel.
+last_profiles = {}
+
+def record_profile(o, profile, log_filepath=""):
+    # Finish the profile, keep it for the panel, and append it to the log
+    # file, if there is one.
+    profile.finish()
+    last_profiles[(o.name, profile.name)] = profile
+    if log_filepath:
+        try:
+            append_to_log(bpy.path.abspath(log_filepath), profile)
+        except OSError as e:
+            print(f"WARNING: couldn't write profile log {log_filepath}: {e}")
+
+# Recently sampled points, so that going back to earlier settings (or
+# re-opening a file) doesn't sample everything again. The operator sets
+# its size from the addon preferences.
+sample_cache = SampleCache(0)
+
+def stored_points(pc, series):
+    # The points stored on pc as (vertices, normals, colors) arrays, if they
+    # were sampled from the given series; otherwise, no points at all.
+    if (not series) or (pc.raw_series != series):
+        return empty_points()
+    return raw_points(pc)
+
+def raw_points(pc):
+    # All the points stored on pc as (vertices, normals, colors) arrays, or
+    # no points at all if they don't match up.
+    vertices = pc.raw_vertices.reshape(-1, 3)
+    normals = pc.raw_normals.reshape(-1, 3)
+    colors = pc.raw_colors.reshape(-1, 4)
+    if not (len(vertices) == len(normals) == len(colors)):
+        return empty_points()
+    return (vertices, normals, colors)
+
+def generate_points(sampler, count, seed=0, step_count=0, prefix=None, scheduler=None):
+    # Yield all the points generated so far after each step. The points are
+    # views into buffers for all count points, which are allocated up front.
+    # If prefix is given, it must hold the first points that sampler would
+    # generate; only the points after it are sampled. If scheduler (a
+    # StepScheduler) is given, it sizes the steps instead of step_count.
+    points = PointAccumulator(count)
+    if prefix is not None:
+        points.extend(prefix)
+    if scheduler is None:
+        for data in sample_batches(sampler, count, seed, step_count, start=len(points)):
+            points.extend(data)
+            yield points.data()
+        return
+    while len(points) < count:
+        start = len(points)
+        stop = step_stop(start, scheduler.size, count)
+        began = time.perf_counter()
+        points.extend(sample_range(sampler, seed, start, stop))
+        # The step sampled whole chunks, including any part before start.
+        sampled = stop - (start // CHUNK_SIZE) * CHUNK_SIZE
+        scheduler.record(sampled, time.perf_counter() - began)
+        # A step that adds nothing would be repeated forever.
+        if len(points) == start:
+            raise SamplingError("Didn't generate any points.")
+        yield points.data()
+
+def generate_points_in_background(sampler, count, seed=0, step_count=0, workers=0, prefix=None):
+    # Like generate_points(), and with the same results, but all the steps are
+    # handed to a pool of worker processes up front. Each time it's advanced,
+    # it collects the steps that have finished (in order) and yields all the
+    # points so far.
     if not step_count: step_count = count
-    total_count = 0
-    total_data = [[], [], []]
-    while total_count < count:
-        step_count = min(step_count, (count - total_count))
-        # data = sphere_sample_obj(target, step_count, rng)
-        # data = volume_sample_obj(target, step_count, rng)
-        data = surface_sample_obj(target, step_count, rng)
-        for i in range(len(total_data)):
-            total_data[i] += data[i]
-        total_count += step_count
-        if total_count < count:
-            yield list(total_data)
-    yield total_data
+    pool = BackgroundSampler(sampler, workers, worker_process_context())
+    points = PointAccumulator(count)
+    if prefix is not None:
+        points.extend(prefix)
+    try:
+        pending = deque(
+            pool.submit(seed, start, stop)
+            for (start, stop) in step_ranges(len(points), count, step_count))
+        while True:
+            while pending and pending[0].done():
+                points.extend(pending.popleft().result())
+            yield points.data()
+            if not pending:
+                break
+    finally:
+        pool.shutdown()
+
+def worker_process_context():
+    # Worker processes must run Blender's bundled Python. Before 2.91,
+    # sys.executable is the Blender binary instead, so point them at it.
+    context = multiprocessing.get_context('spawn')
+    python = getattr(bpy.app, 'binary_path_python', None)
+    if python:
+        context.set_executable(python)
+    return context
+
+def sample_batches(sampler, count, seed=0, step_count=0, start=0):
+    # Yield just the points generated by each step, so that a caller that
+    # writes them out as they come only needs memory for one step. The first
+    # start points are skipped.
+    if not step_count: step_count = count
+    for (start, stop) in step_ranges(start, count, step_count):
+        yield sample_range(sampler, seed, start, stop)
+
+#---------------------------------------------------------------------------#
+# Export
+#
+# An ExportJob holds everything an export needs, read from Blender up front,
+# so that it can run on an ExportThread without touching bpy. The file is
+# only moved into place once it is complete, so a cancelled or failed export
+# leaves any earlier file as it was.
+
+# Seconds between checks on a background export.
+EXPORT_TICK_INTERVAL = 0.1
+
+# Points packed and written at a time.
+EXPORT_BATCH_COUNT = 1 << 20
+
+# Change this whenever exported files change for the same points and
+# settings, so that they are all written again.
+EXPORT_VERSION = 1
+
+def export_settings(file_format, compress, tile_size=None):
+    # The settings that make a difference to an exported file.
+    settings = {'format': file_format}
+    if file_format == 'V2':
+        settings['compress'] = compress
+    if tile_size is not None:
+        settings['tile_size'] = tile_size
+    return settings
+
+def export_key(source, settings):
+    # Everything that goes into an exported file: where the points come
+    # from, and the settings.
+    fields = [f"v{EXPORT_VERSION}", source]
+    fields.extend(f"{name}={settings[name]}" for name in sorted(settings))
+    return ' '.join(fields)
+
+def stored_points_source(pc, points):
+    # The content hashes of pc's stored points, which are already known
+    # for points in the RawDataStore. Only points unpacked from an older
+    # file have to be hashed here.
+    digests = (pc.raw_vertices_digest, pc.raw_normals_digest, pc.raw_colors_digest)
+    return "points:" + ':'.join((digest or digest_of(a)) for (digest, a) in zip(digests, points))
+
+class ExportJob:
+
+    def __init__(self, filepath, file_format='V1', compress=False, profile=None, key=None):
+        self.filepath = filepath
+        self.file_format = file_format
+        self.compress = compress
+        self.profile = (profile or Profile('export'))
+        # If given, the export_key() to record in a key file once the
+        # file is written.
+        self.key = key
+        self._run = None
+
+    def stored(self, points):
+        # Export points as (vertices, normals, colors) arrays. The stored
+        # raw arrays can be given as they are: they are memory-mapped from
+        # content-addressed files, which never change.
+        self._run = (lambda: self._write(points[0], self._batches(points), len(points[0])))
+
+    def sampled(self, sampler, count, seed, positions):
+        # Sample count points again as the export goes. Every sample lies on
+        # or inside the mesh, so within the bounds of its positions.
+        batches = sample_batches(sampler, count, seed, step_count=SAMPLE_STEP_COUNT)
+        self._run = (lambda: self._write(positions, batches, count, span='sample'))
+
+    def tiled(self, points, tile_size):
+        # The manifest's offsets are into a version 1 file.
+        self._run = (lambda: self._write_tiled(points, tile_size))
+
+    def run(self):
+        """Do the export, yielding its progress from 0 to 1 as it goes.
+        Closing the generator early abandons the file."""
+        yield from self._run()
+        if self.key:
+            write_key_file(self.filepath, self.key)
+
+    @staticmethod
+    def _batches(points):
+        (vertices, normals, colors) = points
+        for start in range(0, len(vertices), EXPORT_BATCH_COUNT):
+            end = start + EXPORT_BATCH_COUNT
+            yield (vertices[start:end], normals[start:end], colors[start:end])
+
+    def open_writer(self, positions, count):
+        # A writer for the chosen format, for count points; version 2
+        # quantises to the bounds of positions.
+        if self.file_format == 'PLY':
+            return PointcloudPlyWriter(self.filepath, count, atomic=True)
+        if self.file_format == 'V2':
+            positions = positions.reshape(-1, 3)
+            if len(positions):
+                (lo, hi) = (positions.min(axis=0), positions.max(axis=0))
+            else:
+                lo = hi = np.zeros(3, dtype=np.float32)
+            return PointcloudBin2Writer(self.filepath, lo, hi, compress=self.compress, atomic=True)
+        return PointcloudBinWriter(self.filepath, atomic=True)
+
+    def _write(self, positions, batches, count, span='read'):
+        profile = self.profile
+        done = 0
+        with self.open_writer(positions, count) as f:
+            while True:
+                with profile.span(span):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                (vertices, normals, colors) = batch
+                if isinstance(f, PointcloudBin2Writer):
+                    with profile.span('write'):
+                        f.write(vertices, normals, colors)
+                else:
+                    with profile.span('pack'):
+                        if isinstance(f, PointcloudPlyWriter):
+                            records = pack_ply_records(vertices, normals, colors)
+                        else:
+                            records = pack_records(vertices, colors)
+                    with profile.span('write'):
+                        f.write_records(records)
+                done += len(vertices)
+                yield (done / count if count else 1.0)
+        profile.count('points', f.count)
+        profile.count('bytes_written', f.size)
+
+    def _write_tiled(self, points, tile_size):
+        (vertices, normals, colors) = points
+        with self.profile.span('write'):
+            manifest = write_tiled_bin(self.filepath, vertices, colors, tile_size)
+        self.profile.count('points', manifest['count'])
+        self.profile.count('tiles', len(manifest['tiles']))
+        yield 1.0
+
+
+class ExportThread(threading.Thread):
+    # Runs ExportJobs one after another, keeping the overall progress and
+    # any error for the main thread to check on. Stops at the first error.
+
+    def __init__(self, jobs):
+        super().__init__(daemon=True)
+        self.jobs = jobs
+        self.progress = 0.0
+        self.error = None
+        self.cancelled = False
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        try:
+            for (i, job) in enumerate(self.jobs):
+                steps = job.run()
+                for progress in steps:
+                    self.progress = (i + progress) / len(self.jobs)
+                    if self._cancel.is_set():
+                        steps.close()
+                        self.cancelled = True
+                        return
+        except Exception as e:
+            self.error = e
 
 #---------------------------------------------------------------------------#
 # Meshes for in-Blender visualization.
 
-def create_pointcloud_mesh(name, data):
+def update_pointcloud_display(o, data=None):
+    # Rebuild o's mesh, in its display mode, from data; or if data is None,
+    # from the points stored on it (which data must be the same as). Only
+    # as many points as the viewport budget allows are shown.
+    pc = o.pointclouds[0]
+    if data is None:
+        data = raw_points(pc)
+    data = viewport_subset(pc, data, viewport_point_budget(pc))
+    rebuild_pointcloud_mesh(o, data, display_mode=pc.display_mode)
+    assign_material(o, get_pointcloud_material())
+    update_point_instancing(o, pc.display_mode)
+
+def viewport_point_budget(pc):
+    # The most points to show for pc, or 0 for no limit.
+    if pc.viewport_points:
+        return pc.viewport_points
+    addon = bpy.context.preferences.addons.get(__package__)
+    return (addon.preferences.viewport_point_budget if addon else 0)
+
+# progressive_order() of the vertices stored with each digest. Working it
+# out takes a moment for big pointclouds, so the last few are kept.
+_progressive_orders = OrderedDict()
+PROGRESSIVE_ORDER_CACHE_SIZE = 8
+
+def viewport_subset(pc, data, budget):
+    # The first budget points of data (the points stored on pc), in
+    # progressive order, so that they cover it evenly; or all of them.
+    count = len(data[0])
+    if (not budget) or (count <= budget):
+        return data
+    key = pc.raw_vertices_digest
+    order = _progressive_orders.get(key)
+    if (order is None) or (len(order) != count):
+        order = progressive_order(data[0])
+        if key:
+            _progressive_orders[key] = order
+            while len(_progressive_orders) > PROGRESSIVE_ORDER_CACHE_SIZE:
+                _progressive_orders.popitem(last=False)
+    else:
+        _progressive_orders.move_to_end(key)
+    # Reading the subset in storage order is kinder to memory-mapped data.
+    subset = np.sort(order[:budget])
+    return tuple(a[subset] for a in data)
+
+def update_all_pointcloud_displays():
+    for o in bpy.data.objects:
+        if o.pointclouds and (o.type == 'MESH'):
+            update_pointcloud_display(o)
+
+# The custom property marking meshes made to show pointclouds.
+POINTCLOUD_MESH_TAG = 'agnosia_pointcloud'
+
+def rebuild_pointcloud_mesh(o, data, display_mode='QUADS'):
+    # Replace the geometry of o's mesh with the points in data. The mesh is
+    # reused where possible, so that updates don't pile up old meshes.
+    mesh = o.data
+    if hasattr(mesh, 'clear_geometry') and (mesh.users == 1):
+        # From 2.81, clear it out and refill it; materials stay.
+        mesh.clear_geometry()
+        fill_pointcloud_mesh(mesh, data, display_mode)
+        return
+    # Otherwise, swap in a new mesh, and get rid of the old one if that
+    # leaves it unused.
+    name = mesh.name
+    o.data = create_pointcloud_mesh(name, data, display_mode)
+    if (mesh.users == 0) and mesh.get(POINTCLOUD_MESH_TAG):
+        bpy.data.meshes.remove(mesh)
+        o.data.name = name
+
+def purge_pointcloud_meshes():
+    # Remove pointcloud meshes that nothing uses any more. Returns the
+    # number of meshes and vertices removed.
+    orphans = [m for m in bpy.data.meshes if (m.users == 0) and m.get(POINTCLOUD_MESH_TAG)]
+    vertex_count = sum(len(m.vertices) for m in orphans)
+    for m in orphans:
+        bpy.data.meshes.remove(m)
+    return (len(orphans), vertex_count)
+
+def create_pointcloud_mesh(name, data, display_mode='QUADS'):
     mesh = bpy.data.meshes.new(name)
+    fill_pointcloud_mesh(mesh, data, display_mode)
+    return mesh
+
+def point_attribute_domain():
+    # The per-vertex attribute domain was called 'VERTEX' in 2.91, and has
+    # been 'POINT' since 2.92.
+    return ('VERTEX' if bpy.app.version < (2, 92, 0) else 'POINT')
+
+def fill_pointcloud_mesh(mesh, data, display_mode='QUADS'):
+    # data is a tuple (vertices, normals, colors) of float32 arrays shaped
+    # [n, 3], [n, 3] and [n, 4]; mesh must be empty. The mesh is built with
+    # bulk foreach_set() calls; it is valid by construction, so it doesn't
+    # need validate().
+    mesh[POINTCLOUD_MESH_TAG] = True
     (vertices, normals, colors) = data
+    if display_mode == 'INSTANCED':
+        # Just one vertex per point, with no faces; update_point_instancing()
+        # puts a quad on each.
+        if len(vertices):
+            mesh.vertices.add(len(vertices))
+            mesh.vertices.foreach_set('co', np.ascontiguousarray(vertices).ravel())
+            mesh.update()
+            # Point attributes only exist from 2.91. Before that, there is
+            # nowhere on a loose vertex to keep its color and normal.
+            if hasattr(mesh, 'attributes'):
+                domain = point_attribute_domain()
+                color_layer = mesh.attributes.new('PointColor', 'FLOAT_COLOR', domain)
+                color_layer.data.foreach_set('color', np.ascontiguousarray(colors).ravel())
+                normal_layer = mesh.attributes.new('PointNormal', 'FLOAT_COLOR', domain)
+                normal_layer.data.foreach_set('color', pack_normals(normals).ravel())
+        return
     # Expand each vertex to make a quad facing the -y axis.
-    if vertices:
+    if len(vertices):
         (vertices, faces, normals, colors) = \
             expand_vertex_data_to_mesh(vertices, normals, colors)
-        mesh.from_pydata(vertices, [], faces)
-        mesh.validate(verbose=True, clean_customdata=False)
-        mesh.update()
-        # Apply per-vertex colors and normals
+        (face_count, face_size) = faces.shape
+        mesh.vertices.add(len(vertices))
+        mesh.vertices.foreach_set('co', vertices.ravel())
+        mesh.loops.add(faces.size)
+        mesh.loops.foreach_set('vertex_index', faces.ravel())
+        mesh.polygons.add(face_count)
+        mesh.polygons.foreach_set('loop_start',
+            np.arange(0, faces.size, face_size, dtype=np.int32))
+        mesh.polygons.foreach_set('loop_total',
+            np.full(face_count, face_size, dtype=np.int32))
+        mesh.update(calc_edges=True)
+        # Apply per-vertex colors and normals. Each vertex has exactly one
+        # loop, with the same index, so the layers can be set directly.
         color_layer = mesh.vertex_colors.new(name='PointColor')
-        for (i, color) in enumerate(colors):
-            color_layer.data[i].color = color
+        color_layer.data.foreach_set('color', colors.ravel())
         normal_layer = mesh.vertex_colors.new(name='PointNormal')
-        for (i, normal) in enumerate(normals):
-            # Pack the normals into the color data
-            n = (normal / 2.0) + Vector((0.5, 0.5, 0.5))
-            normal_layer.data[i].color = (n[0], n[1], n[2], 0.0)
-    return mesh
+        normal_layer.data.foreach_set('color', normals.ravel())
+
 
+# The mesh representing a point: a quad facing the -y axis.
+POINT_QUAD = np.array((
+    (1, 0, 1),
+    (-1, 0, 1),
+    (-1, 0, -1),
+    (1, 0, -1),
+    ), dtype=np.float32) * 0.05
+
+def pack_normals(normals):
+    # Pack normals into colors, as float32[n, 4].
+    packed = np.zeros((len(normals), 4), dtype=np.float32)
+    packed[:, :3] = (normals / 2.0) + 0.5
+    return packed
 
 def expand_vertex_data_to_mesh(vertices, normals, colors):
-    expanded_vertices = []
-    expanded_normals = []
-    expanded_colors = []
-    faces = []
-
-    # Size of the mesh representing a point.
-    scale = 0.05
-    quad = (
-        Vector((1, 0, 1)) * scale,
-        Vector((-1, 0, 1)) * scale,
-        Vector((-1, 0, -1)) * scale,
-        Vector((1, 0, -1)) * scale,
-        )
+    # Returns (vertices, faces, normals, colors): four vertices per point as
+    # float32[4n, 3], one quad per point as int32[n, 4] vertex indices, and
+    # the normals (packed into colors) and colors as float32[4n, 4].
+    count = len(vertices)
 
     # Expand the source data to a quad.
-    for v in vertices:
-        expanded_vertices.extend((v + quad[0], v + quad[1], v + quad[2], v + quad[3]))
-    for n in normals:
-        expanded_normals.extend((n, n, n, n))
-    for c in colors:
-        expanded_colors.extend((c, c, c, c))
+    expanded_vertices = (vertices[:, np.newaxis, :] + POINT_QUAD).reshape(-1, 3)
+    # Pack the normals into color data
+    expanded_normals = np.repeat(pack_normals(normals), 4, axis=0)
+    expanded_colors = np.repeat(colors, 4, axis=0)
 
     # Generate faces
-    for i in range(len(vertices)):
-        base = (4 * i)
-        faces.append((
-            base + 0,
-            base + 1,
-            base + 2,
-            base + 3,
-            ))
+    faces = np.arange(4 * count, dtype=np.int32).reshape(count, 4)
 
     return (expanded_vertices, faces, expanded_normals, expanded_colors)
 
 
+# The custom property marking the object that a pointcloud instances on
+# each of its vertices.
+POINT_INSTANCE_TAG = 'agnosia_point_instance'
+
+def update_point_instancing(o, display_mode):
+    # In INSTANCED mode, o instances a child object with the point quad on
+    # every vertex; otherwise, it has no such child.
+    instance = next((c for c in o.children if c.get(POINT_INSTANCE_TAG)), None)
+    if display_mode == 'INSTANCED':
+        if instance is None:
+            instance = bpy.data.objects.new(o.name + 'Point', get_point_instance_mesh())
+            instance[POINT_INSTANCE_TAG] = True
+            instance.parent = o
+            instance.hide_select = True
+            for collection in o.users_collection:
+                collection.objects.link(instance)
+        o.instance_type = 'VERTS'
+    else:
+        o.instance_type = 'NONE'
+        if instance is not None:
+            bpy.data.objects.remove(instance)
+
+def get_point_instance_mesh():
+    # The quad mesh shared by the instances of all pointclouds.
+    name = 'PointcloudInstanceMesh'
+    mesh = bpy.data.meshes.get(name)
+    if not mesh:
+        mesh = bpy.data.meshes.new(name)
+        mesh.from_pydata(POINT_QUAD.tolist(), [], [(0, 1, 2, 3)])
+        mesh.update()
+        mesh.materials.append(get_point_instance_material())
+    return mesh
+
+def get_point_instance_material():
+    # Like the pointcloud material, but reading the attributes from the
+    # instancing vertex; that is only possible from 3.0, so before then the
+    # instances are plain white.
+    name = 'PointcloudInstanceMaterial'
+    m = bpy.data.materials.get(name)
+    if not m:
+        m = bpy.data.materials.new(name)
+        define_pointcloud_material(m, attribute_type='INSTANCER')
+    return m
+
+
 #---------------------------------------------------------------------------#
 # Sampling.
 
 def sphere_sample_obj(o, count, rng):
     # Sample the object by raycasting from a sphere surrounding it
-    # towards the origin.
-    vertices = []
-    normals = []
-    colors = []
-    radius = object_bounding_radius(o) + 0.1
-    it = iter(sphere_surface_points(radius, rng))
-    while len(vertices) < count:
-        pt = next(it)
-        result, position, normal, index = raycast_to_origin(o, pt)
-        if result:
-            vertices.append(position)
-            normals.append(normal)
-            colors.append((1.0, 0.0, 1.0, 1.0))
-    return (vertices, normals, colors)
+    # towards the origin. To sample the same object repeatedly, keep a
+    # SphereSampler around instead, so that its BVH is only built once.
+    sampler = create_local_sampler('SPHERE', mesh_triangles(o))
+    rs = np.random.RandomState(rng.getrandbits(32))
+    return sampler.sample(count, rs)
 
 def volume_sample_obj(o, count, rng):
-    # Sample the object by generating points within its bounds and
-    # testing if they're inside it. Assumes the mesh is watertight.
-    vertices = []
-    normals = []
-    colors = []
-    bm = bmesh.new()
-    bm.from_mesh(o.data)
-    bvh = BVHTree.FromBMesh(bm)
-
-    halfwidth = object_bounding_halfwidth(o) + 0.1
-    it = iter(cube_volume_points(halfwidth, rng))
-    while len(vertices) < count:
-        pt = next(it)
-
-        (location, normal, index, distance) = raycast_to_exterior(bvh, pt)
-        pt_is_inside = (location is not None)
-
-        if pt_is_inside:
-            vertices.append(location)
-            normals.append(normal)
-            # TEMP: color each point by its coordinates
-            r = (abs(location[0]) / halfwidth)
-            g = (abs(location[1]) / halfwidth)
-            b = (abs(location[2]) / halfwidth)
-            colors.append((r, g, b, 1.0))
-    return (vertices, normals, colors)
+    # Sample the object by generating points within it. Assumes the mesh is
+    # watertight. To sample the same object repeatedly, keep a VolumeSampler
+    # around instead, so that the mesh is only voxelised once.
+    sampler = VolumeSampler(mesh_triangles(o))
+    rs = np.random.RandomState(rng.getrandbits(32))
+    return sampler.sample(count, rs)
 
 def surface_sample_obj(o, count, rng):
     # Sample the object by generating points on the surfaces of its tris.
-    vertices = []
-    normals = []
-    colors = []
-
+    # To sample the same object repeatedly, keep a SurfaceSampler around
+    # instead, so that the mesh is only read and measured once.
+    sampler = SurfaceSampler(mesh_triangles(o))
+    rs = np.random.RandomState(rng.getrandbits(32))
+    return sampler.sample(count, rs)
+
+def mesh_triangles(o):
+    # Read the object's mesh into a TriangleMesh, in bulk.
     mesh = o.data
-    # Find the surface area of each poly and the whole mesh.
-    poly_areas = [p.area for p in mesh.polygons]
-    surface_area = sum(poly_areas)
-
-    # Generate uniform random area targets.
-    area_targets = sorted(rng.uniform(0, surface_area) for _ in range(count))
-
-    # Iterate the polys to see which reaches the target.
-    area_so_far = 0
-    target = area_targets.pop(0)
-    for i, poly in enumerate(mesh.polygons):
-        area_so_far += poly_areas[i]
-        while target <= area_so_far:
-            # Spawn a point.
-            poly_vertices = [Vector(mesh.vertices[j].co) for j in poly.vertices]
-            location = polygon_surface_point(poly_vertices, rng)
-            normal = poly.normal
-            # Save the point.
-            vertices.append(location)
-            normals.append(normal)
-            # TEMP: color each point by its coordinates
-            halfwidth = object_bounding_halfwidth(o) + 0.1
-            r = (abs(location[0]) / halfwidth)
-            g = (abs(location[1]) / halfwidth)
-            b = (abs(location[2]) / halfwidth)
-            colors.append((r, g, b, 1.0))
-            # Get a new target
-            if area_targets:
-                target = area_targets.pop(0)
-            else:
-                # If we've run out of targets, then we have enough points.
-                break
-    if not vertices:
-        print(f"ERROR: didn't generate any vertices!")
-    return (vertices, normals, colors)
+    mesh.calc_loop_triangles()
+    vertex_count = len(mesh.vertices)
+    triangle_count = len(mesh.loop_triangles)
+    positions = np.empty(3 * vertex_count, dtype=np.float32)
+    mesh.vertices.foreach_get('co', positions)
+    triangles = np.empty(3 * triangle_count, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('vertices', triangles)
+    normals = np.empty(3 * triangle_count, dtype=np.float32)
+    mesh.loop_triangles.foreach_get('normal', normals)
+    return TriangleMesh(
+        positions.reshape(-1, 3),
+        triangles.reshape(-1, 3),
+        normals.reshape(-1, 3),
+        )
+
+class BVHTreeRaycaster:
+    # Casts batches of rays against a mathutils BVHTree, which is built and
+    # traversed in C. The tree can't be pickled, so only samplers that stay
+    # in Blender's process use this; worker processes use the sampler's
+    # default bvh.TriangleBVH instead.
+
+    def __init__(self, mesh):
+        self.bvh = BVHTree.FromPolygons(mesh.positions.tolist(), mesh.triangles.tolist())
+
+    def ray_cast_many(self, origins, directions):
+        count = len(origins)
+        hit = np.zeros(count, dtype=bool)
+        locations = np.zeros((count, 3), dtype=np.float64)
+        normals = np.zeros((count, 3), dtype=np.float64)
+        indices = np.full(count, -1, dtype=np.int64)
+        distances = np.full(count, np.inf)
+        ray_cast = self.bvh.ray_cast
+        for (i, (origin, direction)) in enumerate(zip(origins.tolist(), directions.tolist())):
+            (location, normal, index, distance) = ray_cast(origin, direction)
+            if location is not None:
+                hit[i] = True
+                locations[i] = location
+                normals[i] = normal
+                indices[i] = index
+                distances[i] = distance
+        return (hit, locations, normals, indices, distances)
+
+def create_local_sampler(name, mesh, miss_budget=None):
+    # Like create_sampler(), for a sampler that only runs in this process:
+    # sphere sampling then casts its rays with mathutils' BVHTree. Where rays
+    # graze an edge, the two trees can disagree about a hit, so points from
+    # here and from worker processes can differ slightly.
+    if name == 'SPHERE':
+        return SphereSampler(mesh, BVHTreeRaycaster(mesh), miss_budget=miss_budget)
+    return create_sampler(name, mesh, miss_budget=miss_budget)
 
 def object_bounding_radius(o):
     from math import sqrt
@@ -653,69 +1486,6 @@ def object_bounding_halfwidth(o):
         halfwidth = max(halfwidth, abs(x), abs(y), abs(z))
     return halfwidth
 
-def sphere_surface_points(radius, rng):
-    # Generate Vectors randomly distributed on the surface of
-    # a sphere with the given radius.
-    while True:
-        from math import acos, cos, pi, sin, sqrt
-        u = rng.random()
-        v = rng.random()
-        theta = 2 * pi * u
-        phi = acos(2 * v - 1)
-        x = radius * cos(theta) * sin(phi)
-        y = radius * sin(theta) * sin(phi)
-        z = radius * cos(phi)
-        yield Vector((x, y, z))
-
-def cube_volume_points(halfwidth, rng):
-    # Generate Vectors randomly distributed within the volume
-    # of a cube with the given halfwidth.
-    while True:
-        u = rng.uniform(-1, 1)
-        v = rng.uniform(-1, 1)
-        w = rng.uniform(-1, 1)
-        x = halfwidth * u
-        y = halfwidth * v
-        z = halfwidth * w
-        yield Vector((x, y, z))
-
-def polygon_surface_point(vertices, rng):
-    # Return a random point on the surface of the polygon.
-    # Determine the vertices abc of each triangle, and the vectors ab and ac.
-    tris = [
-        (
-            vertices[0],    # a
-            vertices[i+1],  # b
-            vertices[i+2],  # c
-            (vertices[i+1] - vertices[0]),  # ab
-            (vertices[i+2] - vertices[0]),  # ac
-        )
-        for i in range(len(vertices) - 2)
-    ]
-    # Find the area of each tri and the total polygon area.
-    tri_areas = [
-        (ab.cross(ac)).length / 2.0
-        for (_, _, _, ab, ac) in tris
-    ]
-    surface_area = sum(tri_areas)
-    # Pick a target tri by area
-    target = rng.uniform(0, surface_area)
-    area_so_far = 0
-    for (i, (a, b, c, ab, ac)) in enumerate(tris):
-        area_so_far += tri_areas[i]
-        while target <= area_so_far:
-            # Pick a point in this tri
-            r1 = rng.random()
-            r2 = rng.random()
-            r1root = math.sqrt(r1)
-            pt = ((1 - r1root) * a
-                + r1root * (1 - r2) * b
-                + r1root * r2 * c)
-            return pt
-    # Shouldn't get here, but if we do, just return a vertex
-    print("ERROR: failed to find target tri.")
-    return vertices[0]
-
 def raycast_to_origin(o, pt):
     # Raycast the object o from pt (in object space) to its origin.
     # Return a tuple: (result, position, normal, index)
@@ -758,127 +1528,3 @@ def raycast_to_exterior(bvh, pt):
         return NO_HIT
 
     return (location, normal, index, distance)
-
-
-#---------------------------------------------------------------------------#
-# Pointcloud file types
-
-## Structures in binary pointcloud file
-
-def bin_size(size):
-    return struct.pack('=L', size)
-
-def bin_point(x, y, z, r, g, b):
-    return struct.pack('=fffBBBx', x, y, z, r, g, b)
-
-
-## Binary pointcloud writing
-
-class PointcloudBinWriter:
-    # File format:
-    #     uint32_t size_of_data
-    #     struct record {
-    #         float x, y, z;
-    #         uint8_t r, g, b;
-    #         uint8_t pad;
-    #     } records[size / sizeof(struct record)]
-
-    def __init__(self, filename):
-        self.filename = filename
-        self.file = None
-        self.count = 0
-        self.size = 0
-
-    def write(self, x, y, z, r, g, b):
-        assert (self.file is not None), "File is not open."
-        blob = bin_point(x, y, z, r, g, b)
-        self.file.write(blob)
-        self.size += len(blob)
-        self.count += 1
-
-    def __len__(self):
-        return self.count
-
-    def __enter__(self):
-        self.file = open(self.filename, 'wb')
-        # The file starts with the size of its data. We write a zero
-        # initially, and fill in the actual size on __exit__().
-        self.file.write(bin_size(0))
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        if not exc_type and not exc_value:
-            self.file.seek(0)
-            self.file.write(bin_size(self.size))
-        self.file.close()
-
-
-#---------------------------------------------------------------------------#
-# Utils.
-
-from contextlib import contextmanager
-
-@contextmanager
-def tempfile(suffix='', dir=None):
-    """ Context for temporary file.
-
-    Will find a free temporary filename upon entering
-    and will try to delete the file on leaving, even in case of an exception.
-
-    Parameters
-    ----------
-    suffix : string
-        optional file suffix
-    dir : string
-        optional directory to save temporary file in
-    """
-    # From: https://stackoverflow.com/a/29491523
-    import os
-    import tempfile as tmp
-
-    tf = tmp.NamedTemporaryFile(delete=False, suffix=suffix, dir=dir)
-    tf.file.close()
-    try:
-        yield tf.name
-    finally:
-        try:
-            os.remove(tf.name)
-        except OSError as e:
-            if e.errno == 2:
-                pass
-            else:
-                raise
-
-@contextmanager
-def file_atomic(filepath, *args, **kwargs):
-    """ Open temporary file object that atomically moves to destination upon
-    exiting.
-
-    Allows reading and writing to and from the same filename.
-
-    The file will not be moved to destination in case of an exception.
-
-    Parameters
-    ----------
-    filepath : string
-        the file path to be opened
-    fsync : bool
-        whether to force write the file to disk
-    *args : mixed
-        Any valid arguments for :code:`open`
-    **kwargs : mixed
-        Any valid keyword arguments for :code:`open`
-    """
-    # From: https://stackoverflow.com/a/29491523
-    import os
-    fsync = kwargs.get('fsync', False)
-
-    with tempfile(dir=os.path.dirname(os.path.abspath(filepath))) as tmppath:
-        with open(tmppath, *args, **kwargs) as file:
-            try:
-                yield file
-            finally:
-                if fsync:
-                    file.flush()
-                    os.fsync(file.fileno())
-        os.rename(tmppath, filepath)
\ No newline at end of file
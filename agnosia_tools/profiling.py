@@ -0,0 +1,95 @@
+import json
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#---------------------------------------------------------------------------#
+# Profiling
+#
+# A Profile collects named timing spans and counters for one run of an
+# operation. Spans with the same name add up, so a span can be wrapped
+# around each step of something that runs over many modal ticks.
+
+class Profile:
+
+    def __init__(self, name, **info):
+        self.name = name
+        # Anything else worth knowing about the run, like its settings.
+        self.info = info
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.elapsed = None
+        self.spans = OrderedDict()
+        self.counters = OrderedDict()
+        # Rates to report, as name: (counter, span or None).
+        self.rates = OrderedDict()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + (time.perf_counter() - start)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def finish(self):
+        # Stop the clock. The elapsed time includes any time between spans,
+        # such as waiting for the next modal tick.
+        self.elapsed = time.perf_counter() - self._start
+        return self
+
+    @property
+    def busy(self):
+        # Time spent inside spans.
+        return sum(self.spans.values())
+
+    def add_rate(self, name, counter, span=None):
+        # Report counter per second of span, or of the whole run.
+        self.rates[name] = (counter, span)
+
+    def rate(self, name):
+        (counter, span) = self.rates[name]
+        seconds = (self.spans.get(span, 0.0) if span else self.elapsed)
+        value = self.counters.get(counter)
+        if not seconds or value is None:
+            return None
+        return value / seconds
+
+    def as_dict(self):
+        return OrderedDict((
+            ('name', self.name),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))),
+            ('info', self.info),
+            ('elapsed', self.elapsed),
+            ('busy', self.busy),
+            ('spans', self.spans),
+            ('counters', self.counters),
+            ('rates', OrderedDict((name, self.rate(name)) for name in self.rates)),
+            ))
+
+    def summary(self):
+        # Lines for showing the profile in the UI: the total, then each span
+        # with its share of the busy time, then the counters.
+        lines = []
+        elapsed = (self.elapsed if self.elapsed is not None else time.perf_counter() - self._start)
+        lines.append(f"{self.name}: {elapsed:.3f}s ({self.busy:.3f}s busy)")
+        busy = (self.busy or 1.0)
+        for (name, seconds) in self.spans.items():
+            lines.append(f"{name}: {seconds * 1000:.1f}ms ({100 * seconds / busy:.0f}%)")
+        for (name, value) in self.counters.items():
+            lines.append(f"{name}: {value:,}")
+        for name in self.rates:
+            value = self.rate(name)
+            if value is not None:
+                lines.append(f"{name}: {value:,.0f}")
+        return lines
+
+
+def append_to_log(filename, profile):
+    """Append the profile to a JSON-lines log file."""
+    with open(filename, 'a') as f:
+        f.write(json.dumps(profile.as_dict()) + '\n')
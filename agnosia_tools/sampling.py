@@ -0,0 +1,669 @@
+import hashlib
+import numpy as np
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .bvh import TriangleBVH
+
+# Nothing in this module may import bpy, bmesh or mathutils: it works on
+# plain arrays, so that it can also run outside of Blender.
+
+class SamplingError(Exception):
+    pass
+
+
+#---------------------------------------------------------------------------#
+# Meshes as plain arrays.
+
+# A triangulated mesh in object space:
+#     positions: float32[vertex_count, 3]
+#     triangles: int32[triangle_count, 3], indices into positions
+#     normals:   float32[triangle_count, 3], one normal per triangle
+TriangleMesh = namedtuple('TriangleMesh', ('positions', 'triangles', 'normals'))
+
+def mesh_digest(mesh):
+    """Return a hash of the mesh's geometry."""
+    h = hashlib.blake2b(digest_size=16)
+    for a in mesh:
+        a = np.ascontiguousarray(a)
+        h.update(repr((a.dtype.str, a.shape)).encode('ascii'))
+        h.update(memoryview(a))
+    return h.hexdigest()
+
+def open_edge_count(mesh):
+    """Return how many edges of the mesh are not shared by exactly two
+    triangles: zero for a closed, manifold mesh. Vertices at the same
+    position count as one, so that split normals or UVs don't open it."""
+    if not len(mesh.triangles):
+        return 0
+    (unique, welded) = np.unique(mesh.positions, axis=0, return_inverse=True)
+    triangles = welded.reshape(-1)[mesh.triangles]
+    edges = np.concatenate((triangles[:, (0, 1)], triangles[:, (1, 2)], triangles[:, (2, 0)]))
+    edges = np.sort(edges[edges[:, 0] != edges[:, 1]], axis=1)
+    (unique, counts) = np.unique(edges, axis=0, return_counts=True)
+    return int(np.count_nonzero(counts != 2))
+
+def bounding_halfwidth(positions):
+    # Same as pointcloud.object_bounding_halfwidth(), but for an array of positions.
+    if len(positions) == 0:
+        return 0.0
+    return float(np.abs(positions).max())
+
+def bounding_radius(positions):
+    # Same as pointcloud.object_bounding_radius(), but for an array of positions.
+    if len(positions) == 0:
+        return 0.0
+    return float(np.sqrt((positions.astype(np.float64) ** 2).sum(axis=1)).max())
+
+def sphere_surface_points(radius, uv):
+    # Map pairs of uniform random numbers uv[n, 2] to points uniformly
+    # distributed on the surface of a sphere with the given radius.
+    theta = 2 * np.pi * uv[:, 0]
+    phi = np.arccos(2 * uv[:, 1] - 1)
+    return radius * np.stack((
+        np.cos(theta) * np.sin(phi),
+        np.sin(theta) * np.sin(phi),
+        np.cos(phi),
+        ), axis=1)
+
+def coordinate_colors(locations, halfwidth):
+    # TEMP: color each point by its coordinates
+    colors = np.ones((len(locations), 4), dtype=np.float32)
+    colors[:, :3] = np.abs(locations) / halfwidth
+    return colors
+
+def empty_points():
+    return (
+        np.empty((0, 3), dtype=np.float32),
+        np.empty((0, 3), dtype=np.float32),
+        np.empty((0, 4), dtype=np.float32),
+        )
+
+
+#---------------------------------------------------------------------------#
+# Samplers.
+#
+# A sampler's sample(count, rs) returns a tuple (vertices, normals, colors) of
+# float32 arrays shaped [count, 3], [count, 3] and [count, 4], drawing all its
+# random numbers from the numpy RandomState rs.
+
+class SurfaceSampler:
+    """Sample points uniformly over the surface of a TriangleMesh.
+
+    The cumulative triangle area table is built once up front; after that
+    each point costs one binary search, and a whole batch of points is
+    picked and placed with array operations."""
+
+    name = 'SURFACE'
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        positions = mesh.positions
+        triangles = mesh.triangles
+        # Corners of every triangle, and the vectors ab and ac.
+        self.a = positions[triangles[:, 0]]
+        self.b = positions[triangles[:, 1]]
+        self.c = positions[triangles[:, 2]]
+        ab = (self.b - self.a).astype(np.float64)
+        ac = (self.c - self.a).astype(np.float64)
+        areas = np.sqrt((np.cross(ab, ac) ** 2).sum(axis=1)) / 2.0
+        self.cdf = np.cumsum(areas)
+        self.surface_area = (float(self.cdf[-1]) if len(self.cdf) else 0.0)
+        self.halfwidth = bounding_halfwidth(positions) + 0.1
+
+    def sample(self, count, rs):
+        if count <= 0:
+            return empty_points()
+        if self.surface_area <= 0.0:
+            raise SamplingError("Target has no surface to sample.")
+        # Pick triangles by area. side='right' never lands on a zero-area tri.
+        targets = rs.random_sample(count) * self.surface_area
+        index = np.searchsorted(self.cdf, targets, side='right')
+        np.minimum(index, len(self.cdf) - 1, out=index)
+        # Pick a point in each triangle.
+        r1root = np.sqrt(rs.random_sample(count))[:, np.newaxis]
+        r2 = rs.random_sample(count)[:, np.newaxis]
+        vertices = ((1.0 - r1root) * self.a[index]
+            + (r1root * (1.0 - r2)) * self.b[index]
+            + (r1root * r2) * self.c[index]).astype(np.float32)
+        normals = self.mesh.normals[index]
+        colors = coordinate_colors(vertices, self.halfwidth)
+        return (vertices, normals, colors)
+
+
+class VolumeSampler:
+    """Sample points uniformly inside a closed TriangleMesh.
+
+    The mesh is voxelised once into an inside/outside occupancy grid, by
+    counting surface crossings up each column of voxels (parity). Candidate
+    points are only drawn from voxels that are inside or on the boundary:
+    points in voxels well inside are accepted as they are, and only points
+    in boundary voxels need an exact test.
+
+    Inside and outside only make sense for a closed mesh: if any edge is not
+    shared by exactly two triangles, sample() raises a SamplingError."""
+
+    name = 'VOLUME'
+    resolution = 64
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        positions = mesh.positions
+        triangles = mesh.triangles
+        self.halfwidth = bounding_halfwidth(positions) + 0.1
+        self.a = positions[triangles[:, 0]].astype(np.float64)
+        self.b = positions[triangles[:, 1]].astype(np.float64)
+        self.c = positions[triangles[:, 2]].astype(np.float64)
+        self.open_edges = open_edge_count(mesh)
+        if not len(triangles) or self.open_edges:
+            self.voxels = np.empty(0, dtype=np.int64)
+            return
+        # Cubic voxels, with a one voxel border around the mesh's bounds.
+        lo = positions.min(axis=0).astype(np.float64)
+        hi = positions.max(axis=0).astype(np.float64)
+        self.size = max(float((hi - lo).max()) / self.resolution, 1e-6)
+        self.lo = lo - self.size
+        self.shape = tuple(int(n) for n in np.ceil((hi - self.lo) / self.size).astype(int) + 1)
+        self._build_columns()
+        self._build_grid(mesh)
+
+    def _build_columns(self):
+        # For each column of voxels (ix, iy), the triangles whose bounds
+        # overlap it in xy, in compressed form: the triangles of column k
+        # are column_triangles[column_start[k]:column_start[k + 1]].
+        (nx, ny, nz) = self.shape
+        tri_lo = np.minimum(np.minimum(self.a, self.b), self.c)[:, :2]
+        tri_hi = np.maximum(np.maximum(self.a, self.b), self.c)[:, :2]
+        limit = np.array((nx - 1, ny - 1))
+        i0 = np.clip(np.floor((tri_lo - self.lo[:2]) / self.size).astype(np.int64), 0, limit)
+        i1 = np.clip(np.floor((tri_hi - self.lo[:2]) / self.size).astype(np.int64), 0, limit)
+        span = (i1 - i0 + 1)
+        counts = span[:, 0] * span[:, 1]
+        triangle = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        width = np.repeat(span[:, 0], counts)
+        ix = np.repeat(i0[:, 0], counts) + (local % width)
+        iy = np.repeat(i0[:, 1], counts) + (local // width)
+        column = ix * ny + iy
+        order = np.argsort(column, kind='stable')
+        self.column_triangles = triangle[order]
+        self.column_start = np.concatenate(([0], np.cumsum(np.bincount(column, minlength=nx * ny))))
+
+    def _column_pairs(self, columns):
+        # Return (index into columns, triangle) for every triangle
+        # overlapping each of the given columns.
+        starts = self.column_start[columns]
+        counts = self.column_start[columns + 1] - starts
+        which = np.repeat(np.arange(len(columns)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return (which, self.column_triangles[np.repeat(starts, counts) + local])
+
+    def _crossing_heights(self, xy, triangle):
+        # Return the height at which a vertical line through each xy crosses
+        # the corresponding triangle, or nan where it misses.
+        a = self.a[triangle]
+        ab = self.b[triangle] - a
+        ac = self.c[triangle] - a
+        ap = xy - a[:, :2]
+        det = ab[:, 0] * ac[:, 1] - ac[:, 0] * ab[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = (ap[:, 0] * ac[:, 1] - ac[:, 0] * ap[:, 1]) / det
+            v = (ab[:, 0] * ap[:, 1] - ap[:, 0] * ab[:, 1]) / det
+            hit = (det != 0) & (u >= 0) & (v >= 0) & (u + v <= 1)
+            z = a[:, 2] + u * ab[:, 2] + v * ac[:, 2]
+        return np.where(hit, z, np.nan)
+
+    def _build_grid(self, mesh):
+        (nx, ny, nz) = self.shape
+        size = self.size
+        # Sample each column slightly off its center, so that the diagonals of
+        # axis-aligned quads don't pass exactly through it and count twice.
+        columns = np.arange(nx * ny)
+        xy = (self.lo[:2] + size * np.stack(
+            (columns // ny + 0.5137, columns % ny + 0.5291), axis=1))
+        (which, triangle) = self._column_pairs(columns)
+        z = self._crossing_heights(xy[which], triangle)
+        crossed = ~np.isnan(z)
+        (which, z) = (which[crossed], z[crossed])
+        # A voxel is inside if an odd number of crossings are above its center.
+        below = np.clip(np.ceil((z - self.lo[2]) / size - 0.5), 0, nz).astype(np.int64)
+        counts = np.zeros((nx * ny, nz + 1), dtype=np.int64)
+        np.add.at(counts, (which, below), 1)
+        above = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        inside = ((above & 1) == 1).reshape(nx, ny, nz)
+
+        # Boundary voxels are any whose occupancy differs from a neighbour's,
+        # and any that the surface passes through.
+        boundary = np.zeros_like(inside)
+        for axis in range(3):
+            differs = np.diff(inside, axis=axis)
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis] = slice(None, -1)
+            upper[axis] = slice(1, None)
+            boundary[tuple(lower)] |= differs
+            boundary[tuple(upper)] |= differs
+        surface = SurfaceSampler(mesh)
+        area_per_voxel = surface.surface_area / (size * size)
+        surface_count = int(min(max(16 * area_per_voxel, 4096), 2**21))
+        surface_points = surface.sample(surface_count, np.random.RandomState(0))[0]
+        for points in (mesh.positions, surface_points):
+            boundary[self._voxel_index(points)] = True
+        crossing_k = np.clip(np.floor((z - self.lo[2]) / size).astype(np.int64), 0, nz - 1)
+        boundary[which // ny, which % ny, crossing_k] = True
+
+        candidates = (inside | boundary)
+        self.voxels = np.flatnonzero(candidates)
+        self.certain = (inside & ~boundary).ravel()[self.voxels]
+
+    def _voxel_index(self, points):
+        limit = np.array(self.shape) - 1
+        i = np.clip(np.floor((points - self.lo) / self.size).astype(np.int64), 0, limit)
+        return (i[:, 0], i[:, 1], i[:, 2])
+
+    def contains(self, points):
+        """Return a bool array: whether each point is inside the mesh.
+        Exact (up to float precision) for closed meshes."""
+        (ix, iy, iz) = self._voxel_index(points)
+        (which, triangle) = self._column_pairs(ix * self.shape[1] + iy)
+        z = self._crossing_heights(points[which, :2], triangle)
+        above = (z > points[which, 2])
+        crossings = np.bincount(which[above], minlength=len(points))
+        return ((crossings & 1) == 1)
+
+    def sample(self, count, rs):
+        if count <= 0:
+            return empty_points()
+        if self.open_edges:
+            raise SamplingError(f"Target is not closed: {self.open_edges} edges are not shared "
+                "by exactly two faces.")
+        if not len(self.voxels):
+            raise SamplingError("Target has no volume to sample.")
+        nx, ny, nz = self.shape
+        accepted = []
+        accepted_count = 0
+        acceptance = 1.0
+        attempts = 0
+        while accepted_count < count:
+            n = int((count - accepted_count) / acceptance * 1.1) + 16
+            pick = rs.randint(0, len(self.voxels), n)
+            offsets = rs.random_sample((n, 3))
+            voxel = self.voxels[pick]
+            index = np.stack((voxel // (ny * nz), (voxel // nz) % ny, voxel % nz), axis=1)
+            points = self.lo + (index + offsets) * self.size
+            keep = self.certain[pick]
+            uncertain = ~keep
+            keep[uncertain] = self.contains(points[uncertain])
+            points = points[keep]
+            accepted.append(points)
+            accepted_count += len(points)
+            acceptance = max(len(points) / n, 0.01)
+            attempts += 1
+            if attempts >= 64 and accepted_count == 0:
+                raise SamplingError("No points found inside the target. Is the mesh closed?")
+        vertices = np.concatenate(accepted)[:count].astype(np.float32)
+        # Interior points have no surface normal: point them away from the
+        # object's origin, like the rays of raycast_to_exterior().
+        lengths = np.sqrt((vertices ** 2).sum(axis=1))[:, np.newaxis]
+        normals = np.where(lengths > 0.0001, vertices / np.maximum(lengths, 0.0001),
+            np.array((0.0, 0.0, 1.0), dtype=np.float32)).astype(np.float32)
+        colors = coordinate_colors(vertices, self.halfwidth)
+        return (vertices, normals, colors)
+
+
+class SphereSampler:
+    """Sample points on the outside of a mesh, by casting rays at it from
+    random points on a sphere around it, towards its origin.
+
+    raycaster.ray_cast_many(origins, directions) must cast a whole batch of
+    rays, returning (hit, locations, normals, ...) arrays; by default it is a
+    bvh.TriangleBVH, which can be pickled. The sampler keeps track of
+    its hit rate, and sizes each batch to the number of hits it still needs.
+    If the rays keep missing (the object is hollow at the origin, say), it
+    gives up with a SamplingError once it has had miss_budget misses for
+    each point it was asked for."""
+
+    name = 'SPHERE'
+    miss_budget = 100
+    # Largest batch of rays to cast at once.
+    max_batch = 2**18
+
+    def __init__(self, mesh, raycaster=None, miss_budget=None):
+        self.mesh = mesh
+        self.raycaster = (raycaster or TriangleBVH.from_mesh(mesh))
+        if miss_budget is not None:
+            self.miss_budget = miss_budget
+        self.radius = bounding_radius(mesh.positions) + 0.1
+        self.rays_cast = 0
+        self.hits = 0
+
+    @property
+    def hit_rate(self):
+        # Starts out optimistic, before any rays have been cast.
+        return ((self.hits / self.rays_cast) if self.rays_cast else 1.0)
+
+    def sample(self, count, rs):
+        if count <= 0:
+            return empty_points()
+        results = []
+        hit_count = 0
+        miss_count = 0
+        max_misses = self.miss_budget * count
+        while hit_count < count:
+            n = int((count - hit_count) / max(self.hit_rate, 0.001) * 1.1) + 16
+            # Don't cast many more rays than the budget has room for.
+            n = min(n, self.max_batch, (max_misses - miss_count) + (count - hit_count))
+            # Random numbers are drawn in pairs, so the rays don't depend on
+            # the batch sizes, just on rs.
+            origins = sphere_surface_points(self.radius, rs.random_sample((n, 2)))
+            directions = -origins / self.radius
+            (hit, locations, normals) = self.raycaster.ray_cast_many(origins, directions)[:3]
+            hits = int(np.count_nonzero(hit))
+            self.rays_cast += n
+            self.hits += hits
+            hit_count += hits
+            miss_count += (n - hits)
+            results.append((locations[hit], normals[hit]))
+            if hit_count < count and miss_count > max_misses:
+                # count is just this call's share (usually a chunk) of
+                # the points being sampled, so report the rate instead.
+                raise SamplingError(
+                    f"Sphere sampling gave up: more than {self.miss_budget} rays missed the "
+                    f"target per point, with only {hit_count} of a batch of {count} points found.")
+        vertices = np.concatenate([r[0] for r in results])[:count].astype(np.float32)
+        normals = np.concatenate([r[1] for r in results])[:count].astype(np.float32)
+        colors = np.tile(np.array((1.0, 0.0, 1.0, 1.0), dtype=np.float32), (count, 1))
+        return (vertices, normals, colors)
+
+
+# Samplers by name.
+SAMPLERS = {cls.name: cls for cls in (SurfaceSampler, VolumeSampler, SphereSampler)}
+
+def create_sampler(name, mesh, miss_budget=None):
+    # Create the sampler with the given name from SAMPLERS for the mesh.
+    if name == 'SPHERE':
+        return SphereSampler(mesh, miss_budget=miss_budget)
+    return SAMPLERS[name](mesh)
+
+
+#---------------------------------------------------------------------------#
+# Deterministic sampling in chunks.
+#
+# Points are sampled in fixed-size chunks, each drawing from its own random
+# stream keyed by the seed and the chunk's index. So the points only depend
+# on the seed, and not on how the work is split into batches or processes.
+
+CHUNK_SIZE = 4096
+
+def chunk_random_state(seed, chunk_index):
+    # The key goes through the Mersenne Twister's init_by_array, so streams
+    # for neighbouring chunks (or seeds) are unrelated.
+    return np.random.RandomState([seed & 0xFFFFFFFF, chunk_index & 0xFFFFFFFF])
+
+def sample_range(sampler, seed, start, stop):
+    """Return points start to stop (exclusive) of everything sampler would
+    produce with seed, as a tuple (vertices, normals, colors).
+
+    Whole chunks are always sampled, and then sliced; so sampling a range is
+    exactly the same as sampling from 0 and slicing the result."""
+    if stop <= start:
+        return empty_points()
+    first_chunk = start // CHUNK_SIZE
+    end_chunk = (stop + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunks = [
+        sampler.sample(CHUNK_SIZE, chunk_random_state(seed, i))
+        for i in range(first_chunk, end_chunk)
+        ]
+    # A short chunk would shift every point after it.
+    for chunk in chunks:
+        if len(chunk[0]) != CHUNK_SIZE:
+            raise SamplingError(f"Sampler gave {len(chunk[0])} points for a chunk of {CHUNK_SIZE}.")
+    offset = first_chunk * CHUNK_SIZE
+    return tuple(
+        np.concatenate([chunk[i] for chunk in chunks])[(start - offset):(stop - offset)]
+        for i in range(3)
+        )
+
+
+def step_ranges(start, count, step_count):
+    """Yield (start, stop) ranges of about step_count points each, from
+    start to count. Each stop but the last falls on a chunk boundary, so
+    that sample_range() never samples a chunk for more than one step; only
+    a first step starting part way through a chunk samples all of it."""
+    while start < count:
+        stop = step_stop(start, step_count, count)
+        yield (start, stop)
+        start = stop
+
+def step_stop(start, size, count):
+    # Where a step of about size points from start should end: on the last
+    # chunk boundary it reaches, or the first one after start if it
+    # reaches none; and never after count.
+    stop = ((start + size) // CHUNK_SIZE) * CHUNK_SIZE
+    if stop <= start:
+        stop = (start // CHUNK_SIZE + 1) * CHUNK_SIZE
+    return min(stop, count)
+
+
+class StepScheduler:
+    """Sizes the steps of an incremental sampling job so that each takes
+    about budget seconds, from how long the previous steps took.
+
+    Steps are whole multiples of CHUNK_SIZE, as sample_range() always
+    samples whole chunks; so a step can't take less time than one chunk."""
+
+    # Steps grow by at most this factor at a time, in case the first ones
+    # were unusually cheap.
+    max_growth = 4
+
+    def __init__(self, budget, max_size=2**20):
+        self.budget = budget
+        self.max_size = max(CHUNK_SIZE, max_size)
+        self.size = CHUNK_SIZE
+        self.seconds_per_point = None
+
+    def record(self, points, seconds):
+        # Record that the last step sampled points in seconds.
+        if points <= 0:
+            return
+        rate = seconds / points
+        if (self.seconds_per_point is None) or (rate > self.seconds_per_point):
+            # Slow down straight away, so an overrun isn't repeated...
+            self.seconds_per_point = rate
+        else:
+            # ...but speed up gradually, as timings are noisy.
+            self.seconds_per_point = 0.5 * (self.seconds_per_point + rate)
+        size = self.budget / max(self.seconds_per_point, 1e-12)
+        size = min(size, self.max_growth * self.size, self.max_size)
+        self.size = max(CHUNK_SIZE, int(size) // CHUNK_SIZE * CHUNK_SIZE)
+
+
+#---------------------------------------------------------------------------#
+# Progressive ordering.
+#
+# Samples are stored in the order they were generated, which keeps them
+# prefix-stable. Any prefix of that order is already a uniform random
+# subsample; but random points clump, and leave gaps. For showing a subset
+# of the points, progressive_order() reorders them so that every prefix is
+# spread out evenly, cell by cell.
+
+def morton_codes(points, bits=10):
+    """Return uint64 Morton codes for points[n, 3], quantised to a grid of
+    2**bits cells on each side of their bounds."""
+    points = np.asarray(points, dtype=np.float64)
+    if not len(points):
+        return np.empty(0, dtype=np.uint64)
+    lo = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - lo, 1e-12)
+    cells = (1 << bits)
+    q = np.clip(((points - lo) / extent * cells).astype(np.int64), 0, cells - 1).astype(np.uint64)
+    codes = np.zeros(len(points), dtype=np.uint64)
+    for bit in range(bits):
+        for axis in range(3):
+            codes |= ((q[:, axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit + axis)
+    return codes
+
+def progressive_order(points, bits=10):
+    """Return a permutation of points[n, 3] such that every prefix of it
+    covers their bounds evenly.
+
+    Each point gets a level: the coarsest octree level at which it is the
+    first point (in the original order) in its cell. Points are ordered by
+    level, then by their original order; so a prefix has one point in every
+    occupied cell of some level, plus a random subset of the next."""
+    count = len(points)
+    codes = morton_codes(points, bits)
+    if not count:
+        return np.empty(0, dtype=np.int64)
+    by_cell = np.argsort(codes, kind='stable')
+    sorted_codes = codes[by_cell]
+    levels = np.full(count, bits + 1, dtype=np.int64)
+    for level in range(bits, -1, -1):
+        # Cells at this level are runs of codes that agree in the top bits;
+        # the first point in each is the one with the lowest index.
+        keys = sorted_codes >> np.uint64(3 * (bits - level))
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        levels[np.minimum.reduceat(by_cell, starts)] = level
+    return np.lexsort((np.arange(count), levels))
+
+
+#---------------------------------------------------------------------------#
+# Accumulating samples.
+
+class PointAccumulator:
+    """Float32 buffers for up to capacity points, allocated once and filled
+    in place as batches of samples arrive."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.vertices = np.empty((capacity, 3), dtype=np.float32)
+        self.normals = np.empty((capacity, 3), dtype=np.float32)
+        self.colors = np.empty((capacity, 4), dtype=np.float32)
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, data):
+        (vertices, normals, colors) = data
+        start = self.count
+        end = start + len(vertices)
+        if end > self.capacity:
+            raise ValueError(f"Too many points: {end} > {self.capacity}")
+        self.vertices[start:end] = vertices
+        self.normals[start:end] = normals
+        self.colors[start:end] = colors
+        self.count = end
+
+    def data(self):
+        # Views of the points so far; they are not copied, so they change if
+        # more points are added.
+        return (
+            self.vertices[:self.count],
+            self.normals[:self.count],
+            self.colors[:self.count],
+            )
+
+
+#---------------------------------------------------------------------------#
+# Caching samples.
+
+def sample_cache_key(mesh, sampler_class, count, seed):
+    return (mesh_digest(mesh), sampler_class.name, count, seed)
+
+def sample_series(key):
+    # A string naming the series of points that the sample_cache_key() key is
+    # a prefix of: since sample_range() is prefix-stable, that's everything
+    # in the key except the count.
+    (digest, sampler_name, count, seed) = key
+    return f"{digest}:{sampler_name}:{seed}"
+
+class SampleCache:
+    """Least-recently-used cache of sampled points, keyed by
+    sample_cache_key(), holding at most max_bytes of arrays."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        # Returns (vertices, normals, colors), or None.
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        # The arrays are kept as they are, not copied, so they mustn't be
+        # changed afterwards.
+        if key in self._entries:
+            self.size -= self._nbytes(self._entries.pop(key))
+        nbytes = self._nbytes(data)
+        if nbytes > self.max_bytes:
+            self._trim()
+            return
+        self._entries[key] = tuple(data)
+        self.size += nbytes
+        self._trim()
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _trim(self):
+        while self._entries and self.size > self.max_bytes:
+            (_, data) = self._entries.popitem(last=False)
+            self.size -= self._nbytes(data)
+
+    @staticmethod
+    def _nbytes(data):
+        return sum(a.nbytes for a in data)
+
+
+#---------------------------------------------------------------------------#
+# Sampling in worker processes.
+
+# The sampler each worker process samples from, set up when the worker
+# starts so that the mesh is only sent to each worker once.
+_worker_sampler = None
+
+def _init_worker(sampler):
+    global _worker_sampler
+    _worker_sampler = sampler
+
+def _sample_in_worker(seed, start, stop):
+    return sample_range(_worker_sampler, seed, start, stop)
+
+class BackgroundSampler:
+    """A pool of worker processes sampling batches of points from a sampler.
+
+    The sampler (and the mesh it holds) must be picklable; all the samplers
+    in this module are. mp_context is a multiprocessing context, which lets
+    callers choose how, and with which executable, workers are started."""
+
+    def __init__(self, sampler, workers=None, mp_context=None):
+        self.executor = ProcessPoolExecutor(
+            max_workers=(workers or None),
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(sampler,))
+        self.futures = []
+
+    def submit(self, seed, start, stop):
+        # Returns a Future of sample_range(sampler, seed, start, stop).
+        future = self.executor.submit(_sample_in_worker, seed, start, stop)
+        self.futures.append(future)
+        return future
+
+    def shutdown(self):
+        # Drop all outstanding work without waiting for it. Batches that are
+        # already running will finish, but they're small.
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,144 @@
+import hashlib
+import numpy as np
+import os
+import shutil
+
+from .utils import SHARED_FILE_PERMISSIONS, file_atomic
+
+# Nothing in this module may import bpy, bmesh or mathutils: it works on
+# plain arrays, so that it can also run outside of Blender.
+
+#---------------------------------------------------------------------------#
+# Raw data storage.
+#
+# Raw pointcloud buffers are kept out of the .blend, as .npy files named by
+# the hash of their contents. The .blend only stores the hashes; the buffers
+# are memory-mapped when they are first needed.
+
+def digest_of(a):
+    """Return the content hash used to name a float32 buffer."""
+    a = np.ascontiguousarray(a)
+    return hashlib.blake2b(memoryview(a), digest_size=16).hexdigest()
+
+
+class RawDataStore:
+    """Content-addressed store of float32 arrays.
+
+    New arrays go into `session_directory`, and gather() copies those that
+    a saved file refers to into `directory` (the sidecar directory next to
+    the .blend), so that the sidecar only changes when the file is saved.
+    Lookups search both."""
+
+    def __init__(self, session_directory):
+        self.directory = None
+        self.session_directory = session_directory
+        self._paths = {}
+        self._arrays = {}
+
+    def _filename(self, digest):
+        return digest + '.npy'
+
+    def put(self, a):
+        """Store the array a, and return its digest."""
+        a = np.ascontiguousarray(a, dtype=np.float32).ravel()
+        if not len(a):
+            return ""
+        digest = digest_of(a)
+        if self.locate(digest) is None:
+            os.makedirs(self.session_directory, exist_ok=True)
+            path = os.path.join(self.session_directory, self._filename(digest))
+            with file_atomic(path, 'wb', permissions=SHARED_FILE_PERMISSIONS) as f:
+                np.save(f, a)
+            self._paths[digest] = path
+        return digest
+
+    def get(self, digest):
+        """Return the array with the given digest, memory-mapped read-only;
+        or None if it can't be found."""
+        if not digest:
+            return np.empty(0, dtype=np.float32)
+        a = self._arrays.get(digest)
+        if a is None:
+            path = self.locate(digest)
+            if path is None:
+                return None
+            a = np.load(path, mmap_mode='r')
+            self._arrays[digest] = a
+        return a
+
+    def locate(self, digest):
+        """Return the path of the file holding digest, or None."""
+        path = self._paths.get(digest)
+        if (path is not None) and os.path.exists(path):
+            return path
+        for directory in (self.directory, self.session_directory):
+            if directory is None:
+                continue
+            path = os.path.join(directory, self._filename(digest))
+            if os.path.exists(path):
+                self._paths[digest] = path
+                return path
+        return None
+
+    def gather(self, digests):
+        """Make sure all of digests are in `directory`, copying them from
+        wherever they were last seen. Return the digests that couldn't be found."""
+        missing = []
+        os.makedirs(self.directory, exist_ok=True)
+        for digest in digests:
+            if not digest:
+                continue
+            path = os.path.join(self.directory, self._filename(digest))
+            if os.path.exists(path):
+                self._paths[digest] = path
+                continue
+            source = self.locate(digest)
+            if source is None:
+                missing.append(digest)
+                continue
+            with file_atomic(path, 'wb', permissions=SHARED_FILE_PERMISSIONS) as f, open(source, 'rb') as src:
+                shutil.copyfileobj(src, f)
+            self._paths[digest] = path
+        return missing
+
+    def evict(self, keep):
+        """Move everything in `directory` that is not in keep out to the
+        session directory, where it is still found (e.g. after an undo), but
+        doesn't clutter up the sidecar."""
+        if (self.directory is None) or (not os.path.isdir(self.directory)):
+            return
+        for filename in os.listdir(self.directory):
+            (digest, ext) = os.path.splitext(filename)
+            if ext != '.npy' or digest in keep:
+                continue
+            os.makedirs(self.session_directory, exist_ok=True)
+            self._arrays.pop(digest, None)
+            self._paths.pop(digest, None)
+            try:
+                shutil.move(os.path.join(self.directory, filename),
+                    os.path.join(self.session_directory, filename))
+            except OSError:
+                # Probably still mapped on Windows; it'll go next time.
+                pass
+
+    def prune(self, keep):
+        """Delete everything in `session_directory` that is not in keep."""
+        if not os.path.isdir(self.session_directory):
+            return
+        for filename in os.listdir(self.session_directory):
+            (digest, ext) = os.path.splitext(filename)
+            if ext != '.npy' or digest in keep:
+                continue
+            self._arrays.pop(digest, None)
+            self._paths.pop(digest, None)
+            try:
+                os.remove(os.path.join(self.session_directory, filename))
+            except OSError:
+                # Probably still mapped on Windows; it'll go next time.
+                pass
+
+    def remove_session_directory(self):
+        """Delete `session_directory` and everything in it."""
+        self._arrays.clear()
+        self._paths.clear()
+        shutil.rmtree(self.session_directory, ignore_errors=True)
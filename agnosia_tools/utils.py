@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+
+@contextmanager
+def tempfile(suffix='', dir=None):
+    """ Context for temporary file.
+
+    Will find a free temporary filename upon entering
+    and will try to delete the file on leaving, even in case of an exception.
+
+    Parameters
+    ----------
+    suffix : string
+        optional file suffix
+    dir : string
+        optional directory to save temporary file in
+    """
+    # From: https://stackoverflow.com/a/29491523
+    import os
+    import tempfile as tmp
+
+    tf = tmp.NamedTemporaryFile(delete=False, suffix=suffix, dir=dir)
+    tf.file.close()
+    try:
+        yield tf.name
+    finally:
+        try:
+            os.remove(tf.name)
+        except OSError as e:
+            if e.errno == 2:
+                pass
+            else:
+                raise
+
+# Permissions for files that other people need to read, such as those on a
+# shared project drive. Temporary files are otherwise only readable by us.
+SHARED_FILE_PERMISSIONS = 0o644
+
+@contextmanager
+def file_atomic(filepath, *args, **kwargs):
+    """ Open temporary file object that atomically moves to destination upon
+    exiting.
+
+    Allows reading and writing to and from the same filename.
+
+    The file will not be moved to destination in case of an exception.
+
+    Parameters
+    ----------
+    filepath : string
+        the file path to be opened
+    fsync : bool
+        whether to force write the file to disk
+    permissions : int
+        optional permissions for the file, which is otherwise private
+    *args : mixed
+        Any valid arguments for :code:`open`
+    **kwargs : mixed
+        Any valid keyword arguments for :code:`open`
+    """
+    # From: https://stackoverflow.com/a/29491523
+    import os
+    fsync = kwargs.pop('fsync', False)
+    permissions = kwargs.pop('permissions', None)
+
+    with tempfile(dir=os.path.dirname(os.path.abspath(filepath))) as tmppath:
+        if permissions is not None:
+            os.chmod(tmppath, permissions)
+        with open(tmppath, *args, **kwargs) as file:
+            try:
+                yield file
+            finally:
+                if fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+        os.replace(tmppath, filepath)
\ No newline at end of file
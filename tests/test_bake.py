@@ -0,0 +1,116 @@
+import numpy as np
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from agnosia_tools.bake import _bake_job, read_mesh, read_npz, read_obj, read_ply
+
+
+# A unit square in z = 0, as two triangles.
+SQUARE_POSITIONS = np.array(((0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)), dtype=np.float32)
+SQUARE_TRIANGLES = np.array(((0, 1, 2), (0, 2, 3)))
+
+PLY_HEADER = """ply
+format {format} 1.0
+element vertex 4
+property float x
+property float y
+property float z
+element face 2
+property list uchar int vertex_indices
+end_header
+"""
+
+
+class MeshReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, ('wb' if isinstance(data, bytes) else 'w')) as f:
+            f.write(data)
+        return path
+
+    def assert_square(self, mesh):
+        np.testing.assert_array_equal(mesh.positions, SQUARE_POSITIONS)
+        np.testing.assert_array_equal(mesh.triangles, SQUARE_TRIANGLES)
+        np.testing.assert_array_equal(mesh.normals, [(0, 0, 1), (0, 0, 1)])
+
+    def ascii_ply(self):
+        body = ''.join('%g %g %g\n' % tuple(p) for p in SQUARE_POSITIONS)
+        return PLY_HEADER.format(format='ascii') + body + "3 0 1 2\n3 0 2 3\n"
+
+    def binary_ply(self):
+        body = SQUARE_POSITIONS.astype('<f4').tobytes()
+        for triangle in SQUARE_TRIANGLES:
+            body += struct.pack('<B3i', 3, *triangle)
+        return PLY_HEADER.format(format='binary_little_endian').encode('ascii') + body
+
+    def test_obj(self):
+        # A quad, fanned into the same two triangles; with y up, so that
+        # it comes out in z = 0.
+        path = self.write('square.obj',
+            "v 0 0 0\nv 1 0 0\nv 1 0 -1\nv 0 0 -1\nf 1/1/1 2/2/1 3/3/1 -1/4/1\n")
+        self.assert_square(read_obj(path))
+        self.assert_square(read_mesh(path))
+
+    def test_obj_keep_axes(self):
+        path = self.write('square.obj', "v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3\nf 1 3 4\n")
+        self.assert_square(read_obj(path, y_up=False))
+
+    def test_ply_ascii(self):
+        self.assert_square(read_ply(self.write('square.ply', self.ascii_ply())))
+
+    def test_ply_binary(self):
+        self.assert_square(read_ply(self.write('square.ply', self.binary_ply())))
+
+    def test_npz(self):
+        path = os.path.join(self.directory, 'square.npz')
+        np.savez(path, positions=SQUARE_POSITIONS, triangles=SQUARE_TRIANGLES)
+        self.assert_square(read_npz(path))
+
+    def test_bad_files_raise_value_error(self):
+        ascii_ply = self.ascii_ply()
+        binary_ply = self.binary_ply()
+        bad = {
+            'truncated_ascii.ply': ascii_ply[:-10],
+            'truncated_binary.ply': binary_ply[:-5],
+            'truncated_header.ply': ascii_ply[:30],
+            'no_count.ply': ascii_ply.replace('element vertex 4', 'element vertex'),
+            'bad_type.ply': ascii_ply.replace('property float x', 'property quad x'),
+            'bad_format.ply': ascii_ply.replace('format ascii', 'format morse'),
+            'not.ply': "hello\n",
+            'short_vertex.obj': "v 0 0\nf 1 1 1\n",
+            'bad_index.obj': "v 0 0 0\nv 1 0 0\nf 1 2 3\n",
+            'bad_number.obj': "v 0 zero 0\n",
+            'missing_arrays.npz': None,
+            'unknown.stl': "solid\n",
+            }
+        for (name, data) in bad.items():
+            if data is None:
+                path = os.path.join(self.directory, name)
+                np.savez(path, points=SQUARE_POSITIONS)
+            else:
+                path = self.write(name, data)
+            with self.subTest(name=name):
+                with self.assertRaises(ValueError):
+                    read_mesh(path)
+
+    def test_bake_job_reports_errors(self):
+        source = self.write('broken.ply', self.ascii_ply()[:-10])
+        settings = {'count': 16, 'seed': 0, 'sampler': 'SURFACE', 'miss_budget': 64, 'y_up': True}
+        (name, count, error, seconds) = _bake_job(source,
+            os.path.join(self.directory, 'broken.bin'), settings, False)
+        self.assertIsNone(count)
+        self.assertIn("Truncated", error)
+
+
+if __name__ == '__main__':
+    unittest.main()
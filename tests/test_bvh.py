@@ -0,0 +1,79 @@
+import numpy as np
+import unittest
+
+from agnosia_tools.bvh import TriangleBVH
+
+
+def brute_force_ray_cast(positions, triangles, origins, directions):
+    # Moller-Trumbore against every triangle, one ray at a time. Returns
+    # (indices, distances) of the closest hits, with -1 and inf for misses.
+    a = positions[triangles[:, 0]]
+    ab = positions[triangles[:, 1]] - a
+    ac = positions[triangles[:, 2]] - a
+    indices = np.full(len(origins), -1)
+    distances = np.full(len(origins), np.inf)
+    for (i, (origin, direction)) in enumerate(zip(origins, directions)):
+        p = np.cross(direction, ac)
+        det = (ab * p).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv = 1.0 / det
+            s = origin - a
+            u = (s * p).sum(axis=1) * inv
+            q = np.cross(s, ab)
+            v = (q * direction).sum(axis=1) * inv
+            t = (q * ac).sum(axis=1) * inv
+        ok = ((np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0))
+        if ok.any():
+            t = np.where(ok, t, np.inf)
+            indices[i] = int(np.argmin(t))
+            distances[i] = t[indices[i]]
+    return (indices, distances)
+
+
+class TriangleBVHTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        # A soup of small random triangles in a box.
+        centers = rs.uniform(-1, 1, (500, 1, 3))
+        self.positions = (centers + rs.uniform(-0.1, 0.1, (500, 3, 3))).reshape(-1, 3)
+        self.triangles = np.arange(len(self.positions)).reshape(-1, 3)
+        # Rays from outside the box, half of them aimed at a triangle so
+        # that plenty hit.
+        self.origins = rs.normal(size=(400, 3))
+        self.origins *= (3.0 / np.sqrt((self.origins ** 2).sum(axis=1)))[:, np.newaxis]
+        targets = np.where((np.arange(400) % 2 == 0)[:, np.newaxis],
+            self.positions[self.triangles[rs.randint(0, 500, 400)]].mean(axis=1),
+            rs.uniform(-1, 1, (400, 3)))
+        self.directions = targets - self.origins
+        self.directions /= np.sqrt((self.directions ** 2).sum(axis=1))[:, np.newaxis]
+
+    def test_ray_cast_many_matches_brute_force(self):
+        bvh = TriangleBVH(self.positions, self.triangles)
+        (hit, locations, normals, indices, distances) = bvh.ray_cast_many(
+            self.origins, self.directions)
+        (expected_indices, expected_distances) = brute_force_ray_cast(
+            self.positions, self.triangles, self.origins, self.directions)
+        self.assertGreater(np.count_nonzero(hit), 100)
+        np.testing.assert_array_equal(hit, expected_indices >= 0)
+        np.testing.assert_array_equal(indices, expected_indices)
+        np.testing.assert_allclose(distances[hit], expected_distances[hit], rtol=1e-9)
+        np.testing.assert_allclose(locations[hit],
+            self.origins[hit] + self.directions[hit] * expected_distances[hit, np.newaxis],
+            atol=1e-9)
+
+    def test_ray_cast_distance_limit(self):
+        bvh = TriangleBVH(self.positions, self.triangles)
+        (hit, locations, normals, indices, distances) = bvh.ray_cast_many(
+            self.origins, self.directions, distance=2.5)
+        (expected_indices, expected_distances) = brute_force_ray_cast(
+            self.positions, self.triangles, self.origins, self.directions)
+        np.testing.assert_array_equal(hit, expected_distances <= 2.5)
+
+    def test_ray_cast_miss(self):
+        bvh = TriangleBVH(self.positions, self.triangles)
+        self.assertEqual(bvh.ray_cast((0.0, 0.0, 5.0), (0.0, 0.0, 1.0)), (None, None, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+from agnosia_tools.formats import (PLY_RECORD_DTYPE, PointcloudBin2Writer, PointcloudBinReader,
+    PointcloudBinWriter, PointcloudPlyWriter, bin_tiles, colors_to_uint8, pack_records,
+    tiled_manifest_path, write_tiled_bin)
+
+
+def random_points(count, seed=0):
+    rs = np.random.RandomState(seed)
+    vertices = rs.uniform(-5, 5, (count, 3)).astype(np.float32)
+    normals = rs.normal(size=(count, 3))
+    normals /= np.sqrt((normals ** 2).sum(axis=1))[:, np.newaxis]
+    colors = rs.uniform(0, 1, (count, 4)).astype(np.float32)
+    return (vertices, normals.astype(np.float32), colors)
+
+
+class PointcloudBinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'points.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_colors_equal(self, colors, expected):
+        np.testing.assert_array_equal(
+            np.rint(colors[:, :3] * 255).astype(np.uint8), colors_to_uint8(expected[:, :3]))
+        np.testing.assert_array_equal(colors[:, 3], 1.0)
+
+    def test_v1_round_trip(self):
+        (vertices, normals, colors) = random_points(10000)
+        with PointcloudBinWriter(self.filename) as f:
+            f.write_records(pack_records(vertices[:1000], colors[:1000]))
+            f.write_records(pack_records(vertices[1000:], colors[1000:]))
+        with PointcloudBinReader(self.filename) as r:
+            self.assertEqual((r.version, r.count, r.has_normals), (1, 10000, False))
+            (v, n, c) = r.read()
+        np.testing.assert_array_equal(v, vertices)
+        self.assertIsNone(n)
+        self.assert_colors_equal(c, colors)
+
+    def test_v2_round_trip(self):
+        (vertices, normals, colors) = random_points(10000)
+        lo = vertices.min(axis=0)
+        hi = vertices.max(axis=0)
+        for compress in (False, True):
+            with PointcloudBin2Writer(self.filename, lo, hi, compress=compress, block_size=4096) as f:
+                f.write(vertices[:1000], normals[:1000], colors[:1000])
+                f.write(vertices[1000:], normals[1000:], colors[1000:])
+            with PointcloudBinReader(self.filename) as r:
+                self.assertEqual((r.version, r.count, r.has_normals), (2, 10000, True))
+                self.assertEqual(len(r.block_table), 3)
+                (v, n, c) = r.read()
+            # Positions are quantised to 1/65535 of the bounds.
+            np.testing.assert_allclose(v, vertices, atol=float((hi - lo).max()) / 65535)
+            # 8-bit octahedral normals are good to about a degree.
+            cosines = (n * normals).sum(axis=1)
+            self.assertGreater(cosines.min(), np.cos(np.radians(1.5)))
+            self.assert_colors_equal(c, colors)
+
+    def test_v2_without_normals(self):
+        (vertices, normals, colors) = random_points(100)
+        with PointcloudBin2Writer(self.filename, vertices.min(axis=0), vertices.max(axis=0),
+                normals=False) as f:
+            f.write(vertices, None, colors)
+        with PointcloudBinReader(self.filename) as r:
+            (v, n, c) = r.read()
+        self.assertEqual(len(v), 100)
+        self.assertIsNone(n)
+
+    def test_empty(self):
+        with PointcloudBinWriter(self.filename) as f:
+            pass
+        with PointcloudBinReader(self.filename) as r:
+            self.assertEqual(r.read()[0].shape, (0, 3))
+        with PointcloudBin2Writer(self.filename, (0, 0, 0), (0, 0, 0)) as f:
+            pass
+        with PointcloudBinReader(self.filename) as r:
+            self.assertEqual(r.read()[0].shape, (0, 3))
+
+    def test_atomic_write_keeps_old_file_on_error(self):
+        (vertices, normals, colors) = random_points(100)
+        with PointcloudBinWriter(self.filename) as f:
+            f.write_records(pack_records(vertices, colors))
+        with open(self.filename, 'rb') as f:
+            before = f.read()
+        with self.assertRaises(RuntimeError):
+            with PointcloudBinWriter(self.filename, atomic=True) as f:
+                f.write_records(pack_records(vertices[:10], colors[:10]))
+                raise RuntimeError()
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(os.listdir(self.directory), ['points.bin'])
+
+
+class TiledBinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'points.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bin_tiles(self):
+        vertices = np.array([(0.5, 0, 0), (2.5, 0, 0), (0.25, 0.5, 0.75), (2.9, 1.5, 0), (1.0, 0, 0)])
+        (order, origin, grid, tiles) = bin_tiles(vertices, 1.0)
+        np.testing.assert_array_equal(origin, (0.25, 0, 0))
+        np.testing.assert_array_equal(grid, (3, 2, 1))
+        # Grouped by tile, in their original order within each.
+        np.testing.assert_array_equal(order, (0, 2, 4, 1, 3))
+        self.assertEqual(tiles, [([0, 0, 0], 0, 3), ([2, 0, 0], 3, 1), ([2, 1, 0], 4, 1)])
+        (order, origin, grid, tiles) = bin_tiles(np.empty((0, 3)), 1.0)
+        self.assertEqual((len(order), tiles), (0, []))
+        with self.assertRaises(ValueError):
+            bin_tiles(vertices, 0)
+
+    def test_manifest_matches_file(self):
+        (vertices, normals, colors) = random_points(5000)
+        manifest = write_tiled_bin(self.filename, vertices, colors, 2.5, batch_size=1000)
+        with open(tiled_manifest_path(self.filename)) as f:
+            self.assertEqual(json.load(f), manifest)
+        self.assertEqual((manifest['file'], manifest['count'], manifest['grid']),
+            ('points.bin', 5000, [4, 4, 4]))
+        with PointcloudBinReader(self.filename) as r:
+            (v, n, c) = r.read()
+        self.assertEqual(sum(t['count'] for t in manifest['tiles']), 5000)
+        # The tiles are contiguous runs of the file, in order.
+        offset = manifest['header_size']
+        for tile in manifest['tiles']:
+            self.assertEqual(tile['offset'], offset)
+            offset += tile['count'] * manifest['record_size']
+            start = (tile['offset'] - manifest['header_size']) // manifest['record_size']
+            points = v[start:start + tile['count']]
+            np.testing.assert_array_equal(points.min(axis=0), np.float32(tile['min']))
+            np.testing.assert_array_equal(points.max(axis=0), np.float32(tile['max']))
+            cells = np.floor((points - np.array(manifest['origin'])) / manifest['tile_size'])
+            self.assertTrue((cells == tile['index']).all())
+        self.assertEqual(offset, os.path.getsize(self.filename))
+        # The same points, just reordered.
+        np.testing.assert_array_equal(np.unique(v, axis=0), np.unique(vertices, axis=0))
+
+
+class PointcloudPlyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'points.ply')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        end = data.index(b'end_header\n') + len(b'end_header\n')
+        return (data[:end].decode('ascii').splitlines(), np.frombuffer(data[end:], dtype=PLY_RECORD_DTYPE))
+
+    def test_header_and_body(self):
+        (vertices, normals, colors) = random_points(1000)
+        with PointcloudPlyWriter(self.filename, 1000, atomic=True) as f:
+            f.write(vertices[:300], normals[:300], colors[:300])
+            f.write(vertices[300:], normals[300:], colors[300:])
+        (header, records) = self.read()
+        self.assertEqual(header, [
+            'ply',
+            'format binary_little_endian 1.0',
+            'element vertex 1000',
+            'property float x', 'property float y', 'property float z',
+            'property float nx', 'property float ny', 'property float nz',
+            'property uchar red', 'property uchar green', 'property uchar blue',
+            'end_header',
+            ])
+        self.assertEqual(len(records), 1000)
+        np.testing.assert_array_equal(np.stack([records[a] for a in ('x', 'y', 'z')], axis=1), vertices)
+        np.testing.assert_array_equal(np.stack([records[a] for a in ('nx', 'ny', 'nz')], axis=1), normals)
+        np.testing.assert_array_equal(np.stack([records[a] for a in ('red', 'green', 'blue')], axis=1),
+            colors_to_uint8(colors[:, :3]))
+
+    def test_empty(self):
+        with PointcloudPlyWriter(self.filename, 0) as f:
+            pass
+        (header, records) = self.read()
+        self.assertIn('element vertex 0', header)
+        self.assertEqual(len(records), 0)
+
+    def test_count_mismatch_raises(self):
+        (vertices, normals, colors) = random_points(100)
+        with self.assertRaises(ValueError):
+            with PointcloudPlyWriter(self.filename, 100, atomic=True) as f:
+                f.write(vertices[:50], normals[:50], colors[:50])
+        self.assertEqual(os.listdir(self.directory), [])
+        with self.assertRaises(ValueError):
+            with PointcloudPlyWriter(self.filename, 50, atomic=True) as f:
+                f.write(vertices, normals, colors)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+import multiprocessing
+import numpy as np
+import unittest
+
+from agnosia_tools.sampling import (CHUNK_SIZE, BackgroundSampler, SampleCache, SamplingError,
+    SphereSampler, StepScheduler, SurfaceSampler, TriangleMesh, VolumeSampler, chunk_random_state, open_edge_count, progressive_order,
+    sample_range,
+    step_ranges)
+
+
+def cube_mesh(halfwidth=1.0):
+    # A closed cube of 12 triangles, wound outwards.
+    h = halfwidth
+    positions = np.array([(x, y, z) for x in (-h, h) for y in (-h, h) for z in (-h, h)],
+        dtype=np.float32)
+    quads = ((0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3))
+    triangles = np.array([tri for (a, b, c, d) in quads for tri in ((a, b, c), (a, c, d))],
+        dtype=np.int32)
+    a = positions[triangles[:, 0]]
+    normals = np.cross(positions[triangles[:, 1]] - a, positions[triangles[:, 2]] - a)
+    normals /= np.sqrt((normals ** 2).sum(axis=1))[:, np.newaxis]
+    return TriangleMesh(positions, triangles, normals.astype(np.float32))
+
+
+class SampleRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sampler = SurfaceSampler(cube_mesh())
+
+    def assert_points_equal(self, a, b):
+        for (x, y) in zip(a, b):
+            np.testing.assert_array_equal(x, y)
+
+    def test_chunks_depend_only_on_seed_and_index(self):
+        a = self.sampler.sample(CHUNK_SIZE, chunk_random_state(7, 3))
+        b = self.sampler.sample(CHUNK_SIZE, chunk_random_state(7, 3))
+        c = self.sampler.sample(CHUNK_SIZE, chunk_random_state(7, 4))
+        d = self.sampler.sample(CHUNK_SIZE, chunk_random_state(8, 3))
+        self.assert_points_equal(a, b)
+        self.assertFalse(np.array_equal(a[0], c[0]))
+        self.assertFalse(np.array_equal(a[0], d[0]))
+
+    def test_prefix_stable(self):
+        count = 3 * CHUNK_SIZE + 100
+        everything = sample_range(self.sampler, 7, 0, count)
+        self.assertEqual([len(a) for a in everything], [count] * 3)
+        # Any prefix is the same as sampling that many points.
+        self.assert_points_equal(sample_range(self.sampler, 7, 0, 1000),
+            [a[:1000] for a in everything])
+
+    def test_batches_match_serial(self):
+        count = 3 * CHUNK_SIZE + 100
+        everything = sample_range(self.sampler, 7, 0, count)
+        for step in (1000, CHUNK_SIZE, 5000):
+            batches = [sample_range(self.sampler, 7, start, min(start + step, count))
+                for start in range(0, count, step)]
+            self.assert_points_equal([np.concatenate(a) for a in zip(*batches)], everything)
+
+    def test_pool_matches_serial(self):
+        count = 3 * CHUNK_SIZE + 100
+        everything = sample_range(self.sampler, 7, 0, count)
+        pool = BackgroundSampler(self.sampler, 2, multiprocessing.get_context('spawn'))
+        try:
+            futures = [pool.submit(7, start, min(start + 5000, count))
+                for start in range(0, count, 5000)]
+            batches = [future.result(timeout=60) for future in futures]
+        finally:
+            pool.shutdown()
+        self.assert_points_equal([np.concatenate(a) for a in zip(*batches)], everything)
+
+    def test_short_chunks_raise(self):
+        class ShortSampler:
+            def sample(self, count, rs):
+                return tuple(a[:count - 1] for a in sampler.sample(count, rs))
+        sampler = self.sampler
+        with self.assertRaises(SamplingError):
+            sample_range(ShortSampler(), 7, 0, 10)
+        with self.assertRaises(SamplingError):
+            sample_range(SurfaceSampler(TriangleMesh(np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int32),
+                np.zeros((0, 3)))), 7, 0, 10)
+
+
+class VolumeSamplerTest(unittest.TestCase):
+
+    def test_points_are_inside(self):
+        sampler = VolumeSampler(cube_mesh(0.5))
+        (vertices, normals, colors) = sampler.sample(10000, np.random.RandomState(0))
+        self.assertEqual(vertices.shape, (10000, 3))
+        self.assertLessEqual(np.abs(vertices).max(), 0.5)
+        # Spread through the whole volume, not just near the surface.
+        self.assertLess(np.abs(vertices).max(axis=1).min(), 0.1)
+        self.assertTrue(sampler.contains(vertices).all())
+        self.assertFalse(sampler.contains(np.array([(0.0, 0.0, 0.6), (0.7, 0.0, 0.0)])).any())
+
+    def test_open_mesh_raises(self):
+        cube = cube_mesh()
+        self.assertEqual(open_edge_count(cube), 0)
+        # Without its last face the cube is open, with four edges around the hole.
+        (positions, triangles, normals) = cube
+        box = TriangleMesh(positions, triangles[:-2], normals[:-2])
+        self.assertEqual(open_edge_count(box), 4)
+        with self.assertRaises(SamplingError):
+            VolumeSampler(box).sample(100, np.random.RandomState(0))
+        # A second cube sharing an edge with the first makes that edge
+        # non-manifold.
+        (other, _, _) = cube_mesh()
+        other = other + np.array((2.0, 2.0, 0.0), dtype=np.float32)
+        two = TriangleMesh(np.concatenate((positions, other)),
+            np.concatenate((triangles, triangles + 8)), np.concatenate((normals, normals)))
+        self.assertEqual(open_edge_count(two), 1)
+        with self.assertRaises(SamplingError):
+            VolumeSampler(two).sample(100, np.random.RandomState(0))
+
+    def test_split_vertices_are_welded(self):
+        (positions, triangles, normals) = cube_mesh()
+        # One vertex per corner of every triangle, as if every face had its
+        # own normals.
+        split = TriangleMesh(positions[triangles.ravel()],
+            np.arange(3 * len(triangles), dtype=np.int32).reshape(-1, 3), normals)
+        self.assertEqual(open_edge_count(split), 0)
+
+
+class SphereSamplerTest(unittest.TestCase):
+
+    def test_points_are_on_the_outside(self):
+        sampler = SphereSampler(cube_mesh())
+        (vertices, normals, colors) = sampler.sample(1000, np.random.RandomState(0))
+        self.assertEqual(vertices.shape, (1000, 3))
+        np.testing.assert_allclose(np.abs(vertices).max(axis=1), 1.0, rtol=1e-5)
+        self.assertGreater(sampler.hit_rate, 0.1)
+
+    def test_miss_budget(self):
+        # A tiny triangle far from the origin: nearly every ray misses it.
+        positions = np.array(((5, 0, 0), (5, 0.01, 0), (5, 0, 0.01)), dtype=np.float32)
+        mesh = TriangleMesh(positions, np.array(((0, 1, 2),), dtype=np.int32),
+            np.array(((-1, 0, 0),), dtype=np.float32))
+        sampler = SphereSampler(mesh, miss_budget=10)
+        with self.assertRaises(SamplingError) as cm:
+            sampler.sample(100, np.random.RandomState(0))
+        self.assertIn("more than 10 rays missed", str(cm.exception))
+        # It gives up once the budget is spent, without casting many more.
+        self.assertLess(sampler.rays_cast, 10 * 100 + 200)
+        # The same applies to each chunk of a range.
+        with self.assertRaises(SamplingError):
+            sample_range(SphereSampler(mesh, miss_budget=10), 7, 0, 10)
+
+
+class StepRangesTest(unittest.TestCase):
+
+    def test_steps_end_on_chunk_boundaries(self):
+        self.assertEqual(list(step_ranges(1024, 3 * CHUNK_SIZE + 5, CHUNK_SIZE)), [
+            (1024, CHUNK_SIZE),
+            (CHUNK_SIZE, 2 * CHUNK_SIZE),
+            (2 * CHUNK_SIZE, 3 * CHUNK_SIZE),
+            (3 * CHUNK_SIZE, 3 * CHUNK_SIZE + 5),
+            ])
+        # Steps smaller than a chunk still take a whole chunk at a time.
+        self.assertEqual(list(step_ranges(0, 2 * CHUNK_SIZE, 100)),
+            [(0, CHUNK_SIZE), (CHUNK_SIZE, 2 * CHUNK_SIZE)])
+        self.assertEqual(list(step_ranges(10, 10, CHUNK_SIZE)), [])
+
+    def test_each_chunk_is_sampled_once(self):
+        # Except the one the first step starts part way through, which
+        # was partly sampled before.
+        for (start, count, step) in ((1024, 100000, CHUNK_SIZE), (1024, 100000, 10000),
+                (0, 50000, 3 * CHUNK_SIZE), (5000, 6000, 100)):
+            chunks = []
+            for (a, b) in step_ranges(start, count, step):
+                chunks.extend(range(a // CHUNK_SIZE, (b + CHUNK_SIZE - 1) // CHUNK_SIZE))
+            expected = list(range(start // CHUNK_SIZE, (count + CHUNK_SIZE - 1) // CHUNK_SIZE))
+            self.assertEqual(chunks, expected)
+
+
+class SampleCacheTest(unittest.TestCase):
+
+    def points(self, count):
+        return (np.zeros((count, 3), dtype=np.float32), np.zeros((count, 3), dtype=np.float32),
+            np.zeros((count, 4), dtype=np.float32))
+
+    def test_least_recently_used_is_evicted(self):
+        # 10 points take 400 bytes.
+        cache = SampleCache(1000)
+        cache.put('a', self.points(10))
+        cache.put('b', self.points(10))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', self.points(10))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual((len(cache), cache.size), (2, 800))
+
+    def test_replacing_and_oversized_entries(self):
+        cache = SampleCache(1000)
+        cache.put('a', self.points(10))
+        cache.put('a', self.points(5))
+        self.assertEqual((len(cache), cache.size), (1, 200))
+        # Too big to keep at all: it doesn't push anything else out.
+        cache.put('b', self.points(100))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 1)
+        cache.max_bytes = 100
+        cache.put('c', self.points(1))
+        self.assertEqual((len(cache), cache.size), (1, 40))
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class StepSchedulerTest(unittest.TestCase):
+
+    def test_starts_with_one_chunk(self):
+        scheduler = StepScheduler(0.1)
+        self.assertEqual(scheduler.size, CHUNK_SIZE)
+        # Nothing sampled tells it nothing.
+        scheduler.record(0, 1.0)
+        self.assertEqual(scheduler.size, CHUNK_SIZE)
+
+    def test_grows_gradually_to_the_budget(self):
+        # A point takes 1us, so the budget fits 100000 points.
+        scheduler = StepScheduler(0.1)
+        sizes = []
+        for _ in range(6):
+            scheduler.record(scheduler.size, scheduler.size * 1e-6)
+            sizes.append(scheduler.size)
+        self.assertEqual(sizes[:2], [4 * CHUNK_SIZE, 16 * CHUNK_SIZE])
+        self.assertEqual(sizes[-1], 100000 // CHUNK_SIZE * CHUNK_SIZE)
+        for (a, b) in zip([CHUNK_SIZE] + sizes, sizes):
+            self.assertLessEqual(b, 4 * a)
+
+    def test_shrinks_straight_away(self):
+        scheduler = StepScheduler(0.1)
+        for _ in range(4):
+            scheduler.record(scheduler.size, scheduler.size * 1e-6)
+        # One slow step, ten times slower: the next fits the budget at that rate.
+        scheduler.record(scheduler.size, scheduler.size * 1e-5)
+        self.assertEqual(scheduler.size, 10000 // CHUNK_SIZE * CHUNK_SIZE)
+        # However slow, a step is still at least one chunk.
+        scheduler.record(CHUNK_SIZE, 10.0)
+        self.assertEqual(scheduler.size, CHUNK_SIZE)
+
+    def test_sizes_are_whole_chunks_up_to_max_size(self):
+        scheduler = StepScheduler(1.0, max_size=300000)
+        for seconds in (1e-3, 1e-4, 1e-2, 1e-5, 1e-6, 1e-6, 1e-6):
+            scheduler.record(scheduler.size, seconds)
+            self.assertEqual(scheduler.size % CHUNK_SIZE, 0)
+            self.assertGreaterEqual(scheduler.size, CHUNK_SIZE)
+            self.assertLessEqual(scheduler.size, 300000)
+        self.assertEqual(scheduler.size, 300000 // CHUNK_SIZE * CHUNK_SIZE)
+
+
+class ProgressiveOrderTest(unittest.TestCase):
+
+    def test_is_a_permutation(self):
+        rs = np.random.RandomState(0)
+        for points in (rs.uniform(-1, 1, (5000, 3)), np.zeros((100, 3)), rs.uniform(0, 1, (1, 3)),
+                np.concatenate((rs.uniform(0, 1, (50, 3)),) * 3)):
+            with self.subTest(count=len(points)):
+                order = progressive_order(points)
+                np.testing.assert_array_equal(np.sort(order), np.arange(len(points)))
+        self.assertEqual(len(progressive_order(np.empty((0, 3)))), 0)
+
+    def test_prefixes_are_spread_out(self):
+        # Clumped points: most of them in one corner of the bounds.
+        rs = np.random.RandomState(0)
+        points = np.concatenate((rs.uniform(0, 0.1, (9000, 3)), rs.uniform(0, 1, (1000, 3))))
+        rs.shuffle(points)
+        order = progressive_order(points, bits=3)
+        # The first point is the first in original order.
+        self.assertEqual(order[0], 0)
+        # Then comes the first point in each of the other octants of the bounds.
+        octants = {tuple(p) for p in (points[order[:8]] >= points.min(axis=0)
+            + 0.5 * (points.max(axis=0) - points.min(axis=0)))}
+        self.assertEqual(len(octants), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import numpy as np
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from agnosia_tools.storage import RawDataStore, digest_of
+
+
+class RawDataStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.session = os.path.join(self.root, 'session')
+        self.sidecar = os.path.join(self.root, 'level_pointclouds')
+        self.store = RawDataStore(self.session)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def files(self, directory):
+        if not os.path.isdir(directory):
+            return set()
+        return set(os.listdir(directory))
+
+    def test_put_and_get(self):
+        a = np.arange(12, dtype=np.float32)
+        digest = self.store.put(a)
+        self.assertEqual(digest, digest_of(a))
+        # Putting the same data again finds it, instead of writing it twice.
+        self.assertEqual(self.store.put(a.copy()), digest)
+        b = self.store.get(digest)
+        np.testing.assert_array_equal(b, a)
+        self.assertFalse(b.flags.writeable)
+        # A fresh store finds it on disk, too.
+        np.testing.assert_array_equal(RawDataStore(self.session).get(digest), a)
+
+    def test_put_empty_and_get_missing(self):
+        self.assertEqual(self.store.put(np.empty(0, dtype=np.float32)), "")
+        self.assertEqual(len(self.store.get("")), 0)
+        self.assertIsNone(self.store.get("0" * 32))
+
+    def test_files_are_shared(self):
+        digest = self.store.put(np.arange(3, dtype=np.float32))
+        mode = stat.S_IMODE(os.stat(self.store.locate(digest)).st_mode)
+        self.assertEqual(mode, 0o644)
+
+    def test_put_goes_to_session_directory_until_gathered(self):
+        self.store.directory = self.sidecar
+        kept = self.store.put(np.arange(4, dtype=np.float32))
+        dropped = self.store.put(np.arange(5, dtype=np.float32))
+        self.assertEqual(self.files(self.sidecar), set())
+        self.assertEqual(self.files(self.session), {kept + '.npy', dropped + '.npy'})
+        # Saving gathers only what the file refers to into the sidecar.
+        missing = self.store.gather({kept, "f" * 32})
+        self.assertEqual(missing, ["f" * 32])
+        self.assertEqual(self.files(self.sidecar), {kept + '.npy'})
+        self.assertEqual(os.path.dirname(self.store.locate(kept)), self.sidecar)
+
+    def test_evict_moves_unreferenced_data_to_session(self):
+        self.store.directory = self.sidecar
+        a = self.store.put(np.arange(4, dtype=np.float32))
+        b = self.store.put(np.arange(5, dtype=np.float32))
+        self.store.gather({a, b})
+        self.store.prune(set())
+        self.store.evict({a})
+        self.assertEqual(self.files(self.sidecar), {a + '.npy'})
+        self.assertEqual(self.files(self.session), {b + '.npy'})
+        # Evicted data can still be found, for undo.
+        np.testing.assert_array_equal(self.store.get(b), np.arange(5, dtype=np.float32))
+
+    def test_prune_and_remove(self):
+        a = self.store.put(np.arange(4, dtype=np.float32))
+        b = self.store.put(np.arange(5, dtype=np.float32))
+        self.store.get(b)
+        self.store.prune({a})
+        self.assertEqual(self.files(self.session), {a + '.npy'})
+        self.assertIsNone(self.store.get(b))
+        self.store.remove_session_directory()
+        self.assertFalse(os.path.exists(self.session))
+
+
+if __name__ == '__main__':
+    unittest.main()